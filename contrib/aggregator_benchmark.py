@@ -0,0 +1,72 @@
+"""Compare results stored per second one at a time and in batches
+
+Stores `starting` and `finished` results for a set of jobs the way the
+aggregator does without batching, then with `Storage.add_results` for
+each batch size, and reports results per second. Point DATABASE_URL at a
+scratch database, the benchmark creates its own tables and jobs.
+
+    DATABASE_URL=mysql://root@localhost/cronq_bench \\
+        python contrib/aggregator_benchmark.py [results] [batch sizes...]
+"""
+import datetime
+import sys
+import time
+import uuid
+
+from cronq.backends.mysql import Storage
+
+JOBS = 50
+
+
+def results(count):
+    now = datetime.datetime.utcnow()
+    out = []
+    for i in xrange(count / 2):
+        run_id = uuid.uuid4().hex
+        job_id = i % JOBS + 1
+        for type, return_code in [('starting', None), ('finished', i % 2)]:
+            out.append({
+                'job_id': job_id,
+                '_datetime': now,
+                'run_id': run_id,
+                'type': type,
+                'host': 'benchmark',
+                'return_code': return_code,
+                'resources': {'cpu_user': 0.1},
+            })
+    return out
+
+
+def one_at_a_time(storage, batch):
+    for result in batch:
+        storage.add_event(result['job_id'], result['_datetime'], result['run_id'],
+                          result['type'], result['host'], result['return_code'],
+                          resources=result['resources'])
+        storage.update_job_status(result['run_id'], result['job_id'], result['_datetime'],
+                                  result['type'], result['return_code'])
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    batch_sizes = [int(size) for size in sys.argv[2:]] or [1, 10, 100, 500]
+
+    storage = Storage()
+    storage.bootstrap()
+    now = datetime.datetime.utcnow()
+    for i in xrange(JOBS):
+        storage.add_job('benchmark {0}'.format(i), 60, 'true', now, category_id=1)
+
+    for batch_size in batch_sizes:
+        batch = results(count)
+        start = time.time()
+        if batch_size == 1:
+            one_at_a_time(storage, batch)
+        else:
+            for i in xrange(0, len(batch), batch_size):
+                storage.add_results(batch[i:i + batch_size])
+        elapsed = time.time() - start
+        print 'batch size {0}: {1:.0f} results/s'.format(batch_size, len(batch) / elapsed)
+
+
+if __name__ == '__main__':
+    main()
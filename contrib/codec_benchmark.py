@@ -0,0 +1,71 @@
+"""Compare the cost of encoding and decoding run results per message
+
+Encodes a typical `finished` result in each wire format and decodes it
+the way the aggregator does, including turning the send time into a
+datetime. The `dateutil` row is the aggregator's previous decoding,
+which parsed the legacy timestamp twice with `dateutil.parser.parse`.
+
+    python contrib/codec_benchmark.py [messages]
+"""
+import json
+import sys
+import time
+
+from cronq import codec
+from dateutil.parser import parse
+
+RESULT = {
+    'job_id': 1024,
+    'run_id': '3f2b8c9e4d5a4b6c8e7f9a0b1c2d3e4f',
+    'type': 'finished',
+    'sent_at': time.time(),
+    'host': 'runner-01.example.com',
+    'return_code': 0,
+    'run_time': 12.5,
+    'cpu_user': 3.25,
+    'cpu_system': 0.5,
+    'max_rss': 52340,
+    'block_in': 0,
+    'block_out': 128,
+    'ctx_voluntary': 1200,
+    'ctx_involuntary': 35,
+}
+
+
+def per_message(fn, count):
+    start = time.time()
+    for _ in xrange(count):
+        fn()
+    return (time.time() - start) / count * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    legacy, _ = codec.encode_result(RESULT, 'legacy')
+
+    def dateutil_decode():
+        data = json.loads(legacy)
+        parse(data['x-send-datetime'])
+        parse(data['x-send-datetime'])
+
+    print '{0:<10} {1:>10} {2:>10} {3:>8}'.format('format', 'encode us', 'decode us', 'bytes')
+    print '{0:<10} {1:>10} {2:>10.1f} {3:>8}'.format(
+        'dateutil', '-', per_message(dateutil_decode, count), len(legacy))
+    for wire_format in codec.FORMATS:
+        body, properties = codec.encode_result(RESULT, wire_format)
+        content_type = properties.get('content_type')
+
+        def encode():
+            codec.encode_result(RESULT, wire_format)
+
+        def decode():
+            data = codec.decode_result(body, content_type)
+            codec.to_datetime(data['sent_at'])
+
+        print '{0:<10} {1:>10.1f} {2:>10.1f} {3:>8}'.format(
+            wire_format, per_message(encode, count), per_message(decode, count), len(body))
+
+
+if __name__ == '__main__':
+    main()
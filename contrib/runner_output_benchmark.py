@@ -0,0 +1,79 @@
+"""Compare CPU spent per MB of job output by the runner's output loops
+
+Runs a chatty job through the previous non-blocking readline loop and
+through `iter_output_lines`, and reports the CPU time used by this
+process for each.
+
+    python contrib/runner_output_benchmark.py [megabytes]
+"""
+import fcntl
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from cronq.runner import iter_output_lines
+from cronq.utils import unicodedammit
+
+
+def job(megabytes):
+    command = 'head -c {0} /dev/urandom | base64'.format(megabytes * 1024 * 1024 * 3 / 4)
+    return subprocess.Popen(command, shell=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+def readline_loop(process):
+    fd = process.stdout.fileno()
+    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+    lines = 0
+    while True:
+        try:
+            nextline = process.stdout.readline()
+        except IOError:
+            nextline = ''
+        if nextline == '' and process.poll() is not None:
+            break
+        if nextline == '':
+            time.sleep(0.1 * random.random())
+            continue
+        message = unicodedammit(nextline.rstrip())
+        if message:
+            lines += len(message.splitlines())
+        time.sleep(0.00001)
+        sys.stdout.flush()
+    return lines
+
+
+def pump_loop(process):
+    lines = 0
+    for line in iter_output_lines(process):
+        if line.rstrip():
+            lines += 1
+    return lines
+
+
+def cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(label, loop, megabytes):
+    process = job(megabytes)
+    start_cpu, start = cpu(), time.time()
+    lines = loop(process)
+    used, elapsed = cpu() - start_cpu, time.time() - start
+    print '{0:<16} {1:8d} lines {2:7.3f}s wall {3:7.3f}s cpu {4:7.4f}s cpu/MB'.format(
+        label, lines, elapsed, used, used / megabytes)
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    measure('readline loop', readline_loop, megabytes)
+    measure('select pump', pump_loop, megabytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Time next run calculation for a category of 20k jobs
+
+Compares parsing every schedule on its own, the way category PUTs used to,
+with the compiled schedules and the bulk `next_runs` call.
+
+    python contrib/schedule_benchmark.py [number of jobs]
+"""
+import datetime
+import random
+import sys
+import time
+
+import aniso8601
+
+from cronq import interval_parser
+
+SCHEDULES = [
+    'R/2013-05-29T00:00:00/PT1M',
+    'R/2013-05-29T00:00:00/PT5M',
+    'R/2013-05-29T00:30:00/PT1H',
+    'R/2013-05-29T03:00:00/P1D',
+    'R/2013-01-31T00:00:00/P1M',
+    'R/2013-01-01T00:00:00/P1Y',
+    '*/15 * * * *',
+    '0 9-17 * * mon-fri',
+    '30 2 1 * *',
+    '@daily',
+]
+
+
+def legacy(schedule, now):
+    gen = aniso8601.parse_repeating_interval(schedule)
+    start = next(gen)
+    duration = next(gen) - start
+    iterations = int((now - start).total_seconds() / duration.total_seconds())
+    return start + duration * (iterations + 1)
+
+
+def timed(label, count, fn):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    print '{0:<32} {1:8.3f}s {2:8.2f}us/job'.format(
+        label, elapsed, elapsed / count * 1000000)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    random.seed(0)
+    schedules = [random.choice(SCHEDULES) for _ in xrange(count)]
+    iso = [schedule for schedule in schedules if schedule.startswith('R')]
+    now = datetime.datetime.utcnow()
+
+    timed('legacy parse (iso only)', len(iso),
+          lambda: [legacy(schedule, now) for schedule in iso])
+    timed('compile + next_after per job', count,
+          lambda: [interval_parser.compile_schedule(schedule).next_after(now)
+                   for schedule in schedules])
+    timed('next_runs bulk', count,
+          lambda: interval_parser.next_runs(schedules, now))
+
+
+if __name__ == '__main__':
+    main()
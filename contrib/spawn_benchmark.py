@@ -0,0 +1,61 @@
+"""Compare job launch latency with `subprocess.Popen` and the spawn helper
+
+Grows this process to the given size, to stand in for a long running
+runner, then starts a trivial command repeatedly both ways. Reports the
+time from starting a command to reading its output, and the resident
+memory of this process and of the helper.
+
+    python contrib/spawn_benchmark.py [megabytes] [runs]
+"""
+import os
+import sys
+import time
+
+from cronq.runner import CronqRunner
+from cronq.runner import iter_output_lines
+from cronq.spawn_server import SpawnServer
+
+
+def rss_kb(pid):
+    with open('/proc/{0}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def launch_latency(runner, runs):
+    timings = []
+    for _ in xrange(runs):
+        start = time.time()
+        process = runner.spawn('echo ok')
+        list(iter_output_lines(process))
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) / 2], timings[int(len(timings) * 0.99)]
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    spawn_server = SpawnServer()
+    spawn_server.start()
+
+    # touch every page so the memory is resident
+    ballast = bytearray(megabytes * 1024 * 1024)
+    for i in xrange(0, len(ballast), 4096):
+        ballast[i] = 1
+
+    print 'runner rss: {0} MB'.format(rss_kb(os.getpid()) / 1024)
+    print 'helper rss: {0} MB'.format(rss_kb(spawn_server._helper.pid) / 1024)
+    for name, runner in [('popen', CronqRunner()),
+                         ('spawn server', CronqRunner(spawn_server=spawn_server))]:
+        median, p99 = launch_latency(runner, runs)
+        print '{0}: median {1:.2f} ms, p99 {2:.2f} ms'.format(name, median * 1000, p99 * 1000)
+
+    spawn_server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Schema changes for tables that already exist
+
+`Storage.bootstrap` creates missing tables from the models, which already
+include every column and index. Deployments whose tables were created by an
+older release get the same schema by applying the migrations below, in
+order, once each. Every migration checks the live schema before changing
+it, so it is safe to run against freshly created tables too.
+"""
+import datetime
+import logging
+
+from cronq.backends import runs
+from cronq.models.event import Event
+from cronq.models.job import Job
+from cronq.models.run import Run
+from cronq.models.schema_migration import SchemaMigration
+
+from sqlalchemy import func
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateColumn
+
+logger = logging.getLogger(__name__)
+
+
+def add_columns(engine, model, names):
+    """Add the columns `names` of `model` if the table lacks them"""
+    table = model.__table__
+    existing = set(column['name'] for column in
+                   inspect(engine).get_columns(table.name))
+    for name in names:
+        if name in existing:
+            continue
+        logger.info('Adding column {0}.{1}'.format(table.name, name))
+        ddl = CreateColumn(table.c[name]).compile(dialect=engine.dialect)
+        engine.execute('ALTER TABLE {0} ADD COLUMN {1}'.format(table.name, ddl))
+
+
+def add_indexes(engine, model, names):
+    """Create the indexes `names` declared on `model` if they are missing"""
+    table = model.__table__
+    existing = set(index['name'] for index in
+                   inspect(engine).get_indexes(table.name))
+    for index in table.indexes:
+        if index.name not in names or index.name in existing:
+            continue
+        logger.info('Creating index {0} on {1}'.format(index.name, table.name))
+        index.create(engine)
+
+
+def _job_scheduling_columns(engine):
+    add_columns(engine, Job, ['updated_at', 'catchup', 'catchup_limit'])
+    # the scheduler reloads every job while no job has an update time
+    table = Job.__table__
+    engine.execute(table.update().
+                   where(table.c.updated_at.is_(None)).
+                   values(updated_at=datetime.datetime.utcnow()))
+
+
+def _job_due_indexes(engine):
+    add_indexes(engine, Job, [
+        'ix_jobs_next_run',
+        'ix_jobs_run_now',
+        'ix_jobs_updated_at',
+    ])
+
+
+def _job_jitter_column(engine):
+    add_columns(engine, Job, ['jitter'])
+
+
+def _job_schedule_column(engine):
+    add_columns(engine, Job, ['schedule'])
+
+
+def _event_resource_columns(engine):
+    add_columns(engine, Event, list(Event.RESOURCE_FIELDS))
+
+
+def _job_timeout_column(engine):
+    add_columns(engine, Job, ['timeout'])
+
+
+def _job_overlap_columns(engine):
+    add_columns(engine, Job, ['overlap', 'run_lease_expires_at'])
+
+
+def _job_status_time_column(engine):
+    add_columns(engine, Job, ['status_updated_at'])
+
+
+def _job_queued_run_column(engine):
+    add_columns(engine, Job, ['run_queued'])
+
+
+def _runs_table(engine):
+    Run.__table__.create(engine, checkfirst=True)
+    runs.backfill(engine)
+
+
+MIGRATIONS = [
+    (1, 'add job scheduling columns', _job_scheduling_columns),
+    (2, 'index jobs by due time and run now flag', _job_due_indexes),
+    (3, 'add job jitter window', _job_jitter_column),
+    (4, 'add job schedule expression', _job_schedule_column),
+    (5, 'add run resource usage to events', _event_resource_columns),
+    (6, 'add job timeout', _job_timeout_column),
+    (7, 'add job overlap policy and run lease', _job_overlap_columns),
+    (8, 'add job status update time', _job_status_time_column),
+    (9, 'add runs table built from events', _runs_table),
+    (10, 'add job queued run flag', _job_queued_run_column),
+]
+
+
+def current_version(engine):
+    version = engine.execute(
+        SchemaMigration.__table__.select().
+        with_only_columns([func.max(SchemaMigration.version)])).scalar()
+    return version or 0
+
+
+def migrate(engine):
+    """Apply every migration newer than the recorded schema version"""
+    version = current_version(engine)
+    for number, description, migration in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info('Applying migration {0}: {1}'.format(number, description))
+        migration(engine)
+        try:
+            engine.execute(SchemaMigration.__table__.insert().values(
+                version=number,
+                description=description))
+        except IntegrityError:
+            # another process applied it at the same time
+            logger.debug('Migration {0} already recorded'.format(number))
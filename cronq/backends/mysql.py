@@ -2,17 +2,35 @@
 import datetime
 import logging
 import os
+import random
 import socket
+import time
 import urllib
 
+from cronq import interval_parser
+from cronq import metrics
+from cronq.backends import migrations
+from cronq.backends import runs
 from cronq.config import Config
 from cronq.models.category import Category
 from cronq.models.event import Event
+from cronq.models.injector_instance import InjectorInstance
 from cronq.models.job import Job
-from cronq.utils import chunks_to_runs
-
+from cronq.models.run import Run
+from cronq.models.schema_migration import SchemaMigration
+from cronq.models.shard_lease import ShardLease
+
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import case
+from sqlalchemy import CHAR
 from sqlalchemy import create_engine
+from sqlalchemy import DateTime
+from sqlalchemy import false
+from sqlalchemy import func
+from sqlalchemy import null
 from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.exc import InternalError
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.exc import ProgrammingError
@@ -25,13 +43,98 @@ from uuid import uuid4
 
 logger = logging.getLogger(__name__)
 
+# attempts at a job status update that conflicts with other transactions
+STATUS_UPDATE_ATTEMPTS = 5
+# first wait between those attempts, doubled each time, in seconds
+STATUS_UPDATE_BACKOFF = 0.05
+
+
+def _backoff(attempt):
+    """Randomized exponential delay before retrying after `attempt` failures"""
+    delay = STATUS_UPDATE_BACKOFF * (2 ** attempt)
+    return delay / 2 + random.random() * delay / 2
+
+
+def _status_statements():
+    """Conditional UPDATE statements applying a run result to a job
+
+    A result only changes the row if it is newer than the last one applied,
+    so results arriving out of order cannot regress the status, and a start
+    does not override a result sent at the same time. The statements use
+    bind parameters only, so a batch of results runs as one executemany
+    per kind.
+    """
+    table = Job.__table__
+    at = bindparam('at', type_=DateTime())
+    status = bindparam('status', type_=CHAR(32))
+
+    def statement(newer, values):
+        values.append((table.c.status_updated_at, at))
+        return table.update(preserve_parameter_order=True).where(and_(
+            table.c.id == bindparam('job'),
+            or_(table.c.status_updated_at.is_(None), newer),
+        )).values(values)
+
+    # a start never shortens the lease taken when the run was published
+    renewed = bindparam('renewed', type_=DateTime())
+    start = statement(table.c.status_updated_at < at, [
+        (table.c.run_lease_expires_at, case(
+            [(or_(table.c.overlap.is_(None), table.c.overlap == Job.OVERLAP_ALLOW),
+              table.c.run_lease_expires_at),
+             (table.c.run_lease_expires_at > renewed, table.c.run_lease_expires_at)],
+            else_=renewed)),
+        (table.c.current_status, status),
+        (table.c.last_run_start, at),
+        (table.c.last_run_status, None),
+        (table.c.last_run_stop, None),
+    ])
+
+    # a finishing run leaves a run published after it waiting, and flags
+    # the run a queue_one job held back to run now otherwise. MySQL sees
+    # columns assigned earlier in the statement, the check holds whichever
+    # of the two values it sees
+    queued = and_(table.c.current_status == Storage.QUEUED,
+                  table.c.run_lease_expires_at > bindparam('now', type_=DateTime()))
+    finish = statement(table.c.status_updated_at <= at, [
+        (table.c.run_lease_expires_at, case(
+            [(queued, table.c.run_lease_expires_at)], else_=null())),
+        (table.c.current_status, case([(queued, Storage.QUEUED)], else_=status)),
+        (table.c.run_now, case(
+            [(queued, table.c.run_now), (table.c.run_queued == 1, 1)],
+            else_=table.c.run_now)),
+        (table.c.run_queued, case([(queued, table.c.run_queued)], else_=0)),
+        (table.c.last_run_status, status),
+        (table.c.last_run_stop, at),
+        # set when a batch holds the start of the run too
+        (table.c.last_run_start, func.coalesce(
+            bindparam('started_at', type_=DateTime()), table.c.last_run_start)),
+    ])
+
+    other = statement(table.c.status_updated_at <= at, [
+        (table.c.current_status, status),
+    ])
+    return {'start': start, 'finish': finish, 'other': other}
+
+
+_STATUS_STATEMENTS = {}
+
+
+def _status_statement(kind):
+    if not _STATUS_STATEMENTS:
+        _STATUS_STATEMENTS.update(_status_statements())
+    return _STATUS_STATEMENTS[kind]
+
 
 class Storage(object):
 
     FINISHED = 'finished'
     FAILED = 'failed'
+    QUEUED = 'queued'
+    SKIPPED = 'skipped'
     STARTED = 'started'
+    STARTING = 'starting'
     SUCCEEDED = 'succeeded'
+    TIMED_OUT = 'timed_out'
 
     def __init__(self, publisher=None, isolation_level='SERIALIZABLE'):
         self.publisher = publisher
@@ -40,6 +143,9 @@ class Storage(object):
         self._maker = sessionmaker(bind=self._engine)
         self.session = self._new_session()
 
+        # (number of shards, owned shards) when injecting a subset of jobs
+        self._shards = None
+
     def _new_engine(self, isolation_level='SERIALIZABLE'):
         if isolation_level is not None:
             return create_engine(Config.DATABASE_URL,
@@ -54,6 +160,10 @@ class Storage(object):
             Category,
             Job,
             Event,
+            ShardLease,
+            InjectorInstance,
+            SchemaMigration,
+            Run,
         ]
         for model in models:
             try:
@@ -61,6 +171,8 @@ class Storage(object):
             except (InternalError, OperationalError, ProgrammingError):
                 logger.debug("error in create table - probably already exists: {}".format(model.__table__))
 
+        migrations.migrate(self._engine)
+
     def close(self):
         self.session.close()
         self._engine.dispose()
@@ -72,9 +184,19 @@ class Storage(object):
                 next_run,
                 id=None,
                 category_id=None,
-                routing_key=None):
+                routing_key=None,
+                catchup=None,
+                catchup_limit=None,
+                jitter=None,
+                schedule=None,
+                timeout=None,
+                overlap=None):
         if routing_key is None:
             routing_key = 'default'
+        if catchup is None:
+            catchup = Job.CATCHUP_ONCE
+        if overlap is None:
+            overlap = Job.OVERLAP_ALLOW
         job = Job()
         job.id = id
         job.name = name
@@ -83,65 +205,204 @@ class Storage(object):
         job.command = command
         job.routing_key = routing_key
         job.category_id = category_id
+        job.catchup = catchup
+        job.catchup_limit = catchup_limit
+        job.jitter = jitter
+        job.schedule = schedule
+        job.timeout = timeout
+        job.overlap = overlap
         self.session.merge(job)
         self.session.commit()
 
     def remove_job(self, job_id):
         job = self.session.query(Job).get(job_id)
         if job:
+            # runs only make sense with their job, events are kept
+            self.session.query(Run).filter_by(job_id=job_id).\
+                delete(synchronize_session=False)
             self.session.delete(job)
             self.session.commit()
 
-    def add_event(self, job_id, _datetime, run_id, type, host, return_code):
-        event = Event()
-        event.job_id = job_id
-        event.datetime = _datetime
-        event.run_id = run_id
-        event.type = type
-        event.host = host
-        event.return_code = return_code
-        self.session.add(event)
-        self.session.commit()
+    def add_event(self, job_id, _datetime, run_id, type, host, return_code, resources=None):
+        """Store a run result as an event and apply it to its run"""
+        self._store_results([{
+            'job_id': job_id,
+            '_datetime': _datetime,
+            'run_id': run_id,
+            'type': type,
+            'host': host,
+            'return_code': return_code,
+            'resources': resources,
+        }], update_status=False)
+
+    def add_results(self, results):
+        """Store a batch of run results in a single transaction
+
+        `results` are dicts with the arguments of `add_event`. Their events
+        are inserted with one multi-row statement, their runs are upserted,
+        and each job they touch gets a single conditional status update for
+        its newest result. Lock conflicts are retried a bounded number of
+        times with backoff, after which the error is raised and nothing is
+        stored.
+        """
+        self._store_results(list(results), update_status=True)
+
+    def _store_results(self, results, update_status):
+        if not results:
+            return
+
+        rows = []
+        for result in results:
+            row = dict((field, (result.get('resources') or {}).get(field))
+                       for field in Event.RESOURCE_FIELDS)
+            row.update({
+                'job_id': result['job_id'],
+                'datetime': result['_datetime'],
+                'run_id': result['run_id'],
+                'type': result['type'],
+                'host': result.get('host'),
+                'return_code': result.get('return_code'),
+            })
+            rows.append(row)
+
+        updates = []
+        if update_status:
+            starts = set(result['job_id'] for result in results
+                         if result['type'] in (self.STARTED, self.STARTING))
+            updates = self._merge_status_updates(results, self._job_timeouts(starts))
+        for attempt in xrange(STATUS_UPDATE_ATTEMPTS):
+            try:
+                self.session.execute(Event.__table__.insert(), rows)
+                # a run inserted concurrently raises IntegrityError
+                runs.upsert_runs(self.session, results)
+                for kind, params in updates:
+                    self.session.execute(_status_statement(kind), params)
+                self.session.commit()
+                return
+            except (IntegrityError, InternalError, OperationalError):
+                self.session.rollback()
+                if attempt + 1 == STATUS_UPDATE_ATTEMPTS:
+                    raise
+                delay = _backoff(attempt)
+                logger.warning('Unable to store a batch of {0} results, retrying in {1:.2f}s'.format(
+                    len(results), delay))
+                time.sleep(delay)
+
+    def _merge_status_updates(self, results, timeouts=None):
+        """Status statement parameters for the newest result of each job
+
+        Returns (kind, parameter list) pairs. Jobs are in id order, so
+        concurrent batches lock them in the same order. A finishing result
+        also carries the start of its run when the batch holds that too.
+        `timeouts` maps job ids to their timeout, for the lease a start
+        renews.
+        """
+        timeouts = timeouts or {}
+        terminal = (self.FAILED, self.TIMED_OUT, self.FINISHED)
+        starts = (self.STARTED, self.STARTING)
+        newest = {}
+        started = {}
+        for result in results:
+            if result['type'] == self.SKIPPED:
+                continue
+            job_id = result['job_id']
+            if result['type'] in starts:
+                started.setdefault(job_id, []).append(result['_datetime'])
+            # on a tie a finishing result wins over a start, like the
+            # conditions of the status statements
+            key = (result['_datetime'], result['type'] in terminal)
+            if job_id not in newest or key >= newest[job_id][0]:
+                newest[job_id] = (key, result)
+
+        updates = {}
+        for job_id in sorted(newest):
+            result = newest[job_id][1]
+            started_at = None
+            if result['type'] in terminal:
+                earlier = [start for start in started.get(job_id, [])
+                           if start <= result['_datetime']]
+                started_at = max(earlier) if earlier else None
+            kind, params = self._status_params(job_id, result['_datetime'], result['type'],
+                                               result.get('return_code'), started_at,
+                                               timeouts.get(job_id))
+            updates.setdefault(kind, []).append(params)
+        return sorted(updates.items())
 
     def update_job_status(self, run_id, job_id, _datetime, status, return_code=None):
-        while True:
+        """Apply a run result to the job's status with one conditional UPDATE
+
+        Lock conflicts are retried a bounded number of times with backoff.
+        Returns False if the update could not be written.
+        """
+        for attempt in xrange(STATUS_UPDATE_ATTEMPTS):
             try:
                 self._update_job_status(job_id, _datetime, status, return_code)
-                break
-            except InternalError:
-                logger.warning('[cronq_job_id:{0}] [cronq_run_id:{1}] Unable to update job with result, retrying'.format(
-                    job_id, run_id
-                ))
+                self.session.commit()
+                return True
+            except (InternalError, OperationalError):
                 self.session.rollback()
-        return True
-
-    def _update_job_status(self, job_id, _datetime, new_status, return_code=None):
-        job = self.session.query(Job).get(job_id)
+                if attempt + 1 == STATUS_UPDATE_ATTEMPTS:
+                    break
+                delay = _backoff(attempt)
+                logger.warning('[cronq_job_id:{0}] [cronq_run_id:{1}] Unable to update job with result, retrying in {2:.2f}s'.format(
+                    job_id, run_id, delay
+                ))
+                time.sleep(delay)
 
-        if not job:
-            logger.warning('[cronq_job_id:{0}] job not found during update')
-            return
+        logger.error('[cronq_job_id:{0}] [cronq_run_id:{1}] Gave up updating job with result'.format(
+            job_id, run_id))
+        return False
 
-        # update record if found
-        job.current_status = new_status
-        if new_status == self.STARTED:
-            job.last_run_start = _datetime
-            job.last_run_status = None
-            job.last_run_stop = None
-        if new_status == self.FAILED:
-            job.last_run_status = new_status
-            job.last_run_stop = _datetime
-        if new_status == self.FINISHED:
-            job.last_run_status = new_status
-            job.last_run_stop = _datetime
-            if return_code is not None:
-                job.current_new_status = self.FAILED
-                job.last_run_status = self.FAILED
-                if int(return_code) == 0:
-                    job.current_status = self.SUCCEEDED
-                    job.last_run_status = self.SUCCEEDED
-        self.session.merge(job)
-        self.session.commit()
+    def _update_job_status(self, job_id, _datetime, new_status, return_code=None):
+        """Write the status change for a result, without committing"""
+        timeout = None
+        if new_status in (self.STARTED, self.STARTING):
+            timeout = self._job_timeouts([job_id]).get(job_id)
+        kind, params = self._status_params(job_id, _datetime, new_status, return_code,
+                                           timeout=timeout)
+        if kind is None:
+            # the run that caused the skip still owns the job status
+            return False
+
+        updated = self.session.execute(_status_statement(kind), params).rowcount
+        if not updated:
+            logger.info('[cronq_job_id:{0}] job not found or has a newer status, ignoring {1} result'.format(
+                job_id, new_status))
+        return bool(updated)
+
+    def _status_params(self, job_id, _datetime, new_status, return_code=None, started_at=None,
+                       timeout=None):
+        """The kind of status statement for a result, and its parameters
+
+        A start renews the run lease for as long as publishing a job with
+        `timeout` takes it.
+        """
+        if new_status == self.SKIPPED:
+            return None, None
+
+        now = datetime.datetime.utcnow()
+        params = {'job': job_id, 'at': _datetime, 'status': new_status}
+        if new_status in (self.STARTED, self.STARTING):
+            params['renewed'] = now + self._run_lease(timeout)
+            return 'start', params
+
+        if new_status in (self.FAILED, self.TIMED_OUT, self.FINISHED):
+            if new_status == self.FINISHED and return_code is not None:
+                params['status'] = self.SUCCEEDED if int(return_code) == 0 else self.FAILED
+            params['now'] = now
+            params['started_at'] = started_at
+            return 'finish', params
+
+        return 'other', params
+
+    def _job_timeouts(self, job_ids):
+        """Returns the timeout of each of `job_ids` that has one"""
+        if not job_ids:
+            return {}
+        query = self.session.query(Job.id, Job.timeout).\
+            filter(Job.id.in_(sorted(job_ids))).\
+            filter(Job.timeout != None)  # noqa
+        return dict(query)
 
     def jobs(self, _id=None, category_id=None, page=0, per_page=None, sort='category_id.asc', include_runs=False):
         session = self.session
@@ -186,9 +447,15 @@ class Storage(object):
                 'routing_key': job.routing_key,
                 'command': job.command,
                 'locked_by': job.locked_by,
+                'catchup': job.catchup,
+                'catchup_limit': job.catchup_limit,
+                'jitter': job.jitter,
+                'schedule': job.schedule,
+                'timeout': job.timeout,
+                'overlap': job.overlap,
             }
             if include_runs:
-                data['runs'] = chunks_to_runs(self.last_event_chunks_for_job(job.id, 20))
+                data['runs'] = self.runs_for_job(job.id, 20)
             category = filter(lambda c: c['id'] == job.category_id, categories)
             if len(category) == 1:
                 data['category'] = category[0]
@@ -249,51 +516,37 @@ class Storage(object):
             self.session.commit()
         return category.id
 
-    def last_event_chunks_for_job(self, job_id, number):
-        events = self.session.query(Event).filter_by(job_id=job_id).\
-            order_by(desc(Event.id)).limit(number)
-        events = [doc for doc in self.event_models_to_docs(events)]
-
-        if len(events) == 0:
-            return []
-
-
-        chunks = {}
-        for event in events:
-            if event['run_id'] not in chunks:
-
-                chunks[event['run_id']] = {
-                    'first': None,
-                    'last': None,
-                    'job_id': event['job_id']
-                }
+    def runs_for_job(self, job_id, number):
+        """The newest `number` runs of a job, newest first"""
+        runs = self.session.query(Run).filter_by(job_id=job_id).\
+            order_by(desc(Run.created_at)).limit(number)
+        return [self._run_doc(run) for run in runs]
 
-            if event['type'] == 'starting':
-                chunks[event['run_id']]['first'] = event
-            else:
-                chunks[event['run_id']]['last'] = event
+    def get_run(self, run_id):
+        run = self.session.query(Run).get(run_id)
+        if run is None:
+            return None
+        return self._run_doc(run)
+
+    def _run_doc(self, run):
+        doc = {
+            'id': run.id,
+            'job_id': run.job_id,
+            'host': run.host,
+            'status': run.status,
+            'created_at': run.created_at,
+            'started_at': run.started_at,
+            'completed_at': run.completed_at,
+            'duration': run.duration,
+            'return_code': run.return_code,
+        }
+        for field in Event.RESOURCE_FIELDS:
+            doc[field] = getattr(run, field)
 
         log_url_template = os.getenv('CRONQ_LOG_URL_TEMPLATE', None)
         if log_url_template:
-            self._add_log_urls(chunks, log_url_template)
-
-        docs = [chunk for i, chunk in chunks.iteritems()]
-
-        def chunk_compare(x, y):
-            first = x.get('first', x.get('last'))
-            last = y.get('first', y.get('last'))
-            if first is None and last is None:
-                return 0
-            if first is None:
-                return -1
-            if last is None:
-                return 1
-            return int((first['datetime'] - last['datetime']).total_seconds())
-
-        # newest to oldest
-        docs = sorted(docs, cmp=chunk_compare, reverse=True)
-
-        return docs
+            doc['log_url'] = self._log_url(doc, log_url_template)
+        return doc
 
     def events_for_run_id(self, run_id):
         events = self.session.query(Event).filter_by(run_id=run_id).\
@@ -302,8 +555,8 @@ class Storage(object):
 
     def failures(self):
         events = self.session.query(Event)\
-            .filter_by(type=self.FINISHED)\
-            .filter(Event.return_code != 0)\
+            .filter(or_(and_(Event.type == self.FINISHED, Event.return_code != 0),
+                        Event.type == self.TIMED_OUT))\
             .order_by(desc(Event.id)).limit(50)
         return self.event_models_to_docs(events)
 
@@ -313,38 +566,359 @@ class Storage(object):
         self.session.merge(event)
         self.session.commit()
 
-    def inject(self):
-        """Get a message from storage and injects it into the job stream"""
+    def inject(self, batch_size=None):
+        """Get messages from storage and injects them into the job stream
+
+        When `batch_size` is greater than one, due jobs are claimed up to
+        `batch_size` at a time in a single transaction instead of one
+        transaction per job.
+        """
         logger.info('Trying to inject')
-        while self.get_unpublished_task() is not None:
-            pass
+        if self._shards is not None and not self._shards[1]:
+            logger.info('No shards owned, nothing to inject')
+            return 0
+
+        start = time.time()
+        claimed = 0
+        if batch_size is None or batch_size <= 1:
+            while self.get_unpublished_task() is not None:
+                claimed += 1
+        else:
+            while True:
+                count = self.get_unpublished_tasks(batch_size)
+                claimed += count
+                if count < batch_size:
+                    break
+
+        duration = time.time() - start
+        metrics.INJECT_CYCLE.observe(duration)
+        metrics.JOBS_CLAIMED.observe(claimed)
+        logger.info('Inject cycle claimed {0} jobs in {1:.3f} seconds'.format(
+            claimed, duration))
+        return claimed
+
+    def job_watermark(self):
+        """Returns a cheap (count, last update) summary of the jobs table
+
+        Comparing two watermarks tells whether any job was added, removed or
+        modified in between without reading the job rows themselves.
+        """
+        session = self._new_session()
+        try:
+            query = session.query(func.count(Job.id), func.max(Job.updated_at))
+            return self._filter_shards(query).one()
+        finally:
+            session.close()
 
-    def get_job_to_inject(self, session):
-        to_run = or_(
-            Job.next_run < datetime.datetime.utcnow(),
-            Job.run_now == True,  # noqa
-        )
-        job = session.query(Job).filter(to_run).first()
-        if job is None:
+    def job_schedule(self, updated_since=None):
+        """Returns (id, next_run, run_now) for jobs changed since a time
+
+        Without `updated_since` every job is returned.
+        """
+        session = self._new_session()
+        try:
+            query = self._filter_shards(
+                session.query(Job.id, Job.next_run, Job.run_now))
+            if updated_since is not None:
+                query = query.filter(Job.updated_at >= updated_since)
+            return query.all()
+        finally:
+            session.close()
+
+    def _due_jobs_queries(self, session):
+        """Queries for jobs flagged to run now and jobs past their next run
+
+        They are kept apart so each can use its own index, where an OR
+        across both columns would force a scan of the whole jobs table.
+        """
+        run_now = session.query(Job).filter(Job.run_now == True)  # noqa
+        overdue = session.query(Job).\
+            filter(Job.next_run < datetime.datetime.utcnow()).\
+            order_by(asc(Job.next_run))
+        return [self._filter_shards(run_now), self._filter_shards(overdue)]
+
+    def use_shards(self, num_shards, shards):
+        """Restrict injection to jobs whose id falls in one of `shards`
+
+        Jobs are spread over `num_shards` shards by `id % num_shards`.
+        Passing `num_shards=None` injects every job again.
+        """
+        if num_shards is None:
+            self._shards = None
+        else:
+            self._shards = (num_shards, sorted(shards))
+
+    def _filter_shards(self, query):
+        if self._shards is None:
+            return query
+        num_shards, shards = self._shards
+        if not shards:
+            return query.filter(false())
+        return query.filter((Job.id % num_shards).in_(shards))
+
+    def ensure_shard_leases(self, num_shards):
+        """Create the lease rows for shards that do not exist yet"""
+        session = self._new_session()
+        try:
+            existing = set(row.shard for row in session.query(ShardLease.shard))
+            for shard in xrange(num_shards):
+                if shard not in existing:
+                    session.add(ShardLease(shard=shard))
+            session.commit()
+        except (IntegrityError, InternalError, OperationalError):
+            # another injector created them at the same time
+            session.rollback()
+        finally:
+            session.close()
+
+    def heartbeat_injector(self, name, ttl):
+        """Mark injector `name` alive and return all live injector names
+
+        Injectors that have not sent a heartbeat within `ttl` seconds are
+        forgotten. Returns None if the heartbeat could not be written.
+        """
+        now = datetime.datetime.utcnow()
+        expired = now - datetime.timedelta(seconds=ttl)
+        table = InjectorInstance.__table__
+        session = self._new_session()
+        try:
+            result = session.execute(table.update().
+                                     where(table.c.name == name).
+                                     values(heartbeat_at=now))
+            if result.rowcount == 0:
+                session.execute(table.insert().values(name=name, heartbeat_at=now))
+            session.execute(table.delete().where(table.c.heartbeat_at < expired))
+            session.commit()
+
+            query = session.query(InjectorInstance.name).\
+                filter(InjectorInstance.heartbeat_at >= expired).\
+                order_by(asc(InjectorInstance.name))
+            names = [row.name.strip() for row in query]
+            session.commit()
+            return names
+        except (IntegrityError, InternalError, OperationalError), e:
+            session.rollback()
+            logger.warning('Unable to heartbeat injector {0} - {1}'.format(name, e))
             return None
+        finally:
+            session.close()
 
-        logger.info('[cronq_job_id:{0}] Found a job: {1} {2}'.format(
-            job.id, job.name, job.next_run))
+    def renew_shard_leases(self, name, ttl, num_shards):
+        """Extend every unexpired lease held by `name`
 
-        return job
+        Returns the shards still held, or None if they could not be renewed.
+        """
+        now = datetime.datetime.utcnow()
+        table = ShardLease.__table__
+        held = and_(table.c.owner == name,
+                    table.c.expires_at >= now,
+                    table.c.shard < num_shards)
+        session = self._new_session()
+        try:
+            session.execute(table.update().where(held).values(
+                expires_at=now + datetime.timedelta(seconds=ttl)))
+            shards = [row.shard for row in
+                      session.execute(table.select().where(held))]
+            session.commit()
+            return sorted(shards)
+        except (InternalError, OperationalError), e:
+            session.rollback()
+            logger.warning('Unable to renew shard leases for {0} - {1}'.format(name, e))
+            return None
+        finally:
+            session.close()
 
-    def update_job_time(self, session, job):
+    def free_shards(self, num_shards):
+        """Returns the shards that have no owner or whose lease expired"""
+        now = datetime.datetime.utcnow()
+        session = self._new_session()
+        try:
+            query = session.query(ShardLease.shard).\
+                filter(ShardLease.shard < num_shards).\
+                filter(or_(ShardLease.owner == None,  # noqa
+                           ShardLease.expires_at < now))
+            return sorted(row.shard for row in query)
+        finally:
+            session.close()
+
+    def claim_shard_lease(self, shard, name, ttl):
+        """Take the lease on `shard` if it is free, returns True on success"""
+        now = datetime.datetime.utcnow()
+        table = ShardLease.__table__
+        free = and_(table.c.shard == shard,
+                    or_(table.c.owner == None,  # noqa
+                        table.c.expires_at < now))
+        session = self._new_session()
+        try:
+            result = session.execute(table.update().where(free).values(
+                owner=name,
+                expires_at=now + datetime.timedelta(seconds=ttl)))
+            session.commit()
+            return result.rowcount == 1
+        except (InternalError, OperationalError), e:
+            session.rollback()
+            logger.warning('Unable to claim shard {0} for {1} - {2}'.format(shard, name, e))
+            return False
+        finally:
+            session.close()
+
+    def release_shard_leases(self, name, shards):
+        """Give up the leases `name` holds on `shards`"""
+        if not shards:
+            return
+        table = ShardLease.__table__
+        session = self._new_session()
+        try:
+            session.execute(table.update().
+                            where(table.c.owner == name).
+                            where(table.c.shard.in_(shards)).
+                            values(owner=None, expires_at=None))
+            session.commit()
+        except (InternalError, OperationalError), e:
+            session.rollback()
+            logger.warning('Unable to release shards {0} for {1} - {2}'.format(shards, name, e))
+        finally:
+            session.close()
+
+    def get_job_to_inject(self, session):
+        for query in self._due_jobs_queries(session):
+            job = query.first()
+            if job is not None:
+                logger.info('[cronq_job_id:{0}] Found a job: {1} {2}'.format(
+                    job.id, job.name, job.next_run))
+                return job
+
+        return None
+
+    def get_jobs_to_inject(self, session, limit):
+        """Lock and return up to `limit` due jobs, run now jobs first"""
+        jobs = []
+        for query in self._due_jobs_queries(session):
+            if len(jobs) >= limit:
+                break
+            if jobs:
+                query = query.filter(~Job.id.in_([job.id for job in jobs]))
+            query = self._claim_query(query.limit(limit - len(jobs)),
+                                      session.bind.dialect.name)
+            jobs.extend(query.all())
+
+        for job in jobs:
+            logger.info('[cronq_job_id:{0}] Found a job: {1} {2}'.format(
+                job.id, job.name, job.next_run))
+
+        return jobs
+
+    @staticmethod
+    def _claim_query(query, dialect_name):
+        """Lock the rows of `query` for the injector claiming them"""
+        query = query.with_for_update()
+        if Config.INJECTOR_SKIP_LOCKED and dialect_name == 'mysql':
+            # rows held by other injectors are skipped instead of waited on
+            query = query.suffix_with('SKIP LOCKED')
+        return query
+
+    def _advance_job_time(self, job, session=None):
+        """Move the job to its next run and return how many runs to publish
+
+        Runs held back by the job's overlap policy are recorded as skipped
+        events in `session`.
+        """
+        current_time = datetime.datetime.utcnow()
         if job.next_run is None:
-            current_time = datetime.datetime.utcnow()
             logger.info('[cronq_job_id:{0}] Setting time to {1}'.format(job.id, current_time))
             job.next_run = current_time
+            due = 1
+        elif job.schedule:
+            # one more than can be replayed, so skip can tell runs were missed
+            job.next_run, due = interval_parser.compile_schedule(job.schedule).advance(
+                job.next_run, current_time, Config.INJECTOR_MAX_CATCHUP + 1)
         else:
-            while job.next_run < datetime.datetime.utcnow():
-                logger.info('[cronq_job_id:{0}] Adding time!'.format(job.id))
-                job.next_run += job.interval
+            job.next_run, due = interval_parser.advance_next_run(
+                job.next_run, job.interval, current_time)
+
+        limit = min(job.catchup_limit or Config.INJECTOR_MAX_CATCHUP,
+                    Config.INJECTOR_MAX_CATCHUP)
+        runs = interval_parser.runs_for_catchup(job.catchup, due, limit)
+        if job.run_now:
+            runs = max(runs, 1)
+        if due > 1:
+            logger.info('[cronq_job_id:{0}] {1} runs were due, catchup policy {2} publishes {3}'.format(
+                job.id, due, job.catchup, runs))
+
+        if runs and job.overlap not in (None, Job.OVERLAP_ALLOW):
+            runs = self._limit_overlap(job, current_time, session)
+
         job.run_now = False
-        me = '{0}.{1}'.format(socket.gethostname(), os.getpid())
-        job.locked_by = me
+        job.locked_by = self._injector_name()
+        return runs
+
+    @staticmethod
+    def _run_lease(timeout):
+        """How long a queued or running run of a job with `timeout` holds back the next one"""
+        return datetime.timedelta(seconds=max(Config.INJECTOR_OVERLAP_LEASE,
+                                              2 * (timeout or 0)))
+
+    def _run_in_progress(self, job, now=None):
+        """Whether a run of `job` is queued or running and its lease is live
+
+        The lease is taken when a run is published and renewed when it
+        starts, so runs lost with a runner stop blocking once it expires.
+        """
+        if job.current_status not in (self.QUEUED, self.STARTING, self.STARTED):
+            return False
+        if job.run_lease_expires_at is None:
+            return False
+        return job.run_lease_expires_at > (now or datetime.datetime.utcnow())
+
+    def _limit_overlap(self, job, now, session=None):
+        """Publish at most one run, and none while a run is in progress
+
+        A queue_one job holds one run back instead of skipping it. The
+        status update that finishes the run in progress flags it to run
+        now, so it is published once that run is over.
+        """
+        if not self._run_in_progress(job, now):
+            job.current_status = self.QUEUED
+            job.run_lease_expires_at = now + self._run_lease(job.timeout)
+            job.run_queued = 0
+            return 1
+
+        if job.overlap == Job.OVERLAP_QUEUE_ONE and not job.run_queued:
+            logger.info('[cronq_job_id:{0}] Previous run still in progress, queueing a run'.format(job.id))
+            job.run_queued = 1
+            return 0
+
+        logger.info('[cronq_job_id:{0}] Previous run still in progress, skipping'.format(job.id))
+        if session is not None:
+            result = {
+                'job_id': job.id,
+                '_datetime': now,
+                'run_id': uuid4().hex,
+                'type': self.SKIPPED,
+                'host': self._injector_name(),
+            }
+            event = Event()
+            event.job_id = result['job_id']
+            event.datetime = result['_datetime']
+            event.run_id = result['run_id']
+            event.type = result['type']
+            event.host = result['host']
+            session.add(event)
+            # the job's history is read from its runs
+            runs.upsert_runs(session, [result])
+        return 0
+
+    @staticmethod
+    def _injector_name():
+        return '{0}.{1}'.format(socket.gethostname(), os.getpid())
+
+    def update_job_time(self, session, job):
+        """Advance the next run of `job` and commit it
+
+        Returns the number of runs to publish, or None if the job could not
+        be updated.
+        """
+        runs = self._advance_job_time(job, session)
 
         # update
         try:
@@ -361,44 +935,184 @@ class Storage(object):
             raise
         else:
             logger.info('[cronq_job_id:{0}] Next job run: {1}'.format(job.id, job.next_run))
-            return job
+            return runs
+
+    def update_jobs_time(self, session, jobs):
+        """Advance the next run of every job in `jobs` in one commit
+
+        Returns the documents to publish for the claimed jobs, or None if
+        the batch could not be committed.
+        """
+        docs = []
+        for job in jobs:
+            scheduled_at = self._scheduled_at(job)
+            runs = self._advance_job_time(job, session)
+            job_doc = self._job_doc_for_inject(job, scheduled_at)
+            docs.extend([(job.routing_key, job_doc)] * runs)
+            logger.info('[cronq_job_id:{0}] Next job run: {1}'.format(job.id, job.next_run))
+
+        try:
+            session.commit()
+        except InternalError, e:
+            session.rollback()
+            logger.warning('Error updating time for batch of {0} jobs - {1}'.format(
+                len(jobs), e))
+            return None
+        except Exception, e:
+            session.rollback()
+            logger.exception('Error updating time for batch of {0} jobs - {1}'.format(
+                len(jobs), e))
+            raise
+
+        return docs
+
+    @staticmethod
+    def _scheduled_at(job):
+        """Returns when a claimed job was due, None for run now requests"""
+        if job.next_run is None or job.next_run >= datetime.datetime.utcnow():
+            return None
+        return job.next_run
+
+    def _job_doc_for_inject(self, job, scheduled_at=None):
+        doc = {
+            'name': job.name,
+            'command': unicode(job.command),
+            'id': job.id,
+            'scheduled_at': scheduled_at,
+        }
+        if job.jitter is not None:
+            doc['jitter'] = job.jitter
+        if job.timeout is not None:
+            doc['timeout'] = job.timeout
+        if job.overlap not in (None, Job.OVERLAP_ALLOW):
+            doc['overlap'] = job.overlap
+        return doc
+
+    def _publish_job(self, routing_key, job_doc):
+        logger.info("[cronq_job_id:{0}] Trying to publish job".format(job_doc['id']))
+        success = self.publisher.publish(routing_key, job_doc, uuid4().hex)
+        if not success:
+            logger.warning('[cronq_job_id:{0}] Error publishing: {1}'.format(
+                job_doc['id'], job_doc['name']))
+            return False
+
+        logger.info("[cronq_job_id:{0}] Job published".format(job_doc['id']))
+        return True
+
+    def _publish_jobs(self, docs):
+        """Publish (routing_key, job_doc) pairs without waiting on each confirm"""
+        jobs = [(routing_key, job_doc, uuid4().hex) for routing_key, job_doc in docs]
+        logger.info("Trying to publish {0} jobs".format(len(jobs)))
+        results = self.publisher.publish_many(jobs)
+        for (routing_key, job_doc, run_id), success in zip(jobs, results):
+            if success:
+                logger.info("[cronq_job_id:{0}] Job published".format(job_doc['id']))
+            else:
+                logger.warning('[cronq_job_id:{0}] Error publishing: {1}'.format(
+                    job_doc['id'], job_doc['name']))
+        return results
+
+    def inject_job_now(self, job_id):
+        """Publish a run of `job_id` if it is still flagged to run now
+
+        The flag is cleared with a conditional update before publishing, so
+        a request that the regular scan also sees only results in one run.
+        """
+        table = Job.__table__
+        flagged = and_(table.c.id == job_id, table.c.run_now == 1)
+        session = self._new_session()
+        try:
+            result = session.execute(table.update().where(flagged).values(
+                run_now=0,
+                locked_by=self._injector_name()))
+            session.commit()
+            if result.rowcount != 1:
+                logger.info('[cronq_job_id:{0}] Run now already handled'.format(job_id))
+                return False
+
+            job = session.query(Job).get(job_id)
+            if job.overlap not in (None, Job.OVERLAP_ALLOW):
+                if not self._limit_overlap(job, datetime.datetime.utcnow(), session):
+                    session.commit()
+                    return False
+            routing_key = job.routing_key
+            job_doc = self._job_doc_for_inject(job)
+            session.commit()
+        except (InternalError, OperationalError), e:
+            session.rollback()
+            logger.warning('[cronq_job_id:{0}] Error claiming run now - {1}'.format(job_id, e))
+            return False
+        finally:
+            session.close()
+
+        if self._publish_job(routing_key, job_doc):
+            return True
+
+        # leave it to the regular scan
+        self.run_job_now(job_id)
+        return False
 
     def get_unpublished_task(self):
         session = self._new_session()
 
+        start = time.time()
         job = self.get_job_to_inject(session)
+        metrics.DB_QUERY.observe(time.time() - start)
         if not job:
             logger.info("no job found")
             session.close()
             return
 
         # update job time
-        job = self.update_job_time(session, job)
-        if not job:
+        scheduled_at = self._scheduled_at(job)
+        start = time.time()
+        runs = self.update_job_time(session, job)
+        metrics.DB_QUERY.observe(time.time() - start)
+        if runs is None:
             logger.info("no job found after update time")
             session.close()
             return
 
         # inject
-        job_doc = {
-            'name': job.name,
-            'command': unicode(job.command),
-            'id': job.id,
-        }
+        job_doc = self._job_doc_for_inject(job, scheduled_at)
+        for _ in xrange(runs):
+            if not self._publish_job(job.routing_key, job_doc):
+                session.close()
+                return
 
-        # publish
-        logger.info("[cronq_job_id:{0}] Trying to publish job".format(job.id))
-        success = self.publisher.publish(job.routing_key, job_doc, uuid4().hex)
-        if not success:
-            logger.warning('[cronq_job_id:{0}] Error publishing: {1}'.format(
-                job.id, job.name))
+        session.close()
+        return True
+
+    def get_unpublished_tasks(self, limit):
+        """Claim and publish up to `limit` due jobs
+
+        Returns the number of jobs claimed, so callers can tell when
+        there is nothing left to inject.
+        """
+        session = self._new_session()
+        try:
+            start = time.time()
+            jobs = self.get_jobs_to_inject(session, limit)
+            metrics.DB_QUERY.observe(time.time() - start)
+            if not jobs:
+                logger.info("no job found")
+                session.rollback()
+                return 0
+
+            claimed = len(jobs)
+            start = time.time()
+            docs = self.update_jobs_time(session, jobs)
+            metrics.DB_QUERY.observe(time.time() - start)
+            if docs is None:
+                logger.info("no job found after update time")
+                return 0
+        finally:
             session.close()
-            return
 
-        logger.info("[cronq_job_id:{0}] Job published".format(job.id))
+        if docs:
+            self._publish_jobs(docs)
 
-        session.close()
-        return True
+        return claimed
 
     def event_models_to_docs(self, events):
         for event in events:
@@ -412,11 +1126,13 @@ class Storage(object):
                 'job_id': event.job_id,
                 'status': self.get_status(event.type, event.return_code),
             }
+            for field in Event.RESOURCE_FIELDS:
+                doc[field] = getattr(event, field)
             yield doc
 
     def get_status(self, _type, return_code=None):
-        if _type == self.SUCCEEDED:
-            return self.SUCCEEDED
+        if _type in (self.SUCCEEDED, self.TIMED_OUT, self.SKIPPED):
+            return _type
         elif return_code is None:
             return _type
         elif _type == self.FINISHED:
@@ -427,28 +1143,29 @@ class Storage(object):
 
 
     @staticmethod
-    def _add_log_urls(chunks, log_url_template):
-        for run_id, run_data in chunks.items():
-            log_url = log_url_template \
-                .replace('{job_id}', str(run_data['job_id'])) \
-                .replace('{run_id}', str(run_id))
-
-            if any([time_field in log_url_template for time_field in ('{start_time}', '{end_time}')]):
-                if run_data.get('first'):
-                    start_time = urllib.quote(run_data['first']['datetime'].strftime('%Y-%m-%dT%H:%M:%S.000Z'))
-                else:
-                    # default to now minus 24hrs if field is missing. this generally means bad data
-                    logger.warning("No start time found for {0}, using 24 hours ago for log url".format(run_id))
-                    one_day_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=24)
-                    start_time = urllib.quote(one_day_ago.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
-
-                if run_data.get('last'):
-                    end_time = urllib.quote(run_data['last']['datetime'].strftime('%Y-%m-%dT%H:%M:%S.999Z'))
-                else:
-                    # default to just slightly in the future if not present. probably means still running
-                    few_seconds_in_future = datetime.datetime.utcnow() + datetime.timedelta(seconds=5)
-                    end_time = urllib.quote(few_seconds_in_future.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
-                log_url = log_url.replace('{start_time}', start_time)
-                log_url = log_url.replace('{end_time}', end_time)
-
-            run_data['log_url'] = log_url
+    def _log_url(run, log_url_template):
+        log_url = log_url_template \
+            .replace('{job_id}', str(run['job_id'])) \
+            .replace('{run_id}', str(run['id']))
+
+        if any([time_field in log_url_template for time_field in ('{start_time}', '{end_time}')]):
+            # runs that never started, such as skipped ones, have a result time
+            started_at = run.get('started_at') or run.get('created_at')
+            if started_at:
+                start_time = urllib.quote(started_at.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+            else:
+                # default to now minus 24hrs if field is missing. this generally means bad data
+                logger.warning("No start time found for {0}, using 24 hours ago for log url".format(run['id']))
+                one_day_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=24)
+                start_time = urllib.quote(one_day_ago.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+
+            if run.get('completed_at'):
+                end_time = urllib.quote(run['completed_at'].strftime('%Y-%m-%dT%H:%M:%S.999Z'))
+            else:
+                # default to just slightly in the future if not present. probably means still running
+                few_seconds_in_future = datetime.datetime.utcnow() + datetime.timedelta(seconds=5)
+                end_time = urllib.quote(few_seconds_in_future.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+            log_url = log_url.replace('{start_time}', start_time)
+            log_url = log_url.replace('{end_time}', end_time)
+
+        return log_url
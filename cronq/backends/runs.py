@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""Maintain the `runs` table from run results
+
+Each run has one row, built from its `starting` result and its final
+result. Results may arrive in any order and more than once, and folding
+them into the row gives the same outcome either way, so the aggregator
+and the backfill from `events` can both write it.
+"""
+import logging
+
+from cronq.models.event import Event
+from cronq.models.run import Run
+
+from sqlalchemy import bindparam
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+# events read at a time when backfilling runs
+BACKFILL_BATCH_SIZE = 5000
+# run ids looked up per query
+LOOKUP_BATCH_SIZE = 500
+# attempts at a backfill batch that raced the aggregator inserting a run
+BACKFILL_ATTEMPTS = 3
+
+STARTS = ('started', 'starting')
+
+COLUMNS = [column.name for column in Run.__table__.columns]
+
+_UPDATE = None
+
+
+def _update_statement():
+    global _UPDATE
+    if _UPDATE is None:
+        table = Run.__table__
+        # the other columns are set from the parameters of the same name
+        _UPDATE = table.update().where(table.c.id == bindparam('run_id'))
+    return _UPDATE
+
+
+def new_run(run_id, job_id):
+    run = dict.fromkeys(COLUMNS)
+    run.update({'id': run_id, 'job_id': job_id})
+    return run
+
+
+def run_status(type, return_code=None):
+    if type == 'finished' and return_code is not None:
+        return 'succeeded' if int(return_code) == 0 else 'failed'
+    return type
+
+
+def apply_result(run, result):
+    """Fold a result, a dict like those of `Storage.add_results`, into `run`"""
+    at = result['_datetime']
+    if run['created_at'] is None or at < run['created_at']:
+        run['created_at'] = at
+    if run['host'] is None:
+        run['host'] = result.get('host')
+
+    if result['type'] in STARTS:
+        if run['started_at'] is None or at < run['started_at']:
+            run['started_at'] = at
+        # a start never overrides how the run ended
+        if run['completed_at'] is None:
+            run['status'] = result['type']
+    else:
+        run['completed_at'] = at
+        run['return_code'] = result.get('return_code')
+        run['status'] = run_status(result['type'], result.get('return_code'))
+        resources = result.get('resources') or {}
+        for field in Event.RESOURCE_FIELDS:
+            if resources.get(field) is not None:
+                run[field] = resources[field]
+
+    if run['started_at'] is not None and run['completed_at'] is not None:
+        run['duration'] = (run['completed_at'] - run['started_at']).total_seconds()
+    return run
+
+
+def upsert_runs(connection, results):
+    """Insert or update the runs of `results`, without committing
+
+    Existing rows are read first and the new ones inserted, so a run
+    inserted by someone else meanwhile raises IntegrityError, and the
+    caller retries.
+    """
+    table = Run.__table__
+    results = [result for result in results if result.get('run_id')]
+    run_ids = sorted(set(result['run_id'] for result in results))
+
+    existing = {}
+    for start in xrange(0, len(run_ids), LOOKUP_BATCH_SIZE):
+        query = select([table]).where(
+            table.c.id.in_(run_ids[start:start + LOOKUP_BATCH_SIZE]))
+        for row in connection.execute(query):
+            existing[row['id']] = dict(row.items())
+
+    runs = {}
+    for result in results:
+        run_id = result['run_id']
+        if run_id not in runs:
+            run = existing.get(run_id)
+            runs[run_id] = dict(run) if run else new_run(run_id, result['job_id'])
+        apply_result(runs[run_id], result)
+
+    inserts = []
+    updates = []
+    for run_id in run_ids:
+        run = runs[run_id]
+        if run_id not in existing:
+            inserts.append(run)
+        elif run != existing[run_id]:
+            params = dict((name, value) for name, value in run.items() if name != 'id')
+            params['run_id'] = run_id
+            updates.append(params)
+
+    if inserts:
+        connection.execute(table.insert(), inserts)
+    if updates:
+        connection.execute(_update_statement(), updates)
+    return len(inserts), len(updates)
+
+
+def _event_result(row):
+    return {
+        'job_id': row['job_id'],
+        '_datetime': row['datetime'],
+        'run_id': row['run_id'],
+        'type': row['type'],
+        'host': row['host'],
+        'return_code': row['return_code'],
+        'resources': dict((field, row[field]) for field in Event.RESOURCE_FIELDS),
+    }
+
+
+def backfill(engine, batch_size=BACKFILL_BATCH_SIZE):
+    """Build the runs of every stored event, oldest first"""
+    events = Event.__table__
+    last_id = 0
+    while True:
+        rows = engine.execute(
+            select([events]).
+            where(events.c.id > last_id).
+            order_by(events.c.id).
+            limit(batch_size)).fetchall()
+        if not rows:
+            return
+
+        # events of removed jobs no longer belong to one
+        results = [_event_result(row) for row in rows
+                   if row['job_id'] is not None and row['run_id']]
+        for attempt in xrange(BACKFILL_ATTEMPTS):
+            try:
+                with engine.begin() as connection:
+                    upsert_runs(connection, results)
+                break
+            except IntegrityError:
+                if attempt + 1 == BACKFILL_ATTEMPTS:
+                    raise
+                logger.info('Runs changed while backfilling, retrying')
+
+        last_id = rows[-1]['id']
+        logger.info('Backfilled runs up to event {0}'.format(last_id))
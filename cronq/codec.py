@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""Wire format of job messages and run results
+
+Both kinds of message have a fixed set of fields, and timestamps are
+seconds since the epoch, UTC. Three encodings are understood, told apart
+by the AMQP `content_type` property:
+
+- `legacy`: the original json documents, with `str(datetime)` timestamps
+  and the `x-send-datetime` and `x-host` result fields
+- `json`: a json document with a `v` version field and epoch timestamps
+- `binary`: a version byte, a kind byte and a bitmap of the fields
+  present, followed by those fields packed with `struct`, with content
+  type CONTENT_TYPE_BINARY
+
+Messages are encoded as Config.WIRE_FORMAT says, while every encoding is
+always decoded, so consumers can be upgraded before producers switch.
+Decoding returns a dict of the fields present, with epoch timestamps.
+"""
+import calendar
+import datetime
+import json
+import struct
+
+from cronq.config import Config
+from dateutil.parser import parse
+
+VERSION = 1
+
+CONTENT_TYPE_JSON = 'application/json'
+CONTENT_TYPE_BINARY = 'application/x-cronq-binary'
+
+FORMATS = ('legacy', 'json', 'binary')
+
+# (field, type) in wire order, new fields are only ever appended
+JOB_FIELDS = (
+    ('job_id', 'int'),
+    ('run_id', 'str'),
+    ('cmd', 'str'),
+    ('name', 'str'),
+    ('timeout', 'int'),
+    ('overlap', 'str'),
+)
+
+RESULT_FIELDS = (
+    ('job_id', 'int'),
+    ('run_id', 'str'),
+    ('type', 'str'),
+    ('sent_at', 'time'),
+    ('host', 'str'),
+    ('start_time', 'time'),
+    ('return_code', 'int'),
+    ('run_time', 'float'),
+    ('cpu_user', 'float'),
+    ('cpu_system', 'float'),
+    ('max_rss', 'int'),
+    ('block_in', 'int'),
+    ('block_out', 'int'),
+    ('ctx_voluntary', 'int'),
+    ('ctx_involuntary', 'int'),
+)
+
+SCHEMAS = {
+    'job': (1, JOB_FIELDS),
+    'result': (2, RESULT_FIELDS),
+}
+
+_HEADER = struct.Struct('>BBI')
+_PACKERS = {
+    'int': struct.Struct('>q'),
+    'float': struct.Struct('>d'),
+    'time': struct.Struct('>d'),
+    'str': struct.Struct('>I'),
+}
+
+# legacy result fields named differently
+_LEGACY_NAMES = {
+    'sent_at': 'x-send-datetime',
+    'host': 'x-host',
+}
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def to_epoch(value):
+    """Seconds since the epoch for a naive UTC datetime"""
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+def to_datetime(value):
+    """Naive UTC datetime for seconds since the epoch"""
+    return datetime.datetime.utcfromtimestamp(value)
+
+
+def parse_datetime(text):
+    """Epoch seconds for a legacy `str(datetime)` timestamp"""
+    for pattern in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return to_epoch(datetime.datetime.strptime(text, pattern))
+        except ValueError:
+            pass
+    # anything else that was ever sent
+    return to_epoch(parse(text))
+
+
+def encode(kind, doc, wire_format=None):
+    """Encode the fields of `doc`, returns (body, message properties)"""
+    wire_format = wire_format or Config.WIRE_FORMAT
+    if wire_format == 'binary':
+        return _encode_binary(kind, doc), {'content_type': CONTENT_TYPE_BINARY}
+    if wire_format == 'json':
+        message = _known_fields(kind, doc)
+        message['v'] = VERSION
+        return json.dumps(message, separators=(',', ':')), {'content_type': CONTENT_TYPE_JSON}
+    if wire_format == 'legacy':
+        return json.dumps(_to_legacy(kind, doc)), {}
+    raise ValueError('Unknown wire format {0}, expected one of {1}'.format(
+        wire_format, ', '.join(FORMATS)))
+
+
+def decode(kind, body, content_type=None):
+    """Fields of a `kind` message in any encoding, see the module docstring"""
+    body = str(body)
+    if content_type == CONTENT_TYPE_BINARY:
+        return _decode_binary(kind, body)
+
+    try:
+        doc = json.loads(body)
+    except ValueError, e:
+        raise DecodeError('Invalid json message: {0}'.format(e))
+    if not isinstance(doc, dict):
+        raise DecodeError('Expected a json object, got {0}'.format(type(doc).__name__))
+    if 'v' in doc:
+        if doc['v'] > VERSION:
+            raise DecodeError('Unsupported message version {0}'.format(doc['v']))
+        return _known_fields(kind, doc)
+    return _from_legacy(kind, doc)
+
+
+def encode_job(doc, wire_format=None):
+    return encode('job', doc, wire_format)
+
+
+def decode_job(body, content_type=None):
+    return decode('job', body, content_type)
+
+
+def encode_result(doc, wire_format=None):
+    return encode('result', doc, wire_format)
+
+
+def decode_result(body, content_type=None):
+    return decode('result', body, content_type)
+
+
+def _known_fields(kind, doc):
+    return dict((name, doc[name]) for name, _ in SCHEMAS[kind][1]
+                if doc.get(name) is not None)
+
+
+def _to_legacy(kind, doc):
+    legacy = {}
+    for name, field_type in SCHEMAS[kind][1]:
+        value = doc.get(name)
+        if value is None:
+            continue
+        if field_type == 'time':
+            value = str(to_datetime(value))
+        legacy[_LEGACY_NAMES.get(name, name) if kind == 'result' else name] = value
+    return legacy
+
+
+def _from_legacy(kind, doc):
+    fields = {}
+    for name, field_type in SCHEMAS[kind][1]:
+        if kind == 'result':
+            value = doc.get(_LEGACY_NAMES.get(name, name))
+        else:
+            value = doc.get(name)
+        if value is None:
+            continue
+        if field_type == 'time':
+            value = parse_datetime(value)
+        fields[name] = value
+    return fields
+
+
+def _encode_binary(kind, doc):
+    kind_id, schema = SCHEMAS[kind]
+    present = 0
+    parts = []
+    for bit, (name, field_type) in enumerate(schema):
+        value = doc.get(name)
+        if value is None:
+            continue
+        present |= 1 << bit
+        if field_type == 'str':
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            else:
+                value = str(value)
+            parts.append(_PACKERS['str'].pack(len(value)))
+            parts.append(value)
+        elif field_type == 'int':
+            parts.append(_PACKERS['int'].pack(int(value)))
+        else:
+            parts.append(_PACKERS[field_type].pack(float(value)))
+    return _HEADER.pack(VERSION, kind_id, present) + ''.join(parts)
+
+
+def _decode_binary(kind, body):
+    kind_id, schema = SCHEMAS[kind]
+    try:
+        version, body_kind, present = _HEADER.unpack_from(body)
+    except struct.error:
+        raise DecodeError('Truncated binary message')
+    if version > VERSION:
+        raise DecodeError('Unsupported message version {0}'.format(version))
+    if body_kind != kind_id:
+        raise DecodeError('Expected a {0} message, got kind {1}'.format(kind, body_kind))
+
+    fields = {}
+    offset = _HEADER.size
+    try:
+        for bit, (name, field_type) in enumerate(schema):
+            if not present & (1 << bit):
+                continue
+            packer = _PACKERS[field_type]
+            value, = packer.unpack_from(body, offset)
+            offset += packer.size
+            if field_type == 'str':
+                if offset + value > len(body):
+                    raise struct.error()
+                value, offset = body[offset:offset + value].decode('utf-8'), offset + value
+            fields[name] = value
+    except struct.error:
+        raise DecodeError('Truncated binary message')
+    return fields
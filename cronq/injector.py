@@ -1,27 +1,325 @@
 # -*- coding: utf-8 -*-
+import datetime
+import heapq
 import logging
+import os
+import socket
 import time
 
+from cronq.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class ShardCoordinator(object):
+
+    """Splits the jobs between live injectors using time-bounded leases
+
+    Jobs are spread over `num_shards` shards by id. Every injector records
+    a heartbeat, renews the leases it holds and, based on its position
+    among the live injectors, claims or releases shards until it holds its
+    share. Leases of an injector that stops renewing expire after `ttl`
+    seconds and are picked up by the remaining injectors.
+    """
+
+    def __init__(self, storage, num_shards, ttl, name=None):
+        if name is None:
+            name = '{0}.{1}'.format(socket.gethostname(), os.getpid())
+        self.storage = storage
+        self.num_shards = num_shards
+        self.ttl = ttl
+        self.name = name
+        self._shards = []
+        self._renewed_at = None
+
+    def share(self, live):
+        """Returns how many shards this injector should hold"""
+        if self.name not in live:
+            return 0
+        position = live.index(self.name)
+        share, remainder = divmod(self.num_shards, len(live))
+        if position < remainder:
+            share += 1
+        return share
+
+    def rebalance(self):
+        live = self.storage.heartbeat_injector(self.name, self.ttl)
+        shards = self.storage.renew_shard_leases(self.name, self.ttl, self.num_shards)
+        if live is None or shards is None:
+            return
+
+        share = self.share(live)
+        if len(shards) > share:
+            released = shards[share:]
+            self.storage.release_shard_leases(self.name, released)
+            shards = shards[:share]
+            logger.info('Released shards {0}'.format(released))
+        elif len(shards) < share:
+            for shard in self.storage.free_shards(self.num_shards):
+                if len(shards) >= share:
+                    break
+                if self.storage.claim_shard_lease(shard, self.name, self.ttl):
+                    logger.info('Claimed shard {0}'.format(shard))
+                    shards.append(shard)
+
+        self._shards = sorted(shards)
+        self._renewed_at = time.time()
+
+    def shards(self):
+        """Returns the shards currently held, renewing leases when needed"""
+        if self._renewed_at is None:
+            self.storage.ensure_shard_leases(self.num_shards)
+        if self._renewed_at is None or time.time() - self._renewed_at > self.ttl / 3.0:
+            self.rebalance()
+        if self._renewed_at is None or time.time() - self._renewed_at > self.ttl:
+            # leases could not be renewed and have expired
+            return []
+        return self._shards
+
+    def release(self):
+        self.storage.release_shard_leases(self.name, self._shards)
+        self._shards = []
+
 
 class Injector(object):
 
-    def __init__(self, storage):
+    def __init__(self, storage, batch_size=None, coordinator=None,
+                 control=None, pacer=None):
         self.storage = storage
+        self.batch_size = batch_size
+        self.coordinator = coordinator
+        self.control = control
+        self.pacer = pacer
+        self._shards = None
         storage.bootstrap()
 
+    def wait(self, timeout):
+        """Sleep for `timeout` seconds
+
+        Control messages are handled and paced jobs are released while
+        waiting.
+        """
+        deadline = time.time() + timeout
+        while True:
+            if self.pacer is not None:
+                self.pacer.flush()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            if self.pacer is not None:
+                release = self.pacer.next_release()
+                if release is not None:
+                    remaining = min(remaining, max(release, 0.001))
+            if self.control is None:
+                time.sleep(remaining)
+            else:
+                self.control.poll(remaining)
+
+    def stop(self):
+        if self.pacer is not None:
+            self.pacer.flush(force=True)
+            self.requeue_unpublished()
+        if self.coordinator is not None:
+            self.coordinator.release()
+
+    def requeue_unpublished(self):
+        """Flag jobs the pacer could not publish to run now
+
+        Their next run was already advanced, so the flag is what makes the
+        next injector publish them instead of skipping the run.
+        """
+        job_ids = sorted(set(job['id'] for _, job, _ in self.pacer.take_pending()))
+        for job_id in job_ids:
+            logger.warning('[cronq_job_id:{0}] Unpublished at shutdown, flagging it to run now'.format(job_id))
+            try:
+                self.storage.run_job_now(job_id)
+            except Exception:
+                logger.exception('[cronq_job_id:{0}] Unable to flag job to run now'.format(job_id))
+
+    def handle_control(self, message):
+        if message.get('type') == 'run_now':
+            logger.info('[cronq_job_id:{0}] Run now requested'.format(message.get('job_id')))
+            self.storage.inject_job_now(message['job_id'])
+        else:
+            logger.warning('Unknown control message: {0}'.format(message))
+
+    def update_shards(self):
+        """Point storage at the shards held, returns True if they changed"""
+        if self.coordinator is None:
+            return False
+        shards = list(self.coordinator.shards())
+        if shards == self._shards:
+            return False
+        logger.info('Injecting shards {0}'.format(shards))
+        self._shards = shards
+        self.storage.use_shards(self.coordinator.num_shards, shards)
+        return True
+
     def run(self):
+        try:
+            while True:
+                self.update_shards()
+                self.storage.inject(batch_size=self.batch_size)
+                self.wait(1)
+        finally:
+            self.stop()
+
+
+class Scheduler(Injector):
+
+    """Injector that sleeps until the next job is due instead of polling
+
+    The next run of every job is kept in a heap loaded once at startup.
+    Storage is only asked to inject when the earliest deadline passes, and
+    edits made elsewhere are picked up by comparing the jobs table
+    watermark every `refresh_interval` seconds and reloading only the rows
+    that changed.
+    """
+
+    # rows written by hosts with slightly lagging clocks are still reloaded
+    WATERMARK_SLACK = datetime.timedelta(seconds=5)
+
+    def __init__(self, storage, batch_size=None, coordinator=None,
+                 control=None, pacer=None, refresh_interval=1.0):
+        super(Scheduler, self).__init__(storage,
+                                        batch_size=batch_size,
+                                        coordinator=coordinator,
+                                        control=control,
+                                        pacer=pacer)
+        self.refresh_interval = refresh_interval
+        self._heap = []
+        self._deadlines = {}
+        self._watermark = None
+
+    def load(self):
+        """Load the schedule of every job"""
+        self._watermark = self.storage.job_watermark()
+        self._heap = []
+        self._deadlines = {}
+        self._schedule(self.storage.job_schedule())
+        logger.info('Loaded schedule for {0} jobs'.format(len(self._deadlines)))
+
+    def refresh(self):
+        """Reload the jobs changed since the last load or refresh"""
+        watermark = self.storage.job_watermark()
+        if watermark == self._watermark:
+            return
+
+        count, updated_at = watermark
+        if count != len(self._deadlines) or updated_at is None:
+            # jobs were removed, rebuild the whole schedule
+            self.load()
+            return
+
+        since = self._watermark[1]
+        if since is not None:
+            since = since - self.WATERMARK_SLACK
+        self._watermark = watermark
+        self._schedule(self.storage.job_schedule(updated_since=since))
+
+    def _schedule(self, rows):
+        for job_id, next_run, run_now in rows:
+            deadline = next_run
+            if run_now or deadline is None:
+                deadline = datetime.datetime.min
+            if self._deadlines.get(job_id) == deadline:
+                continue
+            self._deadlines[job_id] = deadline
+            heapq.heappush(self._heap, (deadline, job_id))
+
+        if len(self._heap) > 2 * len(self._deadlines) + 1024:
+            self._heap = [(d, i) for i, d in self._deadlines.iteritems()]
+            heapq.heapify(self._heap)
+
+    def next_deadline(self):
+        """Returns the earliest time a job is due, or None"""
+        while self._heap:
+            deadline, job_id = self._heap[0]
+            if self._deadlines.get(job_id) == deadline:
+                return deadline
+            # superseded by a newer entry for the same job
+            heapq.heappop(self._heap)
+        return None
+
+    def run(self):
+        try:
+            self._run()
+        finally:
+            self.stop()
+
+    def _run(self):
+        self.update_shards()
+        self.load()
+        last_refresh = time.time()
         while True:
-            self.storage.inject()
-            time.sleep(1)
+            if self.update_shards():
+                self.load()
+            deadline = self.next_deadline()
+            now = datetime.datetime.utcnow()
+            if deadline is not None and deadline <= now:
+                claimed = self.storage.inject(batch_size=self.batch_size)
+                self.refresh()
+                last_refresh = time.time()
+                if not claimed:
+                    # due according to the heap but nothing could be
+                    # claimed, so do not spin against the database
+                    self.wait(self.refresh_interval)
+                continue
+
+            timeout = self.refresh_interval - (time.time() - last_refresh)
+            if deadline is not None:
+                timeout = min(timeout, (deadline - now).total_seconds())
+            if timeout > 0:
+                self.wait(timeout)
+
+            if time.time() - last_refresh >= self.refresh_interval:
+                self.refresh()
+                last_refresh = time.time()
 
 
 def main():
+    from cronq import metrics
     from cronq.backends.mysql import Storage
+    from cronq.pacing import PacedPublisher
+    from cronq.pacing import parse_rate_limits
     from cronq.queue_connection import Publisher
+    from cronq.rabbit_connection import ControlConsumer
+
+    if Config.METRICS_PORT:
+        metrics.start_http_server(Config.METRICS_PORT, Config.LISTEN_INTERFACE)
+    if Config.STATSD_HOST:
+        metrics.configure_statsd(Config.STATSD_HOST, Config.STATSD_PREFIX)
 
-    logger = logging.getLogger('cronq.injector')
     logger.info('Creating injector')
-    injector = Injector(Storage(Publisher()))
+    publisher = Publisher()
+    pacer = None
+    if Config.INJECTOR_JITTER_WINDOW or Config.INJECTOR_RATE_LIMITS:
+        pacer = PacedPublisher(
+            publisher,
+            jitter_window=Config.INJECTOR_JITTER_WINDOW,
+            rate_limits=parse_rate_limits(Config.INJECTOR_RATE_LIMITS))
+        publisher = pacer
+    storage = Storage(publisher)
+    coordinator = None
+    if Config.INJECTOR_SHARDS > 0:
+        coordinator = ShardCoordinator(storage,
+                                       Config.INJECTOR_SHARDS,
+                                       Config.INJECTOR_LEASE_TTL)
+    if Config.INJECTOR_MODE == 'scheduler':
+        injector = Scheduler(storage,
+                             batch_size=Config.INJECTOR_BATCH_SIZE,
+                             coordinator=coordinator,
+                             pacer=pacer,
+                             refresh_interval=Config.INJECTOR_REFRESH_INTERVAL)
+    else:
+        injector = Injector(storage,
+                            batch_size=Config.INJECTOR_BATCH_SIZE,
+                            coordinator=coordinator,
+                            pacer=pacer)
+
+    if Config.CONTROL_QUEUE:
+        injector.control = ControlConsumer(Config.CONTROL_QUEUE,
+                                           injector.handle_control)
 
     logger.info('Running injector')
     injector.run()
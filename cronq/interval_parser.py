@@ -1,24 +1,274 @@
 # -*- coding: utf-8 -*-
+import bisect
 import datetime
 
 import aniso8601
+from dateutil.relativedelta import relativedelta
+
+MICROSECOND = datetime.timedelta(microseconds=1)
+SCHEDULE_CACHE_SIZE = 10000
+
+_schedule_cache = {}
 
 
 def next_run_and_duration_from_8601(interval):
-    gen = aniso8601.parse_repeating_interval(interval)
-    start = next(gen)
-    second = next(gen)
-    duration = second - start
-    now = datetime.datetime.utcnow()
-    diff_from_now = now - start
-    number_of_iterations = number_of_iterations_in_time(
-        duration,
-        diff_from_now)
-    next_run = apply_delta_to_datetime(
-        duration,
-        start,
-        number_of_iterations + 1)
-    return next_run, duration
+    schedule = compile_schedule(interval)
+    return schedule.next_after(datetime.datetime.utcnow()), schedule.interval
+
+
+def compile_schedule(text):
+    """Parse `text` into a schedule object, reusing earlier compilations
+
+    Accepts ISO 8601 repeating intervals such as ``R/2013-05-29T00:00:00/PT1M``
+    and five field cron expressions such as ``*/5 * * * 1-5`` or ``@daily``.
+    Raises ValueError if `text` is neither.
+    """
+    text = text.strip()
+    schedule = _schedule_cache.get(text)
+    if schedule is None:
+        if text.startswith('R'):
+            schedule = _compile_8601(text)
+        else:
+            schedule = CronSchedule(text)
+        if len(_schedule_cache) >= SCHEDULE_CACHE_SIZE:
+            _schedule_cache.clear()
+        _schedule_cache[text] = schedule
+    return schedule
+
+
+def next_runs(texts, after):
+    """Return the first run after `after` for every schedule in `texts`
+
+    Jobs in a category mostly share a handful of schedules, so each
+    distinct schedule is compiled and evaluated once for the whole list.
+    """
+    results = {}
+    for text in texts:
+        if text not in results:
+            results[text] = compile_schedule(text).next_after(after)
+    return [results[text] for text in texts]
+
+
+def _naive_utc(dt):
+    if dt.tzinfo is None:
+        return dt
+    return (dt - dt.utcoffset()).replace(tzinfo=None)
+
+
+def _compile_8601(text):
+    try:
+        repeat, start, duration = text.split('/')
+        start = _naive_utc(aniso8601.parse_datetime(start))
+        duration = aniso8601.parse_duration(duration, relative=True)
+    except Exception, e:
+        raise ValueError('Invalid ISO 8601 schedule {0!r}: {1}'.format(text, e))
+    if repeat[1:]:
+        raise ValueError('Bounded repeats are not supported: {0!r}'.format(text))
+
+    if duration.years or duration.months:
+        return CalendarSchedule(start, duration)
+    delta = (start + duration) - start
+    if delta <= datetime.timedelta(0):
+        raise ValueError('Schedule must move forward: {0!r}'.format(text))
+    return IntervalSchedule(start, delta)
+
+
+class Schedule(object):
+
+    """A compiled schedule
+
+    `next_after(t)` returns the first run strictly after `t` and `interval`
+    is the typical time between runs.
+    """
+
+    interval = None
+
+    def next_after(self, t):
+        raise NotImplementedError
+
+    def advance(self, next_run, now, limit=None):
+        """Same as `advance_next_run`, but follows this schedule
+
+        Counting stops after `limit` due runs, in which case the next run
+        is the first one not before `now`.
+        """
+        if next_run >= now:
+            return next_run, 0
+
+        due = 0
+        while next_run < now and (limit is None or due < limit):
+            next_run = self.next_after(next_run)
+            due += 1
+        if next_run < now:
+            next_run = self.next_after(now - MICROSECOND)
+        return next_run, due
+
+
+class IntervalSchedule(Schedule):
+
+    """Fixed length repeats, such as ``PT5M`` or ``P1D``"""
+
+    def __init__(self, start, interval):
+        self.start = start
+        self.interval = interval
+        self._step = timedelta_to_microseconds(interval)
+
+    def next_after(self, t):
+        if t < self.start:
+            return self.start
+        elapsed = timedelta_to_microseconds(t - self.start)
+        return self.start + self.interval * (elapsed // self._step + 1)
+
+    def advance(self, next_run, now, limit=None):
+        return advance_next_run(next_run, self.interval, now)
+
+
+class CalendarSchedule(Schedule):
+
+    """Repeats of months or years, such as ``P1M``
+
+    Every run is computed from the start, so a schedule starting on the
+    31st runs on the last day of shorter months without drifting.
+    """
+
+    def __init__(self, start, duration):
+        self.start = start
+        self.duration = duration
+        months = duration.years * 12 + duration.months
+        rest = (start + relativedelta(days=duration.days,
+                                      hours=duration.hours,
+                                      minutes=duration.minutes,
+                                      seconds=duration.seconds)) - start
+        self.interval = datetime.timedelta(days=months * 365.2425 / 12) + rest
+
+    def _run(self, k):
+        return self.start + self.duration * k
+
+    def next_after(self, t):
+        if t < self.start:
+            return self.start
+        k = int((t - self.start).total_seconds() // self.interval.total_seconds())
+        while k > 0 and self._run(k) > t:
+            k -= 1
+        while self._run(k) <= t:
+            k += 1
+        return self._run(k)
+
+
+class CronSchedule(Schedule):
+
+    """Five field cron expressions: minute hour day-of-month month day-of-week
+
+    Fields accept ``*``, numbers, names, ``a-b`` ranges, ``/n`` steps and
+    comma separated lists. As in cron, a job whose day-of-month and
+    day-of-week are both restricted runs when either matches.
+    """
+
+    MACROS = {
+        '@yearly': '0 0 1 1 *',
+        '@annually': '0 0 1 1 *',
+        '@monthly': '0 0 1 * *',
+        '@weekly': '0 0 * * 0',
+        '@daily': '0 0 * * *',
+        '@midnight': '0 0 * * *',
+        '@hourly': '0 * * * *',
+    }
+    MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+              'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+    DAYS = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+    # look this many years ahead before deciding a schedule never fires
+    MAX_YEARS = 8
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = self.MACROS.get(expression.lower(), expression).split()
+        if len(fields) != 5:
+            raise ValueError('Invalid cron schedule {0!r}'.format(expression))
+
+        self.minutes = self._parse(fields[0], 0, 59)
+        self.hours = self._parse(fields[1], 0, 23)
+        self.days = self._parse(fields[2], 1, 31)
+        self.months = self._parse(fields[3], 1, 12, self.MONTHS, 1)
+        weekdays = self._parse(fields[4], 0, 7, self.DAYS, 0)
+        # cron counts from sunday, datetime.weekday() from monday
+        self.weekdays = frozenset((day - 1) % 7 for day in weekdays)
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+        first = self.next_after(datetime.datetime(2000, 1, 1))
+        if first is None:
+            raise ValueError('Cron schedule never runs {0!r}'.format(expression))
+        self.interval = self.next_after(first) - first
+
+    def _parse(self, field, low, high, names=None, offset=0):
+        values = set()
+        for part in field.lower().split(','):
+            value_range, slash, step = part.partition('/')
+            try:
+                step = int(step) if slash else 1
+                if value_range == '*':
+                    start, end = low, high
+                elif '-' in value_range:
+                    start, end = [self._value(value, names, offset)
+                                  for value in value_range.split('-', 1)]
+                else:
+                    start = self._value(value_range, names, offset)
+                    end = high if slash else start
+            except ValueError:
+                raise ValueError('Invalid cron field {0!r} in {1!r}'.format(
+                    field, self.expression))
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError('Cron field {0!r} out of range in {1!r}'.format(
+                    field, self.expression))
+            values.update(xrange(start, end + 1, step))
+        return sorted(values)
+
+    @staticmethod
+    def _value(value, names, offset):
+        if names and value in names:
+            return names.index(value) + offset
+        return int(value)
+
+    def _day_matches(self, dt):
+        day = dt.day in self.days
+        weekday = dt.weekday() in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    @staticmethod
+    def _first_at_or_after(values, value):
+        index = bisect.bisect_left(values, value)
+        return values[index] if index < len(values) else None
+
+    def next_after(self, t):
+        t = t.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        last_year = t.year + self.MAX_YEARS
+        while t.year <= last_year:
+            month = self._first_at_or_after(self.months, t.month)
+            if month is None:
+                t = datetime.datetime(t.year + 1, self.months[0], 1)
+                continue
+            if month != t.month:
+                t = datetime.datetime(t.year, month, 1)
+
+            if not self._day_matches(t):
+                t = datetime.datetime(t.year, t.month, t.day) + datetime.timedelta(days=1)
+                continue
+
+            hour = self._first_at_or_after(self.hours, t.hour)
+            if hour is None:
+                t = datetime.datetime(t.year, t.month, t.day) + datetime.timedelta(days=1)
+                continue
+            if hour != t.hour:
+                t = t.replace(hour=hour, minute=0)
+
+            minute = self._first_at_or_after(self.minutes, t.minute)
+            if minute is None:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+            return t.replace(minute=minute)
+        return None
 
 
 def number_of_iterations_in_time(duration, time):
@@ -30,3 +280,43 @@ def apply_delta_to_datetime(delta, dt, times):
     full_td = delta * times
     final_dt = dt + full_td
     return final_dt
+
+
+def timedelta_to_microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def advance_next_run(next_run, interval, now):
+    """Move `next_run` forward by whole intervals until it is not before `now`
+
+    Returns the new next run and the number of runs that were due, i.e. how
+    many times `interval` had to be added. This is computed directly
+    instead of stepping one interval at a time, so catching up after a long
+    outage costs the same as an on-time run.
+    """
+    if next_run >= now:
+        return next_run, 0
+
+    step = timedelta_to_microseconds(interval)
+    if step <= 0:
+        return now, 1
+
+    elapsed = timedelta_to_microseconds(now - next_run)
+    due = (elapsed + step - 1) // step
+    return next_run + interval * due, due
+
+
+def runs_for_catchup(policy, due, limit=None):
+    """Return how many of `due` runs should be published under `policy`
+
+    - ``skip``: only run when the job is on time, missed runs are dropped
+    - ``once``: run a single time no matter how many runs were missed
+    - ``replay``: run every missed run, up to `limit`
+    """
+    if due <= 0:
+        return 0
+    if policy == 'skip':
+        return 1 if due == 1 else 0
+    if policy == 'replay':
+        return min(due, max(limit or 1, 1))
+    return 1
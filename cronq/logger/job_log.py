@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Per-job output files written by the runner
+
+Output is buffered in memory and written when the buffer fills or when it
+has been held for longer than the flush interval, rather than once per
+line. Once a file reaches its maximum size it is renamed with a timestamp
+suffix and compressed with gzip by a background thread, which also prunes
+old segments and flushes buffers of jobs that have gone quiet.
+"""
+import atexit
+import datetime
+import gzip
+import logging
+import os
+import Queue
+import shutil
+import threading
+import time
+
+from cronq.config import Config
+
+logger = logging.getLogger(__name__)
+
+_rotate_lock = threading.Lock()
+
+
+def compress_segment(path, filename, backup_count):
+    """gzip the rotated segment `path` and keep `backup_count` segments of `filename`"""
+    with open(path, 'rb') as source:
+        target = gzip.open(path + '.gz', 'wb')
+        try:
+            shutil.copyfileobj(source, target)
+        finally:
+            target.close()
+    os.remove(path)
+
+    directory, name = os.path.split(filename)
+    prefix = name + '.'
+    segments = sorted(entry for entry in os.listdir(directory or '.')
+                      if entry.startswith(prefix) and entry.endswith('.gz'))
+    for segment in segments[:max(len(segments) - backup_count, 0)]:
+        os.remove(os.path.join(directory, segment))
+
+
+class _Maintenance(object):
+
+    """Background thread shared by every open job log"""
+
+    INTERVAL = 0.25
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._logs = set()
+        self._tasks = Queue.Queue()
+        self._thread = None
+        self._stopping = False
+
+    def register(self, job_log):
+        with self._lock:
+            self._logs.add(job_log)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='cronq-job-logs')
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def unregister(self, job_log):
+        with self._lock:
+            self._logs.discard(job_log)
+
+    def compress(self, path, filename, backup_count):
+        self._tasks.put((path, filename, backup_count))
+
+    def stop(self):
+        """Stop the thread before the interpreter tears down modules"""
+        self._stopping = True
+        self._thread.join(self.INTERVAL * 4)
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                task = self._tasks.get(timeout=self.INTERVAL)
+            except Queue.Empty:
+                pass
+            else:
+                try:
+                    compress_segment(*task)
+                except (IOError, OSError):
+                    logger.exception('Unable to compress {0}'.format(task[0]))
+
+            with self._lock:
+                logs = list(self._logs)
+            for job_log in logs:
+                try:
+                    job_log.flush(stale_only=True)
+                except (IOError, OSError):
+                    logger.exception('Unable to flush {0}'.format(job_log.filename))
+
+
+_maintenance = _Maintenance()
+
+
+class JobLog(object):
+
+    """Buffered, rotating writer for the output of a job
+
+    Several runs of the same job may write to one file at once. Each
+    writer notices when another one rotated the file and reopens it.
+    """
+
+    def __init__(self,
+                 filename,
+                 buffer_size=None,
+                 flush_interval=None,
+                 max_bytes=None,
+                 backup_count=None):
+        self.filename = filename
+        self.buffer_size = Config.RUNNER_LOG_BUFFER_SIZE if buffer_size is None else buffer_size
+        self.flush_interval = Config.RUNNER_LOG_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.max_bytes = Config.RUNNER_LOG_MAX_BYTES if max_bytes is None else max_bytes
+        self.backup_count = Config.RUNNER_LOG_BACKUP_COUNT if backup_count is None else backup_count
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.time()
+        self._stream = None
+        _maintenance.register(self)
+
+    def write(self, message):
+        data = message.encode('utf-8') + '\n'
+        with self._lock:
+            self._buffer.append(data)
+            self._buffered += len(data)
+            if (self._buffered >= self.buffer_size or
+                    time.time() - self._last_flush >= self.flush_interval):
+                self._flush()
+
+    def flush(self, stale_only=False):
+        with self._lock:
+            if stale_only and time.time() - self._last_flush < self.flush_interval:
+                return
+            self._flush()
+
+    def close(self):
+        _maintenance.unregister(self)
+        with self._lock:
+            self._flush()
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+
+    def _open(self):
+        if self._stream is not None:
+            try:
+                moved = os.stat(self.filename).st_ino != os.fstat(self._stream.fileno()).st_ino
+            except OSError:
+                moved = True
+            if not moved:
+                return
+            self._stream.close()
+        self._stream = open(self.filename, 'ab')
+
+    def _flush(self):
+        self._last_flush = time.time()
+        if not self._buffer:
+            return
+        self._open()
+        self._stream.write(''.join(self._buffer))
+        self._stream.flush()
+        self._buffer = []
+        self._buffered = 0
+        if self.max_bytes and self._stream.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        with _rotate_lock:
+            try:
+                size = os.stat(self.filename).st_size
+            except OSError:
+                size = 0
+            # another writer may have rotated it already
+            if size >= self.max_bytes:
+                rotated = '{0}.{1}'.format(
+                    self.filename,
+                    datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f'))
+                os.rename(self.filename, rotated)
+                _maintenance.compress(rotated, self.filename, self.backup_count)
+        self._stream.close()
+        self._stream = None
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Batches the output of a running job into chunks for live tailing
+
+Lines are grouped into chunks of up to `chunk_size` bytes, and a partial
+chunk is sent once it is `interval` seconds old. Chunks that have been
+handed to `send` count against `max_buffer` until `sent` is called for
+them, so a connection that cannot keep up makes the stream drop lines
+instead of holding an unbounded backlog. The next chunk reports how many
+lines were dropped.
+"""
+import threading
+import time
+
+
+class LogStream(object):
+
+    def __init__(self, send, chunk_size, interval, max_buffer, clock=time.time):
+        """`send(chunk, size)` is called with each chunk to publish, and
+        the caller reports it published or discarded with `sent(size)`"""
+        self.send = send
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.max_buffer = max_buffer
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._lines = []
+        self._buffered = 0
+        self._in_flight = 0
+        self._dropped = 0
+        self._seq = 0
+        self._started = None
+
+    def write(self, line):
+        size = len(line) + 1
+        with self._lock:
+            if self._buffered + self._in_flight + size > self.max_buffer:
+                self._dropped += 1
+                return
+            if self._started is None:
+                self._started = self.clock()
+            self._lines.append(line)
+            self._buffered += size
+            chunk = self._take_if_due()
+        self._send(chunk)
+
+    def flush_if_due(self):
+        with self._lock:
+            chunk = self._take_if_due()
+        self._send(chunk)
+
+    def close(self):
+        """Send what is left as the final chunk of the stream"""
+        with self._lock:
+            chunk = self._take(final=True)
+        self._send(chunk)
+
+    def sent(self, size):
+        with self._lock:
+            self._in_flight -= size
+
+    def _take_if_due(self):
+        if not self._lines:
+            return None
+        if (self._buffered >= self.chunk_size or
+                self.clock() - self._started >= self.interval):
+            return self._take()
+        return None
+
+    def _take(self, final=False):
+        chunk = {
+            'seq': self._seq,
+            'output': u'\n'.join(self._lines),
+            'dropped': self._dropped,
+            'final': final,
+        }
+        size = self._buffered
+        self._seq += 1
+        self._lines = []
+        self._buffered = 0
+        self._dropped = 0
+        self._started = None
+        self._in_flight += size
+        return chunk, size
+
+    def _send(self, chunk):
+        if chunk is not None:
+            self.send(*chunk)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""In-process histograms for the injector
+
+Histograms are kept in memory and can be read in two ways, neither of
+which needs anything beyond the injector itself:
+
+- pulled over HTTP in the Prometheus text format, see `start_http_server`
+- pushed as statsd packets over UDP as they are observed, see
+  `configure_statsd`
+"""
+import BaseHTTPServer
+import logging
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+COUNT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class Histogram(object):
+
+    def __init__(self, name, description, buckets=SECONDS_BUCKETS, registry=None):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.registry = registry
+        self._lock = threading.Lock()
+        self._counts = [0] * len(self.buckets)
+        self._count = 0
+        self._sum = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self._count += 1
+            self._sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+        if self.registry is not None and self.registry.statsd is not None:
+            self.registry.statsd.send(self.name, value, self.name.endswith('_seconds'))
+
+    def snapshot(self):
+        """Returns (cumulative bucket counts, count, sum)"""
+        with self._lock:
+            cumulative, total = [], 0
+            for count in self._counts:
+                total += count
+                cumulative.append(total)
+            return cumulative, self._count, self._sum
+
+    def render(self):
+        cumulative, count, total = self.snapshot()
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.description),
+            '# TYPE {0} histogram'.format(self.name),
+        ]
+        for bound, value in zip(self.buckets, cumulative):
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(self.name, bound, value))
+        lines.append('{0}_bucket{{le="+Inf"}} {1}'.format(self.name, count))
+        lines.append('{0}_sum {1}'.format(self.name, total))
+        lines.append('{0}_count {1}'.format(self.name, count))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.statsd = None
+        self._histograms = []
+
+    def histogram(self, name, description, buckets=SECONDS_BUCKETS):
+        histogram = Histogram(name, description, buckets, registry=self)
+        self._histograms.append(histogram)
+        return histogram
+
+    def render(self):
+        lines = []
+        for histogram in self._histograms:
+            lines.extend(histogram.render())
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdClient(object):
+
+    """Fire-and-forget statsd sender, `_seconds` histograms are sent as
+    millisecond timers
+    """
+
+    def __init__(self, host, port=8125, prefix='cronq'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, is_timing):
+        if is_timing:
+            packet = '{0}.{1}:{2:.3f}|ms'.format(self.prefix, name, value * 1000)
+        else:
+            packet = '{0}.{1}:{2}|h'.format(self.prefix, name, value)
+        try:
+            self._socket.sendto(packet, self.address)
+        except socket.error:
+            pass
+
+
+REGISTRY = Registry()
+
+SCHEDULE_LAG = REGISTRY.histogram(
+    'cronq_injector_schedule_lag_seconds',
+    'Time between when a job was due and when it was published')
+INJECT_CYCLE = REGISTRY.histogram(
+    'cronq_injector_cycle_seconds',
+    'Duration of an inject cycle')
+JOBS_CLAIMED = REGISTRY.histogram(
+    'cronq_injector_jobs_claimed',
+    'Number of jobs claimed by an inject cycle',
+    buckets=COUNT_BUCKETS)
+PUBLISH_CONFIRM = REGISTRY.histogram(
+    'cronq_injector_publish_confirm_seconds',
+    'Time taken to publish jobs and receive broker confirms')
+DB_QUERY = REGISTRY.histogram(
+    'cronq_injector_db_query_seconds',
+    'Duration of the queries and commits that claim due jobs')
+
+
+def configure_statsd(address, prefix='cronq', registry=REGISTRY):
+    """Push every observation to the statsd server at "host[:port]" """
+    host, _, port = address.partition(':')
+    registry.statsd = StatsdClient(host, int(port or 8125), prefix)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        body = self.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start_http_server(port, interface='0.0.0.0', registry=REGISTRY):
+    """Serve the histograms of `registry` on every path in a daemon thread"""
+    class MetricsHandler(_MetricsHandler):
+        pass
+    MetricsHandler.registry = registry
+
+    server = BaseHTTPServer.HTTPServer((interface, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='cronq-metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving metrics on {0}:{1}'.format(interface, port))
+    return server
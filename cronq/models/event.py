@@ -4,6 +4,7 @@ from cronq.models.base import Base
 from sqlalchemy import CHAR
 from sqlalchemy import Column
 from sqlalchemy import DateTime
+from sqlalchemy import Float
 from sqlalchemy import ForeignKey
 from sqlalchemy import Integer
 
@@ -13,6 +14,17 @@ class Event(Base):
     __tablename__ = 'events'
     __table_args__ = {'mysql_engine': 'InnoDB'}
 
+    # resource usage reported by the runner with finished events
+    RESOURCE_FIELDS = (
+        'cpu_user',
+        'cpu_system',
+        'max_rss',
+        'block_in',
+        'block_out',
+        'ctx_voluntary',
+        'ctx_involuntary',
+    )
+
     id = Column(Integer, primary_key=True)
     job_id = Column(Integer, ForeignKey('jobs.id'))
     datetime = Column(DateTime)
@@ -20,3 +32,10 @@ class Event(Base):
     type = Column(CHAR(32))
     host = Column(CHAR(255))
     return_code = Column(Integer)
+    cpu_user = Column(Float)
+    cpu_system = Column(Float)
+    max_rss = Column(Integer)
+    block_in = Column(Integer)
+    block_out = Column(Integer)
+    ctx_voluntary = Column(Integer)
+    ctx_involuntary = Column(Integer)
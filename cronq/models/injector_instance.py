@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from cronq.models.base import Base
+
+from sqlalchemy import CHAR
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+
+
+class InjectorInstance(Base):
+
+    __tablename__ = 'injector_instances'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    name = Column(CHAR(64), primary_key=True)
+    heartbeat_at = Column(DateTime())
@@ -20,21 +20,44 @@ class Job(Base):
     __table_args__ = (UniqueConstraint('category_id', 'name'), {
         'mysql_engine': 'InnoDB'})
 
+    CATCHUP_SKIP = 'skip'
+    CATCHUP_ONCE = 'once'
+    CATCHUP_REPLAY = 'replay'
+
+    OVERLAP_ALLOW = 'allow'
+    OVERLAP_SKIP = 'skip'
+    OVERLAP_QUEUE_ONE = 'queue_one'
+
     events = relationship("Event")
 
     id = Column(Integer, primary_key=True)
     name = Column(CHAR(255))
     interval = Column(Interval)
-    next_run = Column(DateTime(), default=datetime.datetime.utcnow)
+    next_run = Column(DateTime(), default=datetime.datetime.utcnow, index=True)
     last_run_start = Column(DateTime(), default=None)
     last_run_stop = Column(DateTime(), default=None)
     last_run_status = Column(CHAR(32))
     current_status = Column(CHAR(32))
     routing_key = Column(CHAR(32), default='default')
     command = Column(Text())
-    run_now = Column(Integer)
+    run_now = Column(Integer, default=0, index=True)
     locked_by = Column(CHAR(64))
     category_id = Column(Integer, ForeignKey('categories.id'))
+    catchup = Column(CHAR(16), default=CATCHUP_ONCE)
+    catchup_limit = Column(Integer, default=None)
+    jitter = Column(Integer, default=None)
+    schedule = Column(CHAR(255), default=None)
+    timeout = Column(Integer, default=None)
+    overlap = Column(CHAR(16), default=OVERLAP_ALLOW)
+    run_lease_expires_at = Column(DateTime(), default=None)
+    # a queue_one run held back until the run in progress finishes
+    run_queued = Column(Integer, default=0)
+    # send time of the last run result applied to the status columns
+    status_updated_at = Column(DateTime(), default=None)
+    updated_at = Column(DateTime(),
+                        default=datetime.datetime.utcnow,
+                        onupdate=datetime.datetime.utcnow,
+                        index=True)
 
     def last_run_text(self):
         hours_ago = ''
@@ -50,7 +73,9 @@ class Job(Base):
         status_map = {
             'started': 'Running now',
             'starting': 'Running now',
+            'queued': 'Queued',
             'failed': 'Last run failed',
+            'timed_out': 'Last run timed out',
             'finished': 'Error',
             'none': 'Waiting...',
             'succeeded': 'About {0}'.format(hours_ago),
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from cronq.models.base import Base
+
+from sqlalchemy import CHAR
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Float
+from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import Integer
+
+
+class Run(Base):
+
+    """One row per run, kept up to date from its results by the aggregator"""
+
+    __tablename__ = 'runs'
+    __table_args__ = (Index('ix_runs_job_id_created_at', 'job_id', 'created_at'), {
+        'mysql_engine': 'InnoDB'})
+
+    id = Column(CHAR(32), primary_key=True)
+    job_id = Column(Integer, ForeignKey('jobs.id'))
+    host = Column(CHAR(255))
+    # send time of the run's first result, runs are listed by it
+    created_at = Column(DateTime())
+    started_at = Column(DateTime())
+    completed_at = Column(DateTime())
+    # seconds from start to completion
+    duration = Column(Float)
+    return_code = Column(Integer)
+    status = Column(CHAR(32))
+    cpu_user = Column(Float)
+    cpu_system = Column(Float)
+    max_rss = Column(Integer)
+    block_in = Column(Integer)
+    block_out = Column(Integer)
+    ctx_voluntary = Column(Integer)
+    ctx_involuntary = Column(Integer)
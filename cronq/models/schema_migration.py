@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from cronq.models.base import Base
+
+from sqlalchemy import CHAR
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Integer
+
+
+class SchemaMigration(Base):
+
+    __tablename__ = 'schema_migrations'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(CHAR(255))
+    applied_at = Column(DateTime(), default=datetime.datetime.utcnow)
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from cronq.models.base import Base
+
+from sqlalchemy import CHAR
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Integer
+
+
+class ShardLease(Base):
+
+    __tablename__ = 'shard_leases'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    shard = Column(Integer, primary_key=True, autoincrement=False)
+    owner = Column(CHAR(64))
+    expires_at = Column(DateTime())
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""Spreads job publishing out over time
+
+Schedules written for the top of the hour make hundreds of jobs due in the
+same second. `PacedPublisher` sits in front of a `Publisher` and holds each
+job back by a deterministic per-job jitter, then releases jobs no faster
+than the token bucket configured for their routing key allows.
+"""
+import datetime
+import hashlib
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def jitter_offset(job_id, window):
+    """Returns a stable delay in seconds for `job_id` within `window`"""
+    if not window:
+        return 0.0
+    digest = hashlib.md5(str(job_id)).hexdigest()
+    return window * int(digest[:8], 16) / float(0xffffffff)
+
+
+def parse_rate_limits(value):
+    """Parse "routing_key=rate[:burst],..." into {routing_key: (rate, burst)}
+
+    `rate` is in jobs per second and `burst` defaults to `rate`. The routing
+    key `*` applies to every routing key without its own limit.
+    """
+    limits = {}
+    if not value:
+        return limits
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        routing_key, spec = item.split('=', 1)
+        rate, _, burst = spec.partition(':')
+        rate = float(rate)
+        limits[routing_key.strip()] = (rate, float(burst) if burst else rate)
+    return limits
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.clock = clock
+        self._tokens = self.burst
+        self._updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self):
+        """Take a token if one is available, returns True on success"""
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        """Seconds until the next token is available"""
+        self._refill()
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+
+class PacedPublisher(object):
+
+    """Publisher wrapper that delays jobs by jitter and rate limits
+
+    `publish` and `publish_many` only queue jobs and report success; `flush`
+    has to be called regularly to actually publish jobs whose time has
+    come. `next_release` tells how long the caller may wait before calling
+    `flush` again. Jobs the wrapped publisher fails to publish stay queued
+    and are retried by the next `flush`, and `take_pending` hands back
+    whatever is still queued when the caller shuts down.
+
+    Job documents carry the time they were due as `scheduled_at`, which is
+    where the jitter is applied from and what the reported delay is
+    measured against. Jobs without it, such as run now requests, are not
+    jittered.
+    """
+
+    def __init__(self, publisher, jitter_window=0, rate_limits=None,
+                 clock=time.time):
+        self.publisher = publisher
+        self.jitter_window = jitter_window
+        self.rate_limits = rate_limits or {}
+        self.clock = clock
+        self._buckets = {}
+        self._delayed = []
+        self._ready = {}
+        self._counter = itertools.count()
+
+    def publish(self, routing_key, job, run_id):
+        self._queue(routing_key, job, run_id)
+        return True
+
+    def publish_many(self, jobs):
+        for routing_key, job, run_id in jobs:
+            self._queue(routing_key, job, run_id)
+        return [True] * len(jobs)
+
+    def _queue(self, routing_key, job, run_id):
+        release = self.clock()
+        scheduled_at = job.get('scheduled_at')
+        if scheduled_at is not None:
+            window = job.get('jitter')
+            if window is None:
+                window = self.jitter_window
+            offset = jitter_offset(job['id'], window)
+            release = max(release, _timestamp(scheduled_at) + offset)
+        heapq.heappush(self._delayed, (release, next(self._counter), routing_key, job, run_id))
+
+    def _bucket(self, routing_key):
+        if routing_key not in self._buckets:
+            limit = self.rate_limits.get(routing_key, self.rate_limits.get('*'))
+            self._buckets[routing_key] = None
+            if limit is not None:
+                self._buckets[routing_key] = TokenBucket(*limit, clock=self.clock)
+        return self._buckets[routing_key]
+
+    def flush(self, force=False):
+        """Publish every job that is due and within its rate limit
+
+        With `force` all queued jobs are published immediately.
+        """
+        now = self.clock()
+        while self._delayed and (force or self._delayed[0][0] <= now):
+            _, _, routing_key, job, run_id = heapq.heappop(self._delayed)
+            self._ready.setdefault(routing_key, deque()).append((job, run_id))
+
+        batch = []
+        for routing_key, jobs in self._ready.items():
+            bucket = self._bucket(routing_key)
+            while jobs and (force or bucket is None or bucket.take()):
+                job, run_id = jobs.popleft()
+                batch.append((routing_key, job, run_id))
+            if not jobs:
+                del self._ready[routing_key]
+
+        if not batch:
+            return []
+
+        try:
+            results = self.publisher.publish_many(batch)
+        except Exception:
+            logger.exception('Unable to publish {0} jobs'.format(len(batch)))
+            results = [False] * len(batch)
+
+        published_at = self.clock()
+        failed = []
+        for (routing_key, job, run_id), success in zip(batch, results):
+            if not success:
+                failed.append((routing_key, job, run_id))
+                continue
+            if job.get('scheduled_at') is None:
+                continue
+            delay = published_at - _timestamp(job['scheduled_at'])
+            logger.info('[cronq_job_id:{0}] Published {1:.3f} seconds after it was due'.format(
+                job['id'], delay))
+
+        # retried first next time, in their original order
+        for routing_key, job, run_id in reversed(failed):
+            logger.warning('[cronq_job_id:{0}] Publishing failed, keeping it queued'.format(job['id']))
+            self._ready.setdefault(routing_key, deque()).appendleft((job, run_id))
+        return results
+
+    def next_release(self):
+        """Seconds until `flush` may publish something, or None when empty"""
+        waits = []
+        if self._delayed:
+            waits.append(max(self._delayed[0][0] - self.clock(), 0))
+        for routing_key in self._ready:
+            bucket = self._bucket(routing_key)
+            waits.append(0.0 if bucket is None else bucket.wait_time())
+        if not waits:
+            return None
+        return min(waits)
+
+    def pending(self):
+        return len(self._delayed) + sum(len(jobs) for jobs in self._ready.values())
+
+    def take_pending(self):
+        """Remove and return every queued (routing_key, job, run_id)"""
+        jobs = [(routing_key, job, run_id)
+                for _, _, routing_key, job, run_id in sorted(self._delayed)]
+        for routing_key, ready in self._ready.items():
+            jobs.extend((routing_key, job, run_id) for job, run_id in ready)
+        self._delayed = []
+        self._ready = {}
+        return jobs
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _timestamp(dt):
+    return (dt - _EPOCH).total_seconds()
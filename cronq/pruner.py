@@ -6,6 +6,7 @@ import sys
 from cronq.backends.mysql import Storage
 from cronq.models.event import Event
 from cronq.models.job import Job
+from cronq.models.run import Run
 
 from sqlalchemy import between
 from sqlalchemy.sql.expression import asc
@@ -81,11 +82,29 @@ def prune_keep_record(job_id, keep, storage):
     storage.session.commit()
 
 
+def prune_keep_runs(job_id, keep, storage):
+    if keep < 1:
+        return
+
+    oldest = storage.session.query(Run.created_at).filter_by(job_id=job_id).\
+        order_by(desc(Run.created_at)).offset(keep - 1).limit(1).scalar()
+    if oldest is None:
+        return
+
+    logger.info('Job ID {0}, Pruning runs before {1}'.format(job_id, oldest))
+    stmt = Run.__table__.delete()\
+                        .where(Run.job_id == job_id)\
+                        .where(Run.created_at < oldest)
+    storage._engine.execute(stmt)
+    storage.session.commit()
+
+
 def prune_keep(keep):
     storage = Storage(isolation_level=None)
     jobs = storage.session.query(Job).order_by(asc(Job.id))
     for job in jobs:
         prune_keep_record(job.id, keep, storage)
+        prune_keep_runs(job.id, keep, storage)
 
 
 def prune_type(args):
@@ -123,7 +142,7 @@ def main():
     parser.add_argument('--keep',
                         type=int,
                         default=None,
-                        help='number of event entries to keep')
+                        help='number of event entries and runs to keep per job')
     parser.add_argument('--first',
                         type=int,
                         default=None,
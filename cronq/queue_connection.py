@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import datetime
 import itertools
 import json
 import logging
@@ -9,6 +10,8 @@ import string
 import time
 import urlparse
 
+from cronq import codec
+from cronq import metrics
 from cronq.config import Config
 from haigha.connections.rabbit_connection import RabbitConnection
 from haigha.message import Message
@@ -78,9 +81,22 @@ class QueueConnection(object):
     Without `confirm=True` the return value of publish will only indicate if
     the message was written to a connection successfully.
 
+    Many messages can be published without waiting for a broker round-trip
+    each. `publish_many` sends them back to back, keeping at most
+    `confirm_window` unconfirmed messages in flight, and returns one bool
+    per message:
+
+        results = queueconnection.publish_many([
+            ('exchange', 'routing_key', {}, 'First Body'),
+            ('exchange', 'routing_key', {}, 'Second Body'),
+        ])
+
+    Message properties, such as the content type, can be passed to
+    `publish` with `properties`, or as a fifth element of each tuple.
+
     """
 
-    def __init__(self, url=None, confirm=False, **kwargs):
+    def __init__(self, url=None, confirm=False, confirm_window=1000, **kwargs):
         if url is None:
             url = Config.RABBITMQ_URL
         hosts, user, password, vhost, port, heartbeat = parse_url(url)
@@ -102,17 +118,20 @@ class QueueConnection(object):
         self._get_next_host = create_host_factory(self._connection_hosts)
 
         self._confirm = confirm
+        self._confirm_window = confirm_window
         self._logger = logger
 
-        self._create_connection()
+        # delivery tags awaiting a confirm and the outcome of confirmed ones
+        self._unconfirmed = set()
+        self._confirmed = {}
 
-        self._acked = False
-        self._last_confirmed_message = None
+        self._create_connection()
 
     def _create_connection(self):
         "Tries to create a connection, returns True on success"
         self._connection = None
-        self._last_confirmed_message = None
+        self._unconfirmed = set()
+        self._confirmed = {}
         host = self._get_next_host()
         self._logger.debug('Trying to connect to {}'.format(host))
         try:
@@ -135,6 +154,7 @@ class QueueConnection(object):
         if self._confirm:
             self._channel.confirm.select(nowait=False)
             self._channel.basic.set_ack_listener(self._ack)
+            self._channel.basic.set_nack_listener(self._nack)
         self._logger.debug('Connected to {}'.format(host))
         return True
 
@@ -159,7 +179,16 @@ class QueueConnection(object):
                 time.sleep(self._connect_attempt_delay)
 
     def _ack(self, message_id):
-        self._last_confirmed_message = message_id
+        self._confirm_message(message_id, True)
+
+    def _nack(self, message_id, requeue=False):
+        self._logger.warning('Message {0} was nacked by the broker'.format(message_id))
+        self._confirm_message(message_id, False)
+
+    def _confirm_message(self, message_id, success):
+        if message_id in self._unconfirmed:
+            self._unconfirmed.discard(message_id)
+            self._confirmed[message_id] = success
 
     def is_connected(self):
         if self._connection is None or self._channel is None:
@@ -180,7 +209,8 @@ class QueueConnection(object):
                 routing_key,
                 headers,
                 body,
-                connect_attempts=3):
+                connect_attempts=3,
+                properties=None):
         """Publish a messages to AMQP
 
         Returns a bool about the success of the publish. If `confirm=True` True
@@ -189,27 +219,65 @@ class QueueConnection(object):
         message making it to the server.
 
         """
+        return self.publish_many(
+            [(exchange, routing_key, headers, body, properties)],
+            connect_attempts=connect_attempts)[0]
+
+    def publish_many(self, messages, connect_attempts=3):
+        """Publish (exchange, routing_key, headers, body[, properties]) tuples to AMQP
+
+        Messages are written back to back without waiting for each confirm.
+        Returns a list with one bool per message, with the same meaning as
+        the return value of `publish`.
+
+        """
+        messages = list(messages)
         if not self.is_connected():
             self._try_to_connect(attempts=connect_attempts)
 
         if self._connection is None or self._channel is None:
             self._logger.error('Tried to publish without an AMQP connection')
-            return False
+            return [False] * len(messages)
+
+        msg_numbers = []
+        for message in messages:
+            exchange, routing_key, headers, body = message[:4]
+            properties = message[4] if len(message) > 4 else None
+            if self._confirm:
+                while len(self._unconfirmed) >= self._confirm_window:
+                    if not self._read_confirms():
+                        break
+            if not self.is_connected():
+                break
+
+            msg_number = self._channel.basic.publish(
+                Message(body, application_headers=headers, **(properties or {})),
+                exchange=exchange,
+                routing_key=routing_key
+            )
+            if self._confirm:
+                self._unconfirmed.add(msg_number)
+            msg_numbers.append(msg_number)
 
-        msg_number = self._channel.basic.publish(
-            Message(body, application_headers=headers),
-            exchange=exchange,
-            routing_key=routing_key
-        )
+        unsent = [False] * (len(messages) - len(msg_numbers))
+        if not self._confirm:
+            return [self.is_connected()] * len(msg_numbers) + unsent
 
-        if self._confirm:
-            if self.is_connected():
-                self._connection.read_frames()
-                return self._last_confirmed_message == msg_number
-            else:
-                return False
+        pending = set(msg_numbers)
+        while pending & self._unconfirmed:
+            if not self._read_confirms():
+                break
 
-        return True
+        results = [self._confirmed.pop(msg_number, False)
+                   for msg_number in msg_numbers]
+        return results + unsent
+
+    def _read_confirms(self):
+        """Process incoming frames, returns False once disconnected"""
+        if not self.is_connected():
+            return False
+        self._connection.read_frames()
+        return self.is_connected()
 
     def publish_json(self, exchange, routing_key, headers, body):
         data = json.dumps(body)
@@ -225,16 +293,65 @@ class Publisher(object):
         self.queue_connection = QueueConnection(Config.RABBITMQ_URL,
                                                 confirm=True)
 
-    def publish(self, routing_key, job, run_id):
+    def _command(self, job, run_id):
         cmd = {
             'run_id': str(run_id),
             'job_id': job['id'],
             'cmd': job['command'],
             'name': job['name'],
         }
+        if job.get('timeout'):
+            cmd['timeout'] = job['timeout']
+        if job.get('overlap'):
+            cmd['overlap'] = job['overlap']
         logger.debug(cmd)
-        return self.queue_connection.publish_json(
+        return cmd
+
+    def _observe(self, jobs, results, start):
+        """Record confirm latency and how late each published job went out"""
+        metrics.PUBLISH_CONFIRM.observe(time.time() - start)
+        now = datetime.datetime.utcnow()
+        for job, success in zip(jobs, results):
+            if success and job.get('scheduled_at') is not None:
+                lag = now - job['scheduled_at']
+                metrics.SCHEDULE_LAG.observe(max(lag.total_seconds(), 0))
+
+    def publish(self, routing_key, job, run_id):
+        start = time.time()
+        body, properties = codec.encode_job(self._command(job, run_id))
+        success = self.queue_connection.publish(
             "cronq",
             routing_key,
             {},
-            cmd)
+            body,
+            properties=properties)
+        self._observe([job], [success], start)
+        return success
+
+    def publish_many(self, jobs):
+        """Publish (routing_key, job, run_id) tuples, returns a bool for each"""
+        jobs = list(jobs)
+        start = time.time()
+        messages = []
+        for routing_key, job, run_id in jobs:
+            body, properties = codec.encode_job(self._command(job, run_id))
+            messages.append(("cronq", routing_key, {}, body, properties))
+        results = self.queue_connection.publish_many(messages)
+        self._observe([job for _, job, _ in jobs], results, start)
+        return results
+
+
+class ControlPublisher(object):
+
+    """Publishes control messages for injectors, such as run now requests"""
+
+    def __init__(self, queue=None):
+        self.queue = queue or Config.CONTROL_QUEUE
+        self.queue_connection = QueueConnection(Config.RABBITMQ_URL)
+
+    def run_now(self, job_id):
+        return self.queue_connection.publish_json(
+            "cronq",
+            self.queue,
+            {},
+            {'type': 'run_now', 'job_id': job_id})
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
 import os
 import random
+import select
 import socket
 import string
 import time
@@ -12,10 +14,12 @@ from cronq.logger.handlers import NullHandler
 
 from haigha.connections.rabbit_connection import RabbitConnection
 
-# cronq jobs can be very long, override heartbeat settings
-# to keep rabbitmq connections alive (or there might be problems)
+# consumers that block between reads while handling a message override
+# heartbeat settings to keep rabbitmq connections alive
 CONSUMER_HEARTBEAT = 50000
 
+RESULTS_QUEUE = 'cronq_results'
+
 
 logger = logging.getLogger(__name__)
 
@@ -105,6 +109,54 @@ def plain_rabbit_connection_to_hosts(hosts, **kwargs):
     logger.error('Could not connect to any hosts')
 
 
+def result_queue(job_id, partitions=None):
+    """Queue, and routing key, for results of `job_id`
+
+    With partitions, results of a job always go to the same one of
+    `cronq_results.0` to `cronq_results.<partitions - 1>`, so one
+    aggregator stores them in order.
+    """
+    if partitions is None:
+        partitions = Config.RESULT_PARTITIONS
+    if partitions <= 0:
+        return RESULTS_QUEUE
+    return '{0}.{1}'.format(RESULTS_QUEUE, int(job_id) % partitions)
+
+
+def declare_result_partitions(channel, partitions=None):
+    """Declare and bind the partitioned result queues
+
+    The broker delivers each queue to one consumer at a time (RabbitMQ
+    3.8 and later), so aggregators sharing a partition act as standbys
+    instead of competing for its results.
+    """
+    if partitions is None:
+        partitions = Config.RESULT_PARTITIONS
+    for partition in xrange(partitions):
+        queue = '{0}.{1}'.format(RESULTS_QUEUE, partition)
+        channel.queue.declare(queue, auto_delete=False,
+                              arguments={'x-single-active-consumer': True})
+        channel.queue.bind(queue, 'cronq', queue)
+
+
+def wait_for_frames(connection, timeout):
+    """Wait up to `timeout` seconds for `connection` to have data to read
+
+    `connection.read_frames()` blocks for as long as the heartbeat interval,
+    so callers that have other work to do check for incoming data first.
+    Returns True when frames can be read without blocking.
+    """
+    # haigha does not expose the socket of its transport
+    sock = getattr(connection.transport, '_sock', None)
+    if sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([sock], [], [], max(timeout, 0))
+    except select.error:
+        return False
+    return bool(readable)
+
+
 def connect(**kwargs):
     hosts, user, password, vhost, port, heartbeat = parse_url(Config.RABBITMQ_URL)
 
@@ -148,6 +200,10 @@ class CronqConsumer(object):
 
     """handles reconnects"""
 
+    # heartbeat interval in seconds, subclasses that keep reading frames
+    # while they work can use a short one
+    heartbeat = CONSUMER_HEARTBEAT
+
     def __init__(self):
         self._connection = None
         self._channel = None
@@ -159,7 +215,7 @@ class CronqConsumer(object):
     def _create_connection(self):
         self._connection = connect(
             close_cb=self._connection_closed_cb,
-            heartbeat=CONSUMER_HEARTBEAT)
+            heartbeat=self.heartbeat)
         self._channel = self._connection.channel()
 
     def connect(self):
@@ -193,9 +249,14 @@ class CronqConsumer(object):
         tag = msg.delivery_info['delivery_tag']
         return tag
 
-    def ack(self, msg):
+    def ack(self, msg, multiple=False):
+        """Ack `msg`, and with `multiple` every earlier unacked message too"""
         tag = self.tag_from_msg(msg)
-        if self.is_connected():
+        if not self.is_connected():
+            return
+        if multiple:
+            self.channel.basic.ack(tag, multiple=True)
+        else:
             self.channel.basic.ack(tag)
 
     def reject(self, msg, requeue=True):
@@ -243,3 +304,61 @@ class CronqConsumer(object):
         self.logger.info('Disconnected because: {}'.format(reason))
         self._connection = None
         self._channel = None
+
+
+class ControlConsumer(CronqConsumer):
+
+    """Consumes control messages, such as run now requests, for the injector
+
+    Unlike `consume`, which blocks forever, `poll` waits at most `timeout`
+    seconds for messages so it can take the place of the injector's sleep.
+    """
+
+    def __init__(self, queue, handler):
+        super(ControlConsumer, self).__init__()
+        self.queue = queue
+        self.handler = handler
+
+    def _create_connection(self):
+        super(ControlConsumer, self)._create_connection()
+        self.channel.queue.declare(self.queue, auto_delete=False)
+        self.channel.queue.bind(self.queue, 'cronq', self.queue)
+        self.channel.basic.qos(prefetch_count=100)
+        self.channel.basic.consume(
+            queue=self.queue,
+            consumer=self.run_something,
+            no_ack=False
+        )
+
+    def run_something(self, msg):
+        try:
+            self.handler(json.loads(str(msg.body)))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.logger.exception('unhandled exception in control message')
+        self.ack(msg)
+
+    def poll(self, timeout):
+        """Handle control messages for up to `timeout` seconds"""
+        deadline = time.time() + timeout
+        if not self.is_connected():
+            try:
+                self.make_connected(attempts=1)
+            except Exception:
+                self.logger.exception('unable to connect for control messages')
+            if not self.is_connected():
+                time.sleep(max(deadline - time.time(), 0))
+                return
+
+        while self.is_connected():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            try:
+                if wait_for_frames(self.connection, remaining):
+                    self.connection.read_frames()
+            except Exception:
+                self.logger.exception('error reading control messages')
+                self._connection = None
+                self._channel = None
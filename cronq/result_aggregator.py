@@ -1,60 +1,177 @@
 # -*- coding: utf-8 -*-
-import json
 import logging
 from uuid import UUID
 import sys
 
+from cronq import codec
 from cronq.backends.mysql import Storage
+from cronq.config import Config
+from cronq.models.event import Event
 from cronq.rabbit_connection import CronqConsumer
-from dateutil.parser import parse
+from cronq.rabbit_connection import declare_result_partitions
+from cronq.rabbit_connection import RESULTS_QUEUE
+from cronq.rabbit_connection import wait_for_frames
 
 logger = logging.getLogger(__name__)
 
 
+def parse_partitions(spec, count):
+    """Partition numbers in a spec like `0,2-3`, all `count` if it is empty"""
+    if not spec:
+        return range(count)
+    partitions = set()
+    for part in spec.split(','):
+        first, _, last = part.strip().partition('-')
+        partitions.update(range(int(first), int(last or first) + 1))
+    unknown = [partition for partition in partitions if not 0 <= partition < count]
+    if unknown:
+        raise ValueError('Unknown result partitions {0}, there are {1}'.format(
+            ', '.join(str(partition) for partition in sorted(unknown)), count))
+    return sorted(partitions)
+
+
+def result_queues(partitions=None, spec=None):
+    """Result queues an aggregator consumes, see `result_queue`"""
+    if partitions is None:
+        partitions = Config.RESULT_PARTITIONS
+    if partitions <= 0:
+        return [RESULTS_QUEUE]
+    return ['{0}.{1}'.format(RESULTS_QUEUE, partition)
+            for partition in parse_partitions(spec, partitions)]
+
+
 class CronqAggregator(CronqConsumer):
 
-    def __init__(self):
+    """Stores job results from the runners
+
+    With `batch_size` greater than one, up to that many results are
+    prefetched and stored together in one transaction, then acked with a
+    single `multiple` ack. A batch is stored once it is full or once no
+    more results arrived for `batch_wait` seconds.
+
+    `consume` takes one queue or a list of them, such as the result
+    partitions this aggregator owns. Each queue is delivered in order,
+    and all of them share one channel, so a `multiple` ack covers results
+    from every queue.
+    """
+
+    def __init__(self, batch_size=1, batch_wait=0.05):
         super(CronqAggregator, self).__init__()
         self.storage = Storage()
+        self.batch_size = max(batch_size, 1)
+        self.batch_wait = batch_wait
+        self._batch = []
+
+    def _create_connection(self):
+        super(CronqAggregator, self)._create_connection()
+        declare_result_partitions(self.channel)
+
+    def _result(self, msg):
+        data = codec.decode_result(msg.body, msg.properties.get('content_type'))
+        return {
+            'job_id': data['job_id'],
+            '_datetime': codec.to_datetime(data['sent_at']),
+            'run_id': UUID(hex=data['run_id']).hex,
+            'type': data.get('type'),
+            'host': data.get('host'),
+            'return_code': data.get('return_code'),
+            'resources': dict((field, data.get(field)) for field in Event.RESOURCE_FIELDS),
+        }
 
     def run_something(self, msg):
-        data = json.loads(str(msg.body))
-
-        job_id = data['job_id']
-        run_id = UUID(hex=data['run_id'])
+        result = self._result(msg)
+        job_id = result['job_id']
+        run_id = result['run_id']
 
         self.log_message(job_id, run_id,
                          "Write job result to database {}".format(str(msg.body)))
 
         self.storage.add_event(
             job_id,
-            parse(data.get('x-send-datetime')),
-            run_id.hex,
-            data.get('type'),
-            data.get('x-host'),
-            data.get('return_code'),
+            result['_datetime'],
+            run_id,
+            result['type'],
+            result['host'],
+            result['return_code'],
+            resources=result['resources'],
         )
 
         self.log_message(job_id, run_id, "Attempting to update status on job")
 
         self.storage.update_job_status(
             run_id,
-            data.get('job_id'),
-            parse(data.get('x-send-datetime')),
-            data.get('type'),
-            data.get('return_code', None))
+            job_id,
+            result['_datetime'],
+            result['type'],
+            result['return_code'])
 
         self.log_message(job_id, run_id, "Acking message on job")
         self.ack(msg)
 
+    def buffer_result(self, msg):
+        try:
+            self._batch.append((msg, self._result(msg)))
+        except (ValueError, KeyError, TypeError):
+            logger.exception('Rejecting malformed result {0}'.format(str(msg.body)))
+            self.reject(msg, requeue=False)
+
+    def flush(self):
+        """Store the buffered results and ack them all at once"""
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+
+        self.storage.add_results(result for _, result in batch)
+        logger.info('Stored a batch of {0} results'.format(len(batch)))
+
+        # delivery tags only grow, the last message acks the whole batch
+        self.ack(batch[-1][0], multiple=True)
+
+    def consume(self, queue):
+        queues = [queue] if isinstance(queue, basestring) else list(queue)
+        batched = self.batch_size > 1
+        consumer = self.buffer_result if batched else self.run_something
+
+        self.make_connected()
+        self._batch = []
+        # the prefetch applies to each queue's consumer
+        self.channel.basic.qos(prefetch_count=self.batch_size)
+        for name in queues:
+            self.channel.basic.consume(
+                queue=name,
+                consumer=consumer,
+                no_ack=False
+            )
+
+        if not batched:
+            while self.is_connected():
+                self.connection.read_frames()
+            return False
+
+        while self.is_connected():
+            # block while idle, only wait briefly for the rest of a batch
+            timeout = self.batch_wait if self._batch else 1
+            if wait_for_frames(self.connection, timeout):
+                self.connection.read_frames()
+                if len(self._batch) < self.batch_size:
+                    continue
+            self.flush()
+
+        # unacked results are redelivered on the next connection
+        self._batch = []
+        return False
+
 
 def setup():
-    runner = CronqAggregator()
+    queues = result_queues(spec=Config.AGGREGATOR_PARTITIONS)
+    runner = CronqAggregator(batch_size=Config.AGGREGATOR_BATCH_SIZE,
+                             batch_wait=Config.AGGREGATOR_BATCH_WAIT)
+    logger.info('Consuming results from {0}'.format(', '.join(queues)))
 
     max_failures = 10
     while max_failures > 0:
         runner.connect()
-        runner.consume(queue="cronq_results")
+        runner.consume(queue=queues)
         max_failures -= 1
 
     runner.logger.warning("Too many errors, exiting")
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""Local spool the runner writes job results to before they are published
+
+Results are appended to a file, one json document per line, and
+published in order by a background thread. A result is only dropped from
+the spool once the broker confirmed it, so results written while the
+broker is unreachable, or before the runner was restarted, are sent once
+it can be reached again. Delivery is at least once: results confirmed
+just before a crash may be published again after the restart.
+
+How far the spool has been published is kept in `<path>.offset`. Once
+everything is published the spool is truncated, and once the published
+part passes COMPACT_BYTES the unpublished tail is copied to a new file.
+"""
+import atexit
+import errno
+import fcntl
+import json
+import logging
+import os
+import threading
+
+from cronq.config import Config
+
+logger = logging.getLogger(__name__)
+
+# published bytes kept at the head of a busy spool before it is compacted
+COMPACT_BYTES = 1024 * 1024
+# longest wait between attempts while the broker is unreachable, in seconds
+MAX_RETRY_INTERVAL = 30
+
+
+class SpoolLocked(Exception):
+    pass
+
+
+class ResultSpool(object):
+
+    """Append results to `path` and publish them with `publish_many`
+
+    `publish_many` takes a list of (exchange, routing_key, headers, body)
+    tuples and returns a bool per message, like
+    `QueueConnection.publish_many` with confirms. `append` only writes to
+    the local file, it never waits for the broker. Results are spooled as
+    json and turned into message bodies and properties by `encode` when
+    they are published. `route`, if given, picks the routing key of each
+    result instead of `routing_key`.
+    """
+
+    def __init__(self, path, publish_many, exchange='cronq', routing_key='cronq_results',
+                 batch_size=None, retry_interval=None, encode=None, route=None):
+        if batch_size is None:
+            batch_size = Config.RUNNER_SPOOL_BATCH_SIZE
+        if retry_interval is None:
+            retry_interval = Config.RUNNER_SPOOL_RETRY_INTERVAL
+        self.path = path
+        self.publish_many = publish_many
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.batch_size = max(batch_size, 1)
+        self.retry_interval = retry_interval
+        self.encode = encode
+        self.route = route
+
+        self._lock = threading.Lock()
+        self._pending = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self._lock_file = open(path + '.lock', 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            self._lock_file.close()
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            raise SpoolLocked('{0} is used by another runner'.format(path))
+
+        self._file = open(path, 'ab')
+        self._file.seek(0, os.SEEK_END)
+        self._offset = self._read_offset()
+        if self._offset > os.path.getsize(path):
+            self._offset = 0
+        if self.unsent():
+            logger.info('Replaying {0} bytes of unsent results from {1}'.format(
+                self.unsent(), path))
+            self._pending.set()
+
+    def _read_offset(self):
+        try:
+            with open(self.path + '.offset') as offset_file:
+                return int(offset_file.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def _write_offset(self, offset):
+        temporary = self.path + '.offset.tmp'
+        with open(temporary, 'w') as offset_file:
+            offset_file.write(str(offset))
+        os.rename(temporary, self.path + '.offset')
+
+    def unsent(self):
+        """Bytes of results waiting to be published"""
+        with self._lock:
+            return self._file.tell() - self._offset
+
+    def append(self, body):
+        line = json.dumps(body) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+        self._pending.set()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='cronq-result-spool')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop publishing and close the spool, whatever is unsent stays in it"""
+        self._stopped.set()
+        self._pending.set()
+        if self._thread is not None:
+            self._thread.join(self.retry_interval * 4)
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+                self._lock_file.close()
+
+    def _read_batch(self):
+        """Unsent lines from the spool, up to the batch size"""
+        with self._lock:
+            end = self._file.tell()
+        lines = []
+        with open(self.path, 'rb') as spool:
+            spool.seek(self._offset)
+            while len(lines) < self.batch_size and spool.tell() < end:
+                line = spool.readline()
+                if not line.endswith('\n'):
+                    break
+                lines.append(line)
+        return lines
+
+    def flush(self):
+        """Publish one batch, returns False if the broker did not take all of it"""
+        lines = self._read_batch()
+        if not lines:
+            return True
+
+        results = self.publish_many([self._message(line) for line in lines])
+        # only the confirmed head is dropped, so results stay in order
+        sent = 0
+        for line, success in zip(lines, results):
+            if not success:
+                break
+            sent += len(line)
+
+        if sent:
+            self._advance(sent)
+        return sent == sum(len(line) for line in lines)
+
+    def _message(self, line):
+        body = line.rstrip('\n')
+        if self.encode is None and self.route is None:
+            return (self.exchange, self.routing_key, {}, body)
+        doc = json.loads(body)
+        routing_key = self.routing_key if self.route is None else self.route(doc)
+        if self.encode is None:
+            return (self.exchange, routing_key, {}, body)
+        body, properties = self.encode(doc)
+        return (self.exchange, routing_key, {}, body, properties)
+
+    def _advance(self, sent):
+        with self._lock:
+            self._offset += sent
+            end = self._file.tell()
+            if self._offset == end:
+                self._file.truncate(0)
+                self._file.seek(0)
+                self._offset = 0
+            elif self._offset >= COMPACT_BYTES:
+                self._compact(end)
+            self._write_offset(self._offset)
+
+    def _compact(self, end):
+        """Move the unsent tail to a fresh spool file, holding the lock"""
+        temporary = self.path + '.tmp'
+        with open(self.path, 'rb') as spool:
+            spool.seek(self._offset)
+            with open(temporary, 'wb') as tail:
+                tail.write(spool.read(end - self._offset))
+        # a crash before the rename replays the old file from the start,
+        # sending duplicates rather than skipping results
+        self._write_offset(0)
+        os.rename(temporary, self.path)
+        self._file.close()
+        self._file = open(self.path, 'ab')
+        self._file.seek(0, os.SEEK_END)
+        self._offset = 0
+
+    def _run(self):
+        delay = 0
+        while not self._stopped.is_set():
+            if delay:
+                # back off while the broker is unreachable, however many
+                # results are appended meanwhile
+                self._stopped.wait(delay)
+            else:
+                self._pending.wait(self.retry_interval)
+            self._pending.clear()
+
+            try:
+                while self.unsent() and not self._stopped.is_set():
+                    if not self.flush():
+                        raise IOError('broker did not confirm every result')
+                delay = 0
+            except Exception:
+                delay = min(max(delay * 2, self.retry_interval), MAX_RETRY_INTERVAL)
+                logger.warning('Unable to publish {0} bytes of results, retrying in {1}s'.format(
+                    self.unsent(), delay), exc_info=True)
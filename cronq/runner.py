@@ -1,38 +1,299 @@
 # -*- coding: utf-8 -*-
-import datetime
+import codecs
+import errno
 import fcntl
 import json
 import logging
-import logging.handlers
 import os
-import random
+import Queue
 import re
+import select
+import signal
 import socket
 import subprocess
 import sys
+import threading
 import time
 
+from cronq import codec
 from cronq.config import Config
+from cronq.logger.job_log import JobLog
+from cronq.logger.log_stream import LogStream
+from cronq.queue_connection import QueueConnection
 from cronq.rabbit_connection import CronqConsumer
-from cronq.utils import unicodedammit
+from cronq.rabbit_connection import declare_result_partitions
+from cronq.rabbit_connection import result_queue
+from cronq.rabbit_connection import wait_for_frames
+from cronq.result_spool import ResultSpool
+from cronq.spawn_server import SpawnedProcess
+from cronq.spawn_server import SpawnServer
 
 from haigha.message import Message
 
 FILENAME_REGEX = re.compile('[\W_]+', re.UNICODE)
 
+# bytes read from a job's output at a time
+OUTPUT_CHUNK_SIZE = 65536
+# how long to wait for output before checking whether the job exited
+OUTPUT_IDLE_TIMEOUT = 0.5
+# how often to check whether a job that closed its output exited
+EXIT_POLL_INTERVAL = 0.1
+# how often to retry a run lock held by another run
+RUN_LOCK_POLL_INTERVAL = 0.5
+
+
+def _latin1_fallback(error):
+    """Decode bytes that are not valid utf-8 as latin1 instead of failing"""
+    invalid = error.object[error.start:error.end]
+    return u''.join(unichr(ord(byte)) for byte in invalid), error.end
+
+
+codecs.register_error('cronq-latin1', _latin1_fallback)
+
+
+class JobTimedOut(Exception):
+    pass
+
+
+def acquire_run_lock(filename, wait=0):
+    """Lock `filename` for a run, returns the open lock file or None if busy
+
+    Waits up to `wait` seconds for the run holding the lock to release it.
+    The kernel drops the lock when the runner exits, so it never outlives
+    a dead runner. Close the returned file to release it.
+    """
+    lock_file = open(filename, 'a')
+    deadline = time.time() + wait
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                lock_file.close()
+                raise
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            lock_file.close()
+            return None
+        time.sleep(min(RUN_LOCK_POLL_INTERVAL, remaining))
+
+
+def reap(process, options=0):
+    """Wait for `process` with wait4 and keep its resource usage
+
+    The usage, stored on `process.rusage`, covers the job and every
+    descendant it waited for. Returns False if `options` includes WNOHANG
+    and the process is still running.
+    """
+    if process.returncode is not None:
+        return True
+    try:
+        if isinstance(process, SpawnedProcess):
+            pid, status, rusage = process.wait4(options)
+        else:
+            pid, status, rusage = os.wait4(process.pid, options)
+    except OSError, e:
+        if e.errno != errno.ECHILD:
+            raise
+        # reaped by someone else, the usage is lost
+        process.rusage = None
+        process.wait()
+        return True
+
+    if pid == 0:
+        return False
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    process.rusage = rusage
+    return True
+
+
+def resource_usage(rusage):
+    """Result fields for the resource usage of a run, max_rss is in KB"""
+    if rusage is None:
+        return {}
+    return {
+        'cpu_user': rusage.ru_utime,
+        'cpu_system': rusage.ru_stime,
+        'max_rss': rusage.ru_maxrss,
+        'block_in': rusage.ru_inblock,
+        'block_out': rusage.ru_oublock,
+        'ctx_voluntary': rusage.ru_nvcsw,
+        'ctx_involuntary': rusage.ru_nivcsw,
+    }
+
+
+def _signal_group(process, signum):
+    try:
+        os.killpg(process.pid, signum)
+    except OSError, e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def terminate_process_group(process, grace):
+    """TERM the process group of `process`, then KILL what is left
+
+    Jobs run in their own session, so the group holds the shell and
+    everything it started. The group is killed once the shell exits or
+    after `grace` seconds, whichever is first, so children that ignore
+    TERM or were left in the background do not survive the job.
+    """
+    _signal_group(process, signal.SIGTERM)
+    deadline = time.time() + grace
+    while not reap(process, os.WNOHANG) and time.time() < deadline:
+        time.sleep(0.1)
+    _signal_group(process, signal.SIGKILL)
+    reap(process)
+
+
+def iter_output_lines(process, idle_timeout=OUTPUT_IDLE_TIMEOUT, on_idle=None, deadline=None):
+    """Yield the lines `process` writes to stdout, decoded, until it exits
+
+    Output is read in large chunks as soon as `select` reports it, and
+    decoded as utf-8 with a latin1 fallback for invalid bytes. The pipe
+    closing wakes the loop when the job exits. A job that leaves a
+    background process holding the pipe open is noticed by checking for
+    its exit whenever no output arrived for `idle_timeout` seconds, which
+    is also when `on_idle` is called. Raises JobTimedOut once the time
+    passes `deadline`, leaving the process running, including while
+    waiting for a job that closed its output to exit.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='cronq-latin1')
+    fd = process.stdout.fileno()
+    pending = u''
+    while True:
+        timeout = idle_timeout
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise JobTimedOut()
+            timeout = min(timeout, remaining)
+        try:
+            readable, _, _ = select.select([fd], [], [], timeout)
+        except select.error:
+            continue
+        if not readable:
+            if on_idle is not None:
+                on_idle()
+            if reap(process, os.WNOHANG):
+                break
+            continue
+
+        chunk = os.read(fd, OUTPUT_CHUNK_SIZE)
+        if not chunk:
+            break
+        lines = (pending + decoder.decode(chunk)).split(u'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+
+    pending += decoder.decode('', final=True)
+    if pending:
+        yield pending
+
+    # a job may close or redirect its output long before it exits
+    last_idle = time.time()
+    while not reap(process, os.WNOHANG):
+        now = time.time()
+        if deadline is not None and now >= deadline:
+            raise JobTimedOut()
+        if on_idle is not None and now - last_idle >= idle_timeout:
+            on_idle()
+            last_idle = now
+        time.sleep(EXIT_POLL_INTERVAL)
+
 
 class CronqRunner(CronqConsumer):
 
-    """handles reconnects"""
+    """handles reconnects
+
+    Jobs run in `slots` worker threads, so the consuming thread keeps
+    reading frames and sending heartbeats while they execute. haigha is
+    not thread safe, so the workers hand their result messages and acks to
+    the consuming thread through an outbox, which is drained between reads
+    from the connection.
+
+    With a `result_spool`, results are appended to it and published by
+    its own thread, so they survive the connection dropping.
+    """
+
+    # how often the consuming thread checks the outbox, in seconds
+    OUTBOX_INTERVAL = 0.1
+
+    def __init__(self, slots=1, spawn_server=None, heartbeat=None, result_spool=None):
+        super(CronqRunner, self).__init__()
+        self.slots = max(slots, 1)
+        self.spawn_server = spawn_server
+        self.result_spool = result_spool
+        if heartbeat is not None:
+            self.heartbeat = heartbeat
+        self._jobs = None
+        self._outbox = None
+
+    def _create_connection(self):
+        super(CronqRunner, self)._create_connection()
+        # results routed to a partition nobody declared yet would be dropped
+        declare_result_partitions(self.channel)
+
+    def _call_on_connection(self, fn, *args):
+        if self._outbox is None:
+            return fn(*args)
+        self._outbox.put((fn, args))
 
     def publish_result(self, body):
-        headers = {
-            'x-send-datetime': str(datetime.datetime.utcnow()),
-            'x-host': str(socket.getfqdn()),
-        }
-        body.update(headers)
-        msg = Message(json.dumps(body))
-        self.publish(msg, 'cronq', 'cronq_results')
+        body.update({
+            'sent_at': time.time(),
+            'host': str(socket.getfqdn()),
+        })
+        if self.result_spool is not None:
+            return self.result_spool.append(body)
+        payload, properties = codec.encode_result(body)
+        msg = Message(payload, **properties)
+        self._call_on_connection(self.publish, msg, 'cronq', result_queue(body['job_id']))
+
+    def _open_log_stream(self, job_id, run_id):
+        """Stream output of a run to `cronq_logs.<run_id>` if enabled"""
+        if not Config.RUNNER_LOG_STREAM:
+            return None
+
+        routing_key = 'cronq_logs.{0}'.format(run_id)
+
+        def send(chunk, size):
+            chunk.update({'job_id': job_id, 'run_id': run_id})
+            self._call_on_connection(
+                self._publish_log_chunk, routing_key, chunk, size, stream)
+
+        stream = LogStream(send,
+                           Config.RUNNER_LOG_STREAM_CHUNK_SIZE,
+                           Config.RUNNER_LOG_STREAM_INTERVAL,
+                           Config.RUNNER_LOG_STREAM_MAX_BUFFER)
+        return stream
+
+    def _publish_log_chunk(self, routing_key, chunk, size, stream):
+        try:
+            if self.is_connected():
+                self.publish(Message(json.dumps(chunk)), 'cronq', routing_key)
+        finally:
+            stream.sent(size)
+
+    def spawn(self, cmd):
+        """Start `cmd` in a shell, in its own session"""
+        if self.spawn_server is not None:
+            return self.spawn_server.spawn(cmd)
+
+        return subprocess.Popen(
+            cmd,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            # own process group, so a timeout can kill all of it
+            preexec_fn=os.setsid,
+        )
 
     def valid_job(self, data):
         valid = True
@@ -43,6 +304,42 @@ class CronqRunner(CronqConsumer):
         return valid
 
     def run_job(self, data):
+        """Run a job, unless its overlap policy forbids running it now
+
+        Runs of a job on one host are serialized with a lock file, as a
+        backstop for the injector which holds runs back cluster-wide. A
+        queue_one run waits for the lock as long as the run holding it may
+        last, then is skipped too.
+        """
+        overlap = data.get('overlap') or 'allow'
+        if overlap == 'allow':
+            return self._run_job(data)
+
+        job_id = data.get('job_id')
+        run_id = data.get('run_id')
+        logfile = '-'.join(FILENAME_REGEX.split(data.get('name', 'UNKNOWN')))
+        wait = 0
+        if overlap == 'queue_one':
+            wait = (data.get('timeout') or Config.RUNNER_TIMEOUT or
+                    Config.INJECTOR_OVERLAP_LEASE)
+        lock_file = acquire_run_lock(
+            '{0}/{1}.lock'.format(Config.LOG_PATH, logfile.strip('-')),
+            wait=wait)
+        if lock_file is None:
+            self.log_message(job_id, run_id, "Another run is in progress, skipping")
+            self.publish_result({
+                'job_id': job_id,
+                'run_id': run_id,
+                'type': 'skipped',
+            })
+            return True
+
+        try:
+            return self._run_job(data)
+        finally:
+            lock_file.close()
+
+    def _run_job(self, data):
         start = time.time()
         process = None
 
@@ -56,17 +353,12 @@ class CronqRunner(CronqConsumer):
         self.publish_result({
             'job_id': data.get('job_id'),
             'run_id': data.get('run_id'),
-            'start_time': str(datetime.datetime.utcnow()),
+            'start_time': time.time(),
             'type': 'starting',
         })
 
         try:
-            process = subprocess.Popen(
-                cmd,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            )
+            process = self.spawn(cmd)
         except OSError:
             # log exception with stack trace
             self.logger.exception('[cronq_job_id:{0}] [cronq_run_id:{1}] Failed job'.format(
@@ -84,83 +376,72 @@ class CronqRunner(CronqConsumer):
 
             return False
 
-        # process job output
-        fd = process.stdout.fileno()
-        fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-        fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-
         self.log_message(job_id, run_id, "Waiting")
 
         splits = FILENAME_REGEX.split(data.get('name', 'UNKNOWN'))
-        if len(splits) > 1:
-            logfile = '-'.join(splits)
+        logfile = '-'.join(splits)
         filename = '{0}/{1}.log'.format(Config.LOG_PATH, logfile.strip('-'))
 
-        handler = logging.handlers.WatchedFileHandler(filename)
+        job_log = JobLog(filename)
+        log_stream = self._open_log_stream(job_id, run_id)
         log_to_stdout = bool(os.getenv('CRONQ_RUNNER_LOG_TO_STDOUT', False))
 
-        while True:
-            try:
-                nextline = process.stdout.readline()
-            except IOError:
-                nextline = ''
+        timeout = data.get('timeout') or Config.RUNNER_TIMEOUT
+        deadline = time.time() + timeout if timeout else None
+        timed_out = False
 
-            if nextline == '' and process.poll() is not None:
-                break
-
-            if nextline == '':
-                time.sleep(0.1 * random.random())
-                continue
-
-            try:
-                message = nextline.rstrip()
-                message = unicodedammit(message)
-            except (TypeError, ValueError):
-                continue
-
-            if message:
-                for m in message.splitlines():
-                    log_record = logging.makeLogRecord({
-                        'msg': message,
-                    })
-                    handler.emit(log_record)
-                    if log_to_stdout:
-                        self.log_message(
-                            job_id, run_id, log_record.getMessage())
-
-            time.sleep(0.00001)
-            sys.stdout.flush()
-
-        handler.close()
+        # process job output
+        on_idle = log_stream.flush_if_due if log_stream is not None else None
+        try:
+            for line in iter_output_lines(process, on_idle=on_idle, deadline=deadline):
+                message = line.rstrip()
+                if not message:
+                    continue
+
+                job_log.write(message)
+                if log_stream is not None:
+                    log_stream.write(message)
+                if log_to_stdout:
+                    self.log_message(job_id, run_id, message)
+        except JobTimedOut:
+            timed_out = True
+            self.log_message(job_id, run_id, "Timed out after {0} seconds, killing".format(
+                timeout), logging.WARNING)
+            terminate_process_group(process, Config.RUNNER_KILL_GRACE)
+        finally:
+            job_log.close()
+            if log_stream is not None:
+                log_stream.close()
 
         # communicate finished
         end = time.time()
-        self.publish_result({
+        result = {
             'job_id': job_id,
             'run_id': run_id,
             'return_code': process.returncode,
             'run_time': end - start,
-            'type': 'finished',
-        })
+            'type': 'timed_out' if timed_out else 'finished',
+        }
+        result.update(resource_usage(process.rusage))
+        self.publish_result(result)
 
         self.log_message(job_id, run_id, "[cronq_exit_code:{}] Done".format(process.returncode))
         return True
 
-    def run_something(self, msg):
-        make_directory(Config.LOG_PATH)
-
-        data = json.loads(str(msg.body))
-        if not self.valid_job(data):
-            return self.reject(requeue=False)
-
+    def _run_job_safely(self, data):
         try:
-            success = self.run_job(data)
+            return self.run_job(data)
         except KeyboardInterrupt:
             raise
         except:
             self.logger.exception("unhandled exception in job")
-            success = False
+            return False
 
+    def _settle(self, channel, msg, success):
+        if channel is not self.channel:
+            # delivery tags belong to the channel that delivered them
+            self.logger.warning("connection was reset, job will be redelivered")
+            return
         if not success:
             self.logger.warning("rejecting message")
             return self.reject(msg, requeue=False)
@@ -168,14 +449,112 @@ class CronqRunner(CronqConsumer):
             self.logger.info("acking message")
             return self.ack(msg)
 
+    def run_something(self, msg):
+        make_directory(Config.LOG_PATH)
+
+        try:
+            data = codec.decode_job(msg.body, msg.properties.get('content_type'))
+        except codec.DecodeError:
+            self.logger.exception("rejecting undecodable job")
+            return self.reject(msg, requeue=False)
+        if not self.valid_job(data):
+            return self.reject(msg, requeue=False)
+
+        if self._jobs is not None:
+            self._jobs.put((self.channel, msg, data))
+            return
+
+        success = self._run_job_safely(data)
+        return self._settle(self.channel, msg, success)
+
+    def _slot(self):
+        while True:
+            channel, msg, data = self._jobs.get()
+            success = self._run_job_safely(data)
+            self._outbox.put((self._settle, (channel, msg, success)))
+
+    def _start_slots(self):
+        if self._jobs is not None:
+            return
+        self._jobs = Queue.Queue()
+        self._outbox = Queue.Queue()
+        for i in xrange(self.slots):
+            thread = threading.Thread(target=self._slot,
+                                      name='cronq-slot-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+
+    def _drain_outbox(self):
+        while self.is_connected():
+            try:
+                fn, args = self._outbox.get_nowait()
+            except Queue.Empty:
+                return
+            fn(*args)
+
+    def _keep_alive(self, last_read):
+        """Heartbeat while no frames arrive, and notice a silent broker
+
+        haigha only sends heartbeats and checks for missed ones when
+        frames are read, which waits until the broker sends something.
+        """
+        self.connection.channel(0).send_heartbeat()
+        if self.heartbeat and time.time() - last_read > 2 * self.heartbeat:
+            self.connection.transport_closed(
+                msg='no frames received for {0} seconds'.format(2 * self.heartbeat))
+
+    def consume(self, queue):
+        self.make_connected()
+        self._start_slots()
+
+        # the broker only delivers as many jobs as there are slots, and
+        # hands out another one as each slot is acked
+        self.channel.basic.qos(prefetch_count=self.slots)
+        self.channel.basic.consume(
+            queue=queue,
+            consumer=self.run_something,
+            no_ack=False
+        )
+
+        last_read = time.time()
+        while self.is_connected():
+            self._drain_outbox()
+            if not self.is_connected():
+                break
+            if wait_for_frames(self.connection, self.OUTBOX_INTERVAL):
+                self.connection.read_frames()
+                last_read = time.time()
+            else:
+                self._keep_alive(last_read)
+
+        return False
+
 
 def setup():
-    runner = CronqRunner()
+    spawn_server = None
+    if Config.RUNNER_SPAWN_SERVER:
+        # started before the runner connects and grows
+        spawn_server = SpawnServer()
+        spawn_server.start()
+
+    result_spool = None
+    if Config.RUNNER_SPOOL_PATH:
+        # results are published with confirms on a connection of their own
+        publisher = QueueConnection(Config.RABBITMQ_URL, confirm=True)
+        result_spool = ResultSpool(Config.RUNNER_SPOOL_PATH, publisher.publish_many,
+                                   encode=codec.encode_result,
+                                   route=lambda result: result_queue(result['job_id']))
+        result_spool.start()
+
+    runner = CronqRunner(slots=Config.RUNNER_SLOTS,
+                         spawn_server=spawn_server,
+                         heartbeat=Config.RUNNER_HEARTBEAT,
+                         result_spool=result_spool)
 
     max_failures = 1000
     while max_failures > 0:
         runner.connect()
-        runner.consume(queue=CRONQ_QUEUE)
+        runner.consume(queue=Config.CRONQ_QUEUE)
         max_failures -= 1
 
     runner.logger.warning("Too many errors, exiting")
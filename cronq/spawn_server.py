@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""Start job commands from a small helper process instead of the runner
+
+Forking the runner copies the page tables of a whole Python interpreter
+for every job. The helper is started once, while it is still small, and
+forks and execs `/bin/sh -c <cmd>` on request. Requests and replies are
+json lines over the helper's stdin and stdout:
+
+    {"id": 1, "cmd": "echo hi", "output": "/tmp/cronq-spawn-x/1"}
+    {"id": 1, "pid": 1234}
+    {"pid": 1234, "status": 0, "rusage": [...]}
+
+The command writes its output to the fifo named in the request, which
+the runner reads like the stdout pipe of a `subprocess.Popen`.
+
+This module runs as a plain script in the helper, so it must only import
+the standard library.
+"""
+import errno
+import fcntl
+import json
+import logging
+import os
+import Queue
+import resource
+import select
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# how long to wait for the helper to start a command, in seconds
+SPAWN_TIMEOUT = 10
+
+
+def _set_blocking(fd, blocking):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    if blocking:
+        flags &= ~os.O_NONBLOCK
+    else:
+        flags |= os.O_NONBLOCK
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+
+class SpawnedProcess(object):
+
+    """A command started by the helper, standing in for a `subprocess.Popen`
+
+    Only the parts the runner uses are provided. The helper reaps the
+    command, so `wait4` waits for its report instead of calling `os.wait4`.
+    """
+
+    def __init__(self, pid, stdout):
+        self.pid = pid
+        self.stdout = stdout
+        self.returncode = None
+        self.rusage = None
+        self._exit = None
+        self._exited = threading.Event()
+
+    def _exited_with(self, status, rusage):
+        self._exit = (self.pid, status, rusage)
+        self._exited.set()
+
+    def wait4(self, options=0):
+        if options & os.WNOHANG and not self._exited.is_set():
+            return 0, 0, None
+        # a timeout keeps the wait interruptible
+        while not self._exited.wait(1):
+            pass
+        return self._exit
+
+    def poll(self):
+        if self.returncode is None and self._exited.is_set():
+            self.wait()
+        return self.returncode
+
+    def wait(self):
+        pid, status, rusage = self.wait4()
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        self.rusage = rusage
+        return self.returncode
+
+
+class SpawnServer(object):
+
+    """Client for the spawn helper, safe to use from several threads
+
+    The helper is started on the first spawn, or by calling `start` early
+    while the calling process is still small, and restarted if it died.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # one request in flight at a time, the helper serves them in order
+        self._request_lock = threading.Lock()
+        self._helper = None
+        self._replies = None
+        self._fifo_dir = None
+        self._next_id = 0
+        self._processes = {}
+        # requests that timed out, their commands are killed on sight
+        self._abandoned = set()
+
+    def start(self):
+        with self._lock:
+            self._ensure_started()
+
+    def _ensure_started(self):
+        if self._helper is not None and self._helper.poll() is None:
+            return
+
+        if self._fifo_dir is None:
+            self._fifo_dir = tempfile.mkdtemp(prefix='cronq-spawn-')
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        # -S skips site, the helper only needs the standard library
+        self._helper = subprocess.Popen(
+            [sys.executable, '-S', script],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            close_fds=True,
+        )
+        self._replies = Queue.Queue()
+        reader = threading.Thread(target=self._read_replies,
+                                  args=(self._helper, self._replies),
+                                  name='cronq-spawn-reader')
+        reader.daemon = True
+        reader.start()
+
+    def _read_replies(self, helper, replies):
+        for line in iter(helper.stdout.readline, ''):
+            reply = json.loads(line)
+            if 'id' in reply:
+                with self._lock:
+                    abandoned = reply['id'] in self._abandoned
+                    self._abandoned.discard(reply['id'])
+                if abandoned:
+                    self._discard(reply)
+                    continue
+                if 'pid' in reply:
+                    # registered before the exit report can be read
+                    process = SpawnedProcess(reply['pid'], None)
+                    with self._lock:
+                        self._processes[process.pid] = process
+                    reply['process'] = process
+                replies.put(reply)
+                continue
+
+            with self._lock:
+                process = self._processes.pop(reply['pid'], None)
+            if process is not None:
+                process._exited_with(reply['status'],
+                                     resource.struct_rusage(reply['rusage']))
+
+        # the helper died, its commands can no longer be reaped
+        replies.put({'error': 'spawn helper exited'})
+        with self._lock:
+            processes, self._processes = self._processes, {}
+        for process in processes.values():
+            process._exited_with(signal.SIGKILL, None)
+
+    def spawn(self, cmd):
+        """Run `cmd` with `/bin/sh` in its own session
+
+        Returns a SpawnedProcess whose stdout carries the command's stdout
+        and stderr. Raises OSError if the command could not be started.
+        """
+        with self._lock:
+            self._ensure_started()
+            self._next_id += 1
+            request_id = self._next_id
+            helper, replies, fifo_dir = self._helper, self._replies, self._fifo_dir
+
+        fifo = os.path.join(fifo_dir, str(request_id))
+        os.mkfifo(fifo, 0600)
+        try:
+            # with the read end open, the helper's open of the write end
+            # does not block, and the output never sees a premature EOF
+            fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                reply = self._request(helper, replies, {
+                    'id': request_id,
+                    'cmd': cmd,
+                    'output': fifo,
+                })
+            except:
+                os.close(fd)
+                raise
+        finally:
+            os.unlink(fifo)
+
+        if 'process' not in reply:
+            os.close(fd)
+            raise OSError(errno.ECHILD, reply.get('error', 'spawn failed'))
+
+        _set_blocking(fd, True)
+        process = reply['process']
+        process.stdout = os.fdopen(fd, 'rb')
+        return process
+
+    def _request(self, helper, replies, request):
+        with self._request_lock:
+            try:
+                helper.stdin.write(json.dumps(request) + '\n')
+                helper.stdin.flush()
+            except IOError, e:
+                raise OSError(e.errno, 'spawn helper is gone')
+            while True:
+                try:
+                    reply = replies.get(timeout=SPAWN_TIMEOUT)
+                except Queue.Empty:
+                    with self._lock:
+                        self._abandoned.add(request['id'])
+                    raise OSError(errno.ETIMEDOUT, 'spawn helper did not reply')
+                if reply.get('id') in (request['id'], None):
+                    return reply
+                # a late reply to a request that timed out
+                self._discard(reply)
+
+    def _discard(self, reply):
+        """Kill the command of a reply nobody waits for any more"""
+        pid = reply.get('pid')
+        if pid is None:
+            return
+        logger.warning('Killing command {0} started after its request timed out'.format(pid))
+        with self._lock:
+            self._processes.pop(pid, None)
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            # not in its own session yet
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def stop(self):
+        with self._lock:
+            helper, self._helper = self._helper, None
+            fifo_dir, self._fifo_dir = self._fifo_dir, None
+        if helper is not None:
+            helper.stdin.close()
+            helper.wait()
+        if fifo_dir is not None:
+            shutil.rmtree(fifo_dir, ignore_errors=True)
+
+
+def _exec_command(request, fd):
+    """In the forked child, make `fd` the output and exec the command"""
+    try:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.closerange(3, subprocess.MAXFD)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.execv('/bin/sh', ['/bin/sh', '-c', request['cmd']])
+    finally:
+        os._exit(127)
+
+
+def _spawn(request):
+    # fails with ENXIO instead of blocking the helper if the runner gave
+    # up on the request and closed the read end
+    fd = os.open(request['output'], os.O_WRONLY | os.O_NONBLOCK)
+    _set_blocking(fd, True)
+    try:
+        pid = os.fork()
+        if pid == 0:
+            _exec_command(request, fd)
+    finally:
+        os.close(fd)
+    return pid
+
+
+def _reap_children(reply):
+    while True:
+        try:
+            pid, status, rusage = os.wait4(-1, os.WNOHANG)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                return
+            raise
+        if pid == 0:
+            return
+        reply({'pid': pid, 'status': status, 'rusage': list(rusage)})
+
+
+def serve(requests, replies):
+    """Start the commands read from the `requests` fd until it is closed"""
+    wakeup_read, wakeup_write = os.pipe()
+    _set_blocking(wakeup_read, False)
+    _set_blocking(wakeup_write, False)
+
+    def wakeup(signum, frame):
+        try:
+            os.write(wakeup_write, '.')
+        except OSError:
+            pass
+
+    signal.signal(signal.SIGCHLD, wakeup)
+    # restart reads and writes interrupted by a command exiting
+    signal.siginterrupt(signal.SIGCHLD, False)
+
+    def reply(doc):
+        replies.write(json.dumps(doc) + '\n')
+        replies.flush()
+
+    pending = ''
+    while True:
+        try:
+            readable, _, _ = select.select([requests, wakeup_read], [], [])
+        except select.error:
+            continue
+
+        if wakeup_read in readable:
+            try:
+                os.read(wakeup_read, 4096)
+            except OSError:
+                pass
+            _reap_children(reply)
+
+        if requests in readable:
+            chunk = os.read(requests, 65536)
+            if not chunk:
+                return
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                request = json.loads(line)
+                try:
+                    reply({'id': request['id'], 'pid': _spawn(request)})
+                except OSError, e:
+                    reply({'id': request['id'], 'error': str(e)})
+
+
+if __name__ == '__main__':
+    serve(sys.stdin.fileno(), sys.stdout)
@@ -10,28 +10,6 @@ def split_command(string):
     return ret
 
 
-def task_status(first, last=None):
-    if last is None:
-        return first['status']
-
-    if last['status'] == 'finished':
-        if int(last['return_code']) == 0:
-            return 'succeeded'
-        return 'failed'
-    return last['status']
-
-
-def took(first_time, last_time):
-    if type(first_time) is not datetime.datetime:
-        return ""
-
-    if type(last_time) is not datetime.datetime:
-        return ""
-
-    elapsed_time = last_time - first_time
-    return int(elapsed_time.total_seconds())
-
-
 def unicodedammit(x):
     """encode as string, decode as unicode bytes"""
     try:
@@ -71,52 +49,6 @@ def decode_string(newstr, ignore=False):
     raise Exception("can't decode this string at all")
 
 
-def chunks_to_runs(chunks):
-    runs = []
-    for chunk in chunks:
-        run_id = None
-        host = None
-        for entry in ['first', 'last']:
-            if chunk.get(entry, None) is None:
-                continue
-
-            if run_id is None:
-                run_id = chunk.get(entry, {}).get('run_id', None)
-            if host is None:
-                host = chunk.get(entry, {}).get('host', None)
-
-        status = 'pending'
-        completed_at = None
-        return_code = None
-        completed_event_id = None
-        if chunk.get('last', {}):
-            status = chunk.get('last', {}).get('status', 'pending')
-            completed_at = chunk.get('last', {}).get('datetime', None)
-            return_code = chunk.get('last', {}).get('return_code', None)
-            completed_event_id = chunk.get('last', {}).get('id', None)
-
-        started_at = None
-        started_event_id = None
-        first = chunk.get('first', None)
-        if first is not None:
-            started_at = chunk.get('first', {}).get('datetime', None)
-            started_event_id = chunk.get('first', {}).get('id', None)
-
-        runs.append({
-            'id': run_id,
-            'job_id': chunk.get('job_id'),
-            'status': status,
-            'completed_at': completed_at,
-            'completed_event_id': completed_event_id,
-            'started_at': started_at,
-            'started_event_id': started_event_id,
-            'return_code': return_code,
-            'host': host,
-        })
-
-    return runs
-
-
 def json_serial(obj):
     """JSON serializer for objects not serializable by default json code"""
 
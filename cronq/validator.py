@@ -26,7 +26,7 @@ def cronq_schema():
                         },
                         "schedule": {
                             "type": "string",
-                            "pattern": "^R/[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}(:[0-9]{2})?/(P([0-9]+Y)?([0-9]+M)?([0-9]+D)?T?([0-9]+H)?([0-9]+M)?([0-9]+S)?|P[0-9]+W)$",  # noqa
+                            "pattern": "^(R/[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}(:[0-9]{2})?/(P([0-9]+Y)?([0-9]+M)?([0-9]+D)?T?([0-9]+H)?([0-9]+M)?([0-9]+S)?|P[0-9]+W)|@(yearly|annually|monthly|weekly|daily|midnight|hourly)|[0-9A-Za-z*,/-]+( +[0-9A-Za-z*,/-]+){4})$",  # noqa
                         },
                         "command": {
                             "type": "string",
@@ -34,6 +34,26 @@ def cronq_schema():
                         "routing_key": {
                             "type": "string",
                         },
+                        "catchup": {
+                            "type": "string",
+                            "enum": ["skip", "once", "replay"],
+                        },
+                        "catchup_limit": {
+                            "type": "integer",
+                            "minimum": 1,
+                        },
+                        "jitter": {
+                            "type": "integer",
+                            "minimum": 0,
+                        },
+                        "timeout": {
+                            "type": "integer",
+                            "minimum": 1,
+                        },
+                        "overlap": {
+                            "type": "string",
+                            "enum": ["allow", "skip", "queue_one"],
+                        },
                     },
                     "required": [
                         "name",
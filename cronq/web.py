@@ -2,9 +2,12 @@
 import datetime
 import json
 import logging
+import threading
 
 from cronq import interval_parser
 from cronq.backends.mysql import Storage
+from cronq.config import Config
+from cronq.queue_connection import ControlPublisher
 from cronq.utils import json_serial
 from cronq.utils import query_category_id
 from cronq.utils import query_category_name
@@ -13,8 +16,6 @@ from cronq.utils import query_page
 from cronq.utils import query_per_page
 from cronq.utils import query_sort
 from cronq.utils import split_command
-from cronq.utils import task_status
-from cronq.utils import took
 
 from flask import Blueprint
 from flask import Response
@@ -28,11 +29,12 @@ from flask import url_for
 
 blueprint_http = Blueprint('blueprint_http', __name__)
 blueprint_http.add_app_template_filter(split_command, 'split_command')
-blueprint_http.add_app_template_filter(task_status, 'task_status')
-blueprint_http.add_app_template_filter(took, 'took')
 
 logger = logging.getLogger(__name__)
 
+_control_publisher = None
+_control_publisher_lock = threading.Lock()
+
 
 @blueprint_http.before_request
 def create_storage():
@@ -70,22 +72,25 @@ def status():
 @blueprint_http.route('/job/<int:id>', methods=['GET', 'POST'])
 def job(id):
     if request.method == 'POST' and request.form.get('run_now') is not None:
-        g.storage.run_job_now(id)
+        run_job_now(id)
         flash('Job submitted at {0}'.format(datetime.datetime.utcnow()))
         return redirect(url_for('.job', id=id))
 
     job_doc = g.storage.get_job(id)
-    chunks = g.storage.last_event_chunks_for_job(id, 20)
+    runs = g.storage.runs_for_job(id, 20)
     title = job_doc.get('name', '')
-    return render_template('job.html', job=job_doc, chunks=chunks, title=title)
+    return render_template('job.html', job=job_doc, runs=runs, title=title)
 
 
 @blueprint_http.route('/run/<string:id>')
 def run_id(id):
+    run = g.storage.get_run(id)
+    if run is None:
+        abort(404)
+    # events are pruned over time, the run is kept
     events = list(g.storage.events_for_run_id(id))
-    job_id = events[0]['job_id']
-    job = g.storage.get_job(job_id)
-    return render_template('run_id.html', events=events, job=job)
+    job = g.storage.get_job(run['job_id'])
+    return render_template('run_id.html', run=run, events=events, job=job)
 
 
 @blueprint_http.route('/failures')
@@ -115,15 +120,22 @@ def category(name):
     for job in existing_jobs:
         job_lookup[job['name']] = job
 
+    logger.info("Calculating next runs")
+    jobs = data.get('jobs', [])
+    try:
+        next_runs = interval_parser.next_runs(
+            [job['schedule'] for job in jobs], datetime.datetime.utcnow())
+    except ValueError, e:
+        logger.warning("Invalid schedule: {0}".format(e))
+        abort(400)
+
     logger.info("Processing posted jobs")
-    for job in data.get('jobs', []):
+    for job, next_run in zip(jobs, next_runs):
         name = job['name']
-        logger.info("Calcuating next run for {0}".format(name))
-        next_run, duration = interval_parser.next_run_and_duration_from_8601(
-            job['schedule'])
+        schedule = interval_parser.compile_schedule(job['schedule'])
         existing_job = job_lookup.get(name, {})
         new_id = existing_job.get('id')
-        new_interval = duration.total_seconds()
+        new_interval = schedule.interval.total_seconds()
         command = job['command']
 
         logger.info("Adding job {0}".format(name))
@@ -134,7 +146,13 @@ def category(name):
             next_run,
             new_id,
             category_id,
-            routing_key=job.get('routing_key')
+            routing_key=job.get('routing_key'),
+            catchup=job.get('catchup'),
+            catchup_limit=job.get('catchup_limit'),
+            jitter=job.get('jitter'),
+            schedule=job['schedule'],
+            timeout=job.get('timeout'),
+            overlap=job.get('overlap'),
         )
         if existing_job:
             del job_lookup[name]
@@ -232,7 +250,7 @@ def api_job_show(id):
     return Response(
         json.dumps({
             'data': {
-                'job': job[0],
+                'job': jobs[0],
             },
         }, default=json_serial),
         mimetype='application/json'
@@ -253,7 +271,7 @@ def api_job_run(id):
             mimetype='application/json'
         )
 
-    g.storage.run_job_now(id)
+    run_job_now(id)
     return Response(
         json.dumps({
             'success': {
@@ -264,6 +282,28 @@ def api_job_run(id):
     )
 
 
+def run_job_now(id):
+    """Flag a job to run now and tell the injectors about it right away
+
+    The flag alone is picked up by the injector's regular scan. When a
+    control queue is configured, injectors are notified immediately as
+    well; failing to notify only means waiting for the scan.
+    """
+    global _control_publisher
+
+    g.storage.run_job_now(id)
+    if not Config.CONTROL_QUEUE:
+        return
+
+    with _control_publisher_lock:
+        try:
+            if _control_publisher is None:
+                _control_publisher = ControlPublisher()
+            _control_publisher.run_now(id)
+        except Exception:
+            logger.exception("unable to publish run now request for {0}".format(id))
+
+
 def remove_jobs(storage, jobs):
     for job in jobs:
         g.storage.remove_job(job['id'])
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import unittest
+
+from cronq import codec
+
+
+class TestCodec(unittest.TestCase):
+
+    result = {
+        'job_id': 12,
+        'run_id': 'a' * 32,
+        'type': 'finished',
+        'sent_at': 1451606400.25,
+        'host': u'runner-é',
+        'return_code': -15,
+        'run_time': 1.5,
+        'max_rss': 2048,
+    }
+
+    def test_result_round_trips_in_every_format(self):
+        for wire_format in codec.FORMATS:
+            body, properties = codec.encode_result(self.result, wire_format)
+            decoded = codec.decode_result(body, properties.get('content_type'))
+            self.assertEqual(self.result, decoded, wire_format)
+
+    def test_decodes_legacy_result(self):
+        body = json.dumps({
+            'job_id': 12,
+            'run_id': 'a' * 32,
+            'type': 'starting',
+            'start_time': '2016-01-01 00:00:00',
+            'x-send-datetime': '2016-01-01 00:00:00.250000',
+            'x-host': 'runner',
+        })
+        decoded = codec.decode_result(body)
+
+        self.assertEqual(datetime.datetime(2016, 1, 1, 0, 0, 0, 250000),
+                         codec.to_datetime(decoded['sent_at']))
+        self.assertEqual(1451606400, decoded['start_time'])
+        self.assertEqual('runner', decoded['host'])
+
+    def test_decodes_legacy_job(self):
+        decoded = codec.decode_job('{"cmd": "sleep 10", "job_id": 1, "run_id": "1234"}')
+        self.assertEqual({'cmd': 'sleep 10', 'job_id': 1, 'run_id': '1234'}, decoded)
+
+    def test_rejects_malformed_messages(self):
+        body, _ = codec.encode_result(self.result, 'binary')
+        self.assertRaises(codec.DecodeError, codec.decode_result,
+                          body[:-3], codec.CONTENT_TYPE_BINARY)
+        self.assertRaises(codec.DecodeError, codec.decode_job,
+                          body, codec.CONTENT_TYPE_BINARY)
+        self.assertRaises(codec.DecodeError, codec.decode_result, '{"v": 99}')
+        self.assertRaises(codec.DecodeError, codec.decode_result, 'not json')
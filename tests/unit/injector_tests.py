@@ -0,0 +1,174 @@
+import datetime
+import unittest
+
+import mock
+
+from cronq import injector
+from cronq import pacing
+
+
+class FakeStorage(object):
+
+    def __init__(self, rows):
+        self.rows = dict((row[0], row) for row in rows)
+        self.updated_at = datetime.datetime(2014, 1, 1)
+
+    def bootstrap(self):
+        pass
+
+    def job_watermark(self):
+        return (len(self.rows), self.updated_at)
+
+    def job_schedule(self, updated_since=None):
+        return self.rows.values()
+
+    def update(self, row):
+        self.rows[row[0]] = row
+        self.updated_at += datetime.timedelta(seconds=1)
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.first = datetime.datetime(2014, 1, 1, 0, 0)
+        self.second = datetime.datetime(2014, 1, 1, 1, 0)
+        self.storage = FakeStorage([
+            (1, self.second, 0),
+            (2, self.first, 0),
+        ])
+        self.scheduler = injector.Scheduler(self.storage)
+        self.scheduler.load()
+
+    def test_earliest_deadline(self):
+        self.assertEqual(self.first, self.scheduler.next_deadline())
+
+    def test_refresh_replaces_deadline(self):
+        later = datetime.datetime(2014, 1, 1, 2, 0)
+        self.storage.update((2, later, 0))
+        self.scheduler.refresh()
+        self.assertEqual(self.second, self.scheduler.next_deadline())
+
+    def test_run_now_is_due_immediately(self):
+        self.storage.update((1, self.second, 1))
+        self.scheduler.refresh()
+        self.assertEqual(datetime.datetime.min, self.scheduler.next_deadline())
+
+    def test_removed_job_reloads_schedule(self):
+        del self.storage.rows[2]
+        self.scheduler.refresh()
+        self.assertEqual(self.second, self.scheduler.next_deadline())
+
+
+class TestInjectorStop(unittest.TestCase):
+
+    def test_unpublished_jobs_are_flagged_to_run_now(self):
+        publisher = mock.Mock()
+        publisher.publish_many.side_effect = lambda jobs: [False] * len(jobs)
+        pacer = pacing.PacedPublisher(publisher)
+        pacer.publish_many([('default', {'id': 2}, 'a'),
+                            ('default', {'id': 1}, 'b'),
+                            ('default', {'id': 2}, 'c')])
+        storage = mock.Mock()
+        injector.Injector(storage, pacer=pacer).stop()
+
+        self.assertEqual([mock.call(1), mock.call(2)], storage.run_job_now.call_args_list)
+        self.assertEqual(0, pacer.pending())
+
+
+class FakeLeaseStorage(object):
+
+    """Shard leases and injector heartbeats kept in memory, on a fake clock"""
+
+    def __init__(self, num_shards):
+        self.now = 0
+        self.leases = dict((shard, (None, None)) for shard in range(num_shards))
+        self.heartbeats = {}
+
+    def bootstrap(self):
+        pass
+
+    def ensure_shard_leases(self, num_shards):
+        pass
+
+    def _held(self, shard, name):
+        owner, expires_at = self.leases[shard]
+        return owner == name and expires_at >= self.now
+
+    def heartbeat_injector(self, name, ttl):
+        self.heartbeats[name] = self.now
+        return sorted(name for name, at in self.heartbeats.items() if at >= self.now - ttl)
+
+    def renew_shard_leases(self, name, ttl, num_shards):
+        held = [shard for shard in self.leases if self._held(shard, name)]
+        for shard in held:
+            self.leases[shard] = (name, self.now + ttl)
+        return sorted(held)
+
+    def free_shards(self, num_shards):
+        return sorted(shard for shard, (owner, expires_at) in self.leases.items()
+                      if owner is None or expires_at < self.now)
+
+    def claim_shard_lease(self, shard, name, ttl):
+        if shard not in self.free_shards(len(self.leases)):
+            return False
+        self.leases[shard] = (name, self.now + ttl)
+        return True
+
+    def release_shard_leases(self, name, shards):
+        for shard in shards:
+            if self.leases[shard][0] == name:
+                self.leases[shard] = (None, None)
+
+    def owners(self):
+        return dict((shard, owner) for shard, (owner, _) in self.leases.items())
+
+
+class TestShardCoordinator(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = FakeLeaseStorage(4)
+
+    def coordinator(self, name):
+        return injector.ShardCoordinator(self.storage, 4, ttl=30, name=name)
+
+    def test_fair_share(self):
+        coordinators = [injector.ShardCoordinator(self.storage, 10, ttl=30, name=name)
+                        for name in 'abc']
+        self.assertEqual([4, 3, 3], [coordinator.share(['a', 'b', 'c'])
+                                     for coordinator in coordinators])
+        self.assertEqual(0, coordinators[1].share(['a', 'c']))
+
+    def test_rebalance_when_an_injector_joins(self):
+        first, second = self.coordinator('a'), self.coordinator('b')
+        first.rebalance()
+        self.assertEqual([0, 1, 2, 3], first._shards)
+
+        # the newcomer waits until the first one gives up its surplus
+        second.rebalance()
+        self.assertEqual([], second._shards)
+        first.rebalance()
+        second.rebalance()
+        self.assertEqual([0, 1], first._shards)
+        self.assertEqual([2, 3], second._shards)
+        self.assertEqual({0: 'a', 1: 'a', 2: 'b', 3: 'b'}, self.storage.owners())
+
+    def test_expired_leases_are_taken_over(self):
+        first, second = self.coordinator('a'), self.coordinator('b')
+        first.rebalance()
+        second.rebalance()
+        first.rebalance()
+        second.rebalance()
+
+        # the second injector stops renewing
+        self.storage.now += 31
+        first.rebalance()
+        self.assertEqual([0, 1, 2, 3], first._shards)
+        self.assertEqual(set(['a']), set(self.storage.owners().values()))
+
+    def test_leases_released_on_stop(self):
+        coordinator = self.coordinator('a')
+        coordinator.rebalance()
+        injector.Injector(self.storage, coordinator=coordinator).stop()
+
+        self.assertEqual([], coordinator._shards)
+        self.assertEqual([0, 1, 2, 3], self.storage.free_shards(4))
@@ -0,0 +1,120 @@
+import datetime
+import unittest
+
+from cronq import interval_parser
+
+
+class TestAdvanceNextRun(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime(2014, 1, 1, 12, 0, 0)
+        self.interval = datetime.timedelta(minutes=1)
+
+    def test_not_due(self):
+        next_run = self.now + datetime.timedelta(seconds=30)
+        self.assertEqual(
+            (next_run, 0),
+            interval_parser.advance_next_run(next_run, self.interval, self.now))
+
+    def test_on_time(self):
+        next_run = self.now - datetime.timedelta(seconds=1)
+        self.assertEqual(
+            (next_run + self.interval, 1),
+            interval_parser.advance_next_run(next_run, self.interval, self.now))
+
+    def test_catch_up_matches_stepping(self):
+        next_run = self.now - datetime.timedelta(days=3, seconds=7)
+        stepped, due = next_run, 0
+        while stepped < self.now:
+            stepped += self.interval
+            due += 1
+        self.assertEqual(
+            (stepped, due),
+            interval_parser.advance_next_run(next_run, self.interval, self.now))
+
+    def test_exact_boundary(self):
+        next_run = self.now - datetime.timedelta(minutes=5)
+        self.assertEqual(
+            (self.now, 5),
+            interval_parser.advance_next_run(next_run, self.interval, self.now))
+
+    def test_zero_interval(self):
+        next_run = self.now - datetime.timedelta(minutes=5)
+        self.assertEqual(
+            (self.now, 1),
+            interval_parser.advance_next_run(
+                next_run, datetime.timedelta(0), self.now))
+
+
+class TestRunsForCatchup(unittest.TestCase):
+
+    def test_once(self):
+        self.assertEqual(1, interval_parser.runs_for_catchup('once', 1))
+        self.assertEqual(1, interval_parser.runs_for_catchup('once', 500))
+
+    def test_skip(self):
+        self.assertEqual(1, interval_parser.runs_for_catchup('skip', 1))
+        self.assertEqual(0, interval_parser.runs_for_catchup('skip', 2))
+
+    def test_replay(self):
+        self.assertEqual(3, interval_parser.runs_for_catchup('replay', 3, 10))
+        self.assertEqual(10, interval_parser.runs_for_catchup('replay', 500, 10))
+
+    def test_nothing_due(self):
+        self.assertEqual(0, interval_parser.runs_for_catchup('replay', 0, 10))
+
+
+class TestCompileSchedule(unittest.TestCase):
+
+    def test_interval(self):
+        schedule = interval_parser.compile_schedule('R/2013-05-29T00:00:00/PT5M')
+        self.assertEqual(datetime.timedelta(minutes=5), schedule.interval)
+        self.assertEqual(
+            datetime.datetime(2014, 1, 1, 12, 5),
+            schedule.next_after(datetime.datetime(2014, 1, 1, 12, 0)))
+
+    def test_months_do_not_drift(self):
+        schedule = interval_parser.compile_schedule('R/2013-01-31T00:00:00/P1M')
+        runs, run = [], datetime.datetime(2013, 1, 31)
+        for _ in xrange(3):
+            run = schedule.next_after(run)
+            runs.append(run)
+        self.assertEqual([
+            datetime.datetime(2013, 2, 28),
+            datetime.datetime(2013, 3, 31),
+            datetime.datetime(2013, 4, 30),
+        ], runs)
+
+    def test_cron(self):
+        schedule = interval_parser.compile_schedule('*/15 9-17 * * mon-fri')
+        # friday evening to monday morning
+        self.assertEqual(
+            datetime.datetime(2026, 10, 19, 9, 0),
+            schedule.next_after(datetime.datetime(2026, 10, 16, 17, 50)))
+
+    def test_cron_day_of_month_or_day_of_week(self):
+        schedule = interval_parser.compile_schedule('0 0 13 * fri')
+        self.assertEqual(
+            datetime.datetime(2026, 1, 2),
+            schedule.next_after(datetime.datetime(2026, 1, 1)))
+
+    def test_invalid(self):
+        for text in ['0 0 30 2 *', '61 * * * *', '* * *', 'R/2013-05-29T00:00:00/PT0S']:
+            self.assertRaises(ValueError, interval_parser.compile_schedule, text)
+
+    def test_advance_counts_up_to_limit(self):
+        schedule = interval_parser.compile_schedule('@hourly')
+        self.assertEqual(
+            (datetime.datetime(2026, 1, 2, 1, 0), 11),
+            schedule.advance(datetime.datetime(2026, 1, 1),
+                             datetime.datetime(2026, 1, 2, 0, 30), 11))
+
+    def test_next_runs(self):
+        after = datetime.datetime(2014, 1, 1, 12, 0, 30)
+        self.assertEqual(
+            [datetime.datetime(2014, 1, 1, 12, 1),
+             datetime.datetime(2014, 1, 2),
+             datetime.datetime(2014, 1, 1, 12, 1)],
+            interval_parser.next_runs(
+                ['R/2013-05-29T00:00:00/PT1M', '@daily', 'R/2013-05-29T00:00:00/PT1M'],
+                after))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from cronq.logger import job_log
+
+
+class TestJobLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'a-job.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        with open(self.filename, 'rb') as f:
+            return f.read()
+
+    def test_buffers_until_size(self):
+        log = job_log.JobLog(self.filename, buffer_size=10, flush_interval=60, max_bytes=0)
+        log.write(u'caf\xe9')
+        self.assertFalse(os.path.exists(self.filename))
+        log.write(u'second')
+        self.assertEqual('caf\xc3\xa9\nsecond\n', self.read())
+        log.close()
+
+    def test_close_flushes(self):
+        log = job_log.JobLog(self.filename, buffer_size=1024, flush_interval=60, max_bytes=0)
+        log.write(u'line')
+        log.close()
+        self.assertEqual('line\n', self.read())
+
+    def test_rotates_and_compresses(self):
+        log = job_log.JobLog(self.filename, buffer_size=0, flush_interval=60,
+                             max_bytes=8, backup_count=2)
+        for i in xrange(6):
+            log.write(u'line {0}'.format(i))
+        log.write(u'tail')
+        log.close()
+
+        for _ in xrange(40):
+            segments = sorted(name for name in os.listdir(self.directory)
+                              if name.endswith('.gz'))
+            if len(segments) == 2 and len(os.listdir(self.directory)) == 3:
+                break
+            time.sleep(0.05)
+
+        self.assertEqual(2, len(segments))
+        contents = [gzip.open(os.path.join(self.directory, name)).read()
+                    for name in segments]
+        self.assertEqual(['line 2\nline 3\n', 'line 4\nline 5\n'], contents)
+        self.assertEqual('tail\n', self.read())
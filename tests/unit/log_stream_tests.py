@@ -0,0 +1,53 @@
+import unittest
+
+from cronq.logger.log_stream import LogStream
+
+
+class FakeClock(object):
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestLogStream(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.chunks = []
+        self.stream = LogStream(self.send, chunk_size=10, interval=1,
+                                max_buffer=20, clock=self.clock)
+
+    def send(self, chunk, size):
+        self.chunks.append((chunk, size))
+
+    def test_chunks_by_size(self):
+        self.stream.write(u'abcd')
+        self.assertEqual([], self.chunks)
+        self.stream.write(u'efgh')
+        self.assertEqual(u'abcd\nefgh', self.chunks[0][0]['output'])
+        self.assertEqual(10, self.chunks[0][1])
+
+    def test_chunks_by_time(self):
+        self.stream.write(u'a')
+        self.stream.flush_if_due()
+        self.assertEqual([], self.chunks)
+        self.clock.now = 1
+        self.stream.flush_if_due()
+        self.assertEqual(u'a', self.chunks[0][0]['output'])
+
+    def test_drops_while_chunks_are_in_flight(self):
+        for line in [u'aaaaaaaaa', u'bbbbbbbbb', u'c', u'd']:
+            self.stream.write(line)
+        self.assertEqual(2, len(self.chunks))
+
+        self.stream.sent(self.chunks[0][1])
+        self.stream.write(u'e')
+        self.stream.close()
+        last = self.chunks[-1][0]
+        self.assertEqual(u'e', last['output'])
+        self.assertEqual(2, last['dropped'])
+        self.assertTrue(last['final'])
+        self.assertEqual(2, last['seq'])
@@ -0,0 +1,45 @@
+import unittest
+
+from cronq import metrics
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_buckets_are_cumulative(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram('lag_seconds', 'Lag', buckets=(1, 5, 10))
+        for value in (0.5, 2, 3, 20):
+            histogram.observe(value)
+
+        cumulative, count, total = histogram.snapshot()
+        self.assertEqual(cumulative, [1, 3, 3])
+        self.assertEqual(count, 4)
+        self.assertEqual(total, 25.5)
+
+    def test_render(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram('lag_seconds', 'Lag', buckets=(1,))
+        histogram.observe(2)
+
+        lines = registry.render().splitlines()
+        self.assertEqual(lines, [
+            '# HELP lag_seconds Lag',
+            '# TYPE lag_seconds histogram',
+            'lag_seconds_bucket{le="1"} 0',
+            'lag_seconds_bucket{le="+Inf"} 1',
+            'lag_seconds_sum 2.0',
+            'lag_seconds_count 1',
+        ])
+
+    def test_statsd(self):
+        registry = metrics.Registry()
+        sent = []
+
+        class Client(object):
+            def send(self, name, value, is_timing):
+                sent.append((name, value, is_timing))
+
+        registry.statsd = Client()
+        registry.histogram('cycle_seconds', 'Cycle').observe(0.25)
+        registry.histogram('claimed', 'Claimed', metrics.COUNT_BUCKETS).observe(3)
+        self.assertEqual(sent, [('cycle_seconds', 0.25, True), ('claimed', 3, False)])
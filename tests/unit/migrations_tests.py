@@ -0,0 +1,104 @@
+import unittest
+
+import mock
+
+from cronq.backends import migrations
+from cronq.models.job import Job
+from cronq.models.schema_migration import SchemaMigration
+
+from sqlalchemy import CHAR
+from sqlalchemy import Column
+from sqlalchemy import create_engine
+from sqlalchemy import DateTime
+from sqlalchemy import inspect
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import Table
+
+
+class TestMigrate(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        SchemaMigration.__table__.create(self.engine)
+        self.applied = []
+
+    def migration(self, number):
+        return (number, 'migration {0}'.format(number),
+                lambda engine: self.applied.append(number))
+
+    def recorded(self):
+        return [row.version for row in self.engine.execute(
+            SchemaMigration.__table__.select().order_by(SchemaMigration.version))]
+
+    def test_applies_new_versions_in_order(self):
+        with mock.patch.object(migrations, 'MIGRATIONS',
+                               [self.migration(1), self.migration(2)]):
+            migrations.migrate(self.engine)
+        self.assertEqual([1, 2], self.applied)
+        self.assertEqual([1, 2], self.recorded())
+        self.assertEqual(2, migrations.current_version(self.engine))
+
+    def test_skips_applied_versions(self):
+        with mock.patch.object(migrations, 'MIGRATIONS', [self.migration(1)]):
+            migrations.migrate(self.engine)
+        with mock.patch.object(migrations, 'MIGRATIONS',
+                               [self.migration(1), self.migration(2)]):
+            migrations.migrate(self.engine)
+            migrations.migrate(self.engine)
+        self.assertEqual([1, 2], self.applied)
+
+    def test_version_recorded_concurrently(self):
+        self.engine.execute(SchemaMigration.__table__.insert().values(
+            version=1, description='migration 1'))
+        # another process applied it after this one read the version
+        with mock.patch.object(migrations, 'current_version', return_value=0):
+            with mock.patch.object(migrations, 'MIGRATIONS', [self.migration(1)]):
+                migrations.migrate(self.engine)
+        self.assertEqual([1], self.applied)
+        self.assertEqual([1], self.recorded())
+
+
+class TestSchemaChanges(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        # the jobs table as an older release created it
+        Table('jobs', MetaData(),
+              Column('id', Integer, primary_key=True),
+              Column('name', CHAR(255)),
+              Column('next_run', DateTime()),
+              Column('run_now', Integer),
+              Column('updated_at', DateTime())).create(self.engine)
+
+    def columns(self):
+        return [column['name'] for column in inspect(self.engine).get_columns('jobs')]
+
+    def indexes(self):
+        return sorted(index['name'] for index in inspect(self.engine).get_indexes('jobs'))
+
+    def test_add_columns_is_idempotent(self):
+        migrations.add_columns(self.engine, Job, ['name', 'jitter', 'schedule'])
+        migrations.add_columns(self.engine, Job, ['jitter', 'schedule'])
+        self.assertEqual(['id', 'name', 'next_run', 'run_now', 'updated_at', 'jitter', 'schedule'],
+                         self.columns())
+
+    def test_add_indexes_is_idempotent(self):
+        migrations.add_indexes(self.engine, Job, ['ix_jobs_next_run'])
+        migrations.add_indexes(self.engine, Job, ['ix_jobs_next_run', 'ix_jobs_run_now'])
+        self.assertEqual(['ix_jobs_next_run', 'ix_jobs_run_now'], self.indexes())
+
+
+class TestJobSchedulingColumns(unittest.TestCase):
+
+    def test_backfills_update_times(self):
+        engine = create_engine('sqlite://')
+        # the jobs table before it had scheduling columns
+        Table('jobs', MetaData(),
+              Column('id', Integer, primary_key=True),
+              Column('name', CHAR(255))).create(engine)
+        engine.execute("INSERT INTO jobs (name) VALUES ('job')")
+
+        migrations._job_scheduling_columns(engine)
+        updated_at, = engine.execute('SELECT updated_at FROM jobs').fetchone()
+        self.assertIsNotNone(updated_at)
@@ -0,0 +1,146 @@
+import datetime
+import unittest
+
+from cronq import pacing
+
+
+class FakeClock(object):
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class RecordingPublisher(object):
+
+    def __init__(self):
+        self.published = []
+        self.fail = False
+
+    def publish_many(self, jobs):
+        if self.fail:
+            return [False] * len(jobs)
+        self.published.extend(jobs)
+        return [True] * len(jobs)
+
+
+def scheduled(seconds):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=seconds)
+
+
+class TestJitterOffset(unittest.TestCase):
+
+    def test_deterministic(self):
+        self.assertEqual(pacing.jitter_offset(42, 60), pacing.jitter_offset(42, 60))
+
+    def test_within_window(self):
+        for job_id in range(200):
+            offset = pacing.jitter_offset(job_id, 60)
+            self.assertTrue(0 <= offset <= 60)
+
+    def test_no_window(self):
+        self.assertEqual(0, pacing.jitter_offset(42, 0))
+
+
+class TestParseRateLimits(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(
+            {'slow': (5.0, 10.0), '*': (100.0, 100.0)},
+            pacing.parse_rate_limits('slow=5:10, *=100'))
+
+    def test_empty(self):
+        self.assertEqual({}, pacing.parse_rate_limits(None))
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        clock = FakeClock()
+        bucket = pacing.TokenBucket(2, 3, clock=clock)
+        self.assertEqual([True, True, True, False],
+                         [bucket.take() for _ in range(4)])
+        self.assertAlmostEqual(0.5, bucket.wait_time())
+        clock.now = 0.5
+        self.assertTrue(bucket.take())
+
+
+class TestPacedPublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(100.0)
+        self.publisher = RecordingPublisher()
+
+    def test_jitter_delays_release(self):
+        paced = pacing.PacedPublisher(self.publisher, jitter_window=60, clock=self.clock)
+        job = {'id': 7, 'scheduled_at': scheduled(100)}
+        paced.publish('default', job, 'run')
+        offset = pacing.jitter_offset(7, 60)
+
+        paced.flush()
+        self.assertEqual([], self.publisher.published)
+        self.assertAlmostEqual(offset, paced.next_release())
+
+        self.clock.now = 100.0 + offset
+        paced.flush()
+        self.assertEqual([('default', job, 'run')], self.publisher.published)
+        self.assertEqual(None, paced.next_release())
+
+    def test_run_now_is_not_jittered(self):
+        paced = pacing.PacedPublisher(self.publisher, jitter_window=60, clock=self.clock)
+        paced.publish('default', {'id': 7, 'scheduled_at': None}, 'run')
+        paced.flush()
+        self.assertEqual(1, len(self.publisher.published))
+
+    def test_rate_limit_per_routing_key(self):
+        paced = pacing.PacedPublisher(self.publisher,
+                                      rate_limits={'slow': (1, 2)},
+                                      clock=self.clock)
+        paced.publish_many([('slow', {'id': i}, str(i)) for i in range(5)])
+        paced.publish_many([('fast', {'id': i}, str(i)) for i in range(5)])
+        paced.flush()
+        keys = [routing_key for routing_key, _, _ in self.publisher.published]
+        self.assertEqual(2, keys.count('slow'))
+        self.assertEqual(5, keys.count('fast'))
+        self.assertAlmostEqual(1.0, paced.next_release())
+
+        self.clock.now += 1
+        paced.flush()
+        self.assertEqual(8, len(self.publisher.published))
+
+    def test_force_flush(self):
+        paced = pacing.PacedPublisher(self.publisher,
+                                      jitter_window=60,
+                                      rate_limits={'*': (1, 1)},
+                                      clock=self.clock)
+        paced.publish_many([('slow', {'id': i, 'scheduled_at': scheduled(100)}, str(i))
+                            for i in range(5)])
+        paced.flush(force=True)
+        self.assertEqual(5, len(self.publisher.published))
+        self.assertEqual(0, paced.pending())
+
+    def test_failed_publish_is_retried_in_order(self):
+        paced = pacing.PacedPublisher(self.publisher, clock=self.clock)
+        jobs = [('default', {'id': i}, str(i)) for i in range(3)]
+        paced.publish_many(jobs)
+
+        self.publisher.fail = True
+        self.assertEqual([False] * 3, paced.flush())
+        self.assertEqual(3, paced.pending())
+
+        self.publisher.fail = False
+        paced.flush()
+        self.assertEqual(jobs, self.publisher.published)
+        self.assertEqual(0, paced.pending())
+
+    def test_take_pending(self):
+        paced = pacing.PacedPublisher(self.publisher, jitter_window=60, clock=self.clock)
+        paced.publish('default', {'id': 1, 'scheduled_at': scheduled(100)}, 'a')
+        self.publisher.fail = True
+        paced.publish('default', {'id': 2}, 'b')
+        paced.flush()
+
+        self.assertEqual([1, 2], sorted(job['id'] for _, job, _ in paced.take_pending()))
+        self.assertEqual(0, paced.pending())
@@ -0,0 +1,74 @@
+import json
+import unittest
+import uuid
+
+import mock
+
+from cronq.rabbit_connection import result_queue
+from cronq.result_aggregator import CronqAggregator
+from cronq.result_aggregator import parse_partitions
+from cronq.result_aggregator import result_queues
+
+
+class TestBatchedAggregator(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch('cronq.result_aggregator.Storage'):
+            self.aggregator = CronqAggregator(batch_size=10)
+        self.aggregator._connection = mock.Mock()
+        self.aggregator._channel = mock.Mock()
+
+    def message(self, tag, **body):
+        data = {
+            'job_id': 1,
+            'run_id': uuid.uuid4().hex,
+            'type': 'finished',
+            'return_code': 0,
+            'x-send-datetime': '2016-01-01 00:00:00',
+            'x-host': 'runner',
+        }
+        data.update(body)
+        msg = mock.Mock()
+        msg.body = json.dumps(data)
+        msg.delivery_info = {'delivery_tag': tag}
+        return msg
+
+    def test_batch_is_stored_and_acked_at_once(self):
+        self.aggregator.buffer_result(self.message(1, job_id=1, type='starting'))
+        self.aggregator.buffer_result(self.message(2, job_id=1))
+        self.aggregator.buffer_result(self.message(3, job_id=2))
+        self.aggregator.flush()
+
+        results = list(self.aggregator.storage.add_results.call_args[0][0])
+        self.assertEqual([(1, 'starting'), (1, 'finished'), (2, 'finished')],
+                         [(result['job_id'], result['type']) for result in results])
+        self.aggregator.channel.basic.ack.assert_called_once_with(3, multiple=True)
+
+    def test_malformed_result_is_rejected(self):
+        msg = mock.Mock()
+        msg.body = 'not json'
+        msg.delivery_info = {'delivery_tag': 1}
+        self.aggregator.buffer_result(msg)
+
+        self.aggregator.channel.basic.reject.assert_called_once_with(1, requeue=False)
+        self.aggregator.flush()
+        self.assertFalse(self.aggregator.storage.add_results.called)
+
+
+class TestResultPartitions(unittest.TestCase):
+
+    def test_unpartitioned(self):
+        self.assertEqual(['cronq_results'], result_queues(0))
+
+    def test_all_partitions_by_default(self):
+        self.assertEqual(['cronq_results.0', 'cronq_results.1', 'cronq_results.2'],
+                         result_queues(3))
+
+    def test_partition_spec(self):
+        self.assertEqual([0, 2, 3], parse_partitions('3, 0,2-3', 4))
+        self.assertRaises(ValueError, parse_partitions, '2-4', 4)
+
+    def test_job_results_share_a_partition(self):
+        self.assertEqual('cronq_results', result_queue(7, 0))
+        self.assertEqual('cronq_results.3', result_queue(7, 4))
+        self.assertEqual(result_queue(11, 4), result_queue(7, 4))
@@ -0,0 +1,101 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from cronq import result_spool
+from cronq.result_spool import ResultSpool
+from cronq.result_spool import SpoolLocked
+
+
+class TestResultSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'results.spool')
+        self.published = []
+        self.confirm = None
+
+    def publish_many(self, messages):
+        results = []
+        for exchange, routing_key, headers, body in messages:
+            success = self.confirm is None or self.confirm(json.loads(body))
+            if success:
+                self.published.append(json.loads(body)['run_id'])
+            results.append(success)
+        return results
+
+    def open_spool(self):
+        spool = ResultSpool(self.path, self.publish_many, batch_size=2, retry_interval=0.1)
+        self.addCleanup(spool.stop)
+        return spool
+
+    def test_publishes_in_order_and_truncates(self):
+        spool = self.open_spool()
+        for run_id in 'abc':
+            spool.append({'run_id': run_id})
+
+        self.assertTrue(spool.flush())
+        self.assertTrue(spool.flush())
+        self.assertEqual(['a', 'b', 'c'], self.published)
+        self.assertEqual(0, spool.unsent())
+        self.assertEqual(0, os.path.getsize(self.path))
+
+    def test_unconfirmed_results_are_replayed_after_restart(self):
+        spool = self.open_spool()
+        for run_id in 'abc':
+            spool.append({'run_id': run_id})
+        self.confirm = lambda body: body['run_id'] != 'b'
+
+        self.assertFalse(spool.flush())
+        self.assertEqual(['a'], self.published)
+        spool.stop()
+
+        self.confirm = None
+        spool = self.open_spool()
+        self.assertTrue(spool.flush())
+        self.assertTrue(spool.flush())
+        self.assertEqual(['a', 'b', 'c'], self.published)
+
+    def test_routes_each_result(self):
+        spool = ResultSpool(self.path, self.publish_many, batch_size=2,
+                            route=lambda result: 'cronq_results.{0}'.format(result['job_id'] % 2))
+        self.addCleanup(spool.stop)
+        spool.append({'run_id': 'a', 'job_id': 3})
+        spool.append({'run_id': 'b', 'job_id': 4})
+
+        messages = [spool._message(line) for line in spool._read_batch()]
+        self.assertEqual(['cronq_results.1', 'cronq_results.0'],
+                         [routing_key for _, routing_key, _, _ in messages])
+
+    def test_compacts_published_head(self):
+        spool = self.open_spool()
+        for run_id in 'abc':
+            spool.append({'run_id': run_id})
+
+        with mock.patch.object(result_spool, 'COMPACT_BYTES', 1):
+            spool.flush()
+        with open(self.path) as spool_file:
+            self.assertEqual([{'run_id': 'c'}], [json.loads(line) for line in spool_file])
+
+        spool.append({'run_id': 'd'})
+        spool.flush()
+        self.assertEqual(['a', 'b', 'c', 'd'], self.published)
+
+    def test_one_runner_per_spool(self):
+        self.open_spool()
+        self.assertRaises(SpoolLocked, ResultSpool, self.path, self.publish_many)
+
+    def test_flusher_thread_publishes(self):
+        spool = self.open_spool()
+        spool.start()
+        spool.append({'run_id': 'a'})
+        for _ in xrange(50):
+            if self.published:
+                break
+            spool._stopped.wait(0.05)
+        self.assertEqual(['a'], self.published)
@@ -0,0 +1,167 @@
+import json
+import os
+import subprocess
+import tempfile
+import time
+import unittest
+
+import mock
+
+from cronq import runner
+from cronq.config import Config
+from cronq.models.event import Event
+
+
+class TestRunnerSlots(unittest.TestCase):
+
+    def setUp(self):
+        self.log_path = Config.LOG_PATH
+        Config.LOG_PATH = tempfile.mkdtemp()
+        self.runner = runner.CronqRunner(slots=2)
+        self.runner._connection = mock.Mock()
+        self.runner._channel = mock.Mock()
+        self.runner._start_slots()
+
+    def tearDown(self):
+        Config.LOG_PATH = self.log_path
+
+    def message(self, tag):
+        msg = mock.Mock()
+        msg.body = json.dumps({'cmd': 'true', 'job_id': 1, 'run_id': 'run', 'name': 'a job'})
+        msg.delivery_info = {'delivery_tag': tag}
+        return msg
+
+    def wait_for_ack(self):
+        for _ in xrange(100):
+            self.runner._drain_outbox()
+            if self.runner.channel.basic.ack.called:
+                return
+            time.sleep(0.05)
+
+    def test_job_runs_off_the_consuming_thread(self):
+        self.runner.run_something(self.message(7))
+        self.assertFalse(self.runner.channel.basic.publish.called)
+
+        self.wait_for_ack()
+        self.runner.channel.basic.ack.assert_called_once_with(7)
+        results = [json.loads(call[0][0].body)['type']
+                   for call in self.runner.channel.basic.publish.call_args_list]
+        self.assertEqual(['starting', 'finished'], results)
+
+    def test_ack_dropped_after_reconnect(self):
+        self.runner._settle(mock.Mock(), self.message(7), True)
+        self.assertFalse(self.runner.channel.basic.ack.called)
+
+    def test_keep_alive_heartbeats_while_idle(self):
+        self.runner.heartbeat = 10
+        self.runner._keep_alive(time.time() - 5)
+        self.runner.connection.channel(0).send_heartbeat.assert_called_once_with()
+        self.assertFalse(self.runner.connection.transport_closed.called)
+
+    def test_keep_alive_drops_silent_connection(self):
+        self.runner.heartbeat = 10
+        self.runner._keep_alive(time.time() - 25)
+        self.assertTrue(self.runner.connection.transport_closed.called)
+
+
+class TestIterOutputLines(unittest.TestCase):
+
+    def run_command(self, command):
+        process = subprocess.Popen(command, shell=True,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return list(runner.iter_output_lines(process, idle_timeout=0.1)), process
+
+    def test_lines_are_decoded(self):
+        lines, process = self.run_command("printf 'caf\\303\\251\\nna\\357ve\\nlast'")
+        self.assertEqual([u'caf\xe9', u'na\xefve', u'last'], lines)
+        self.assertEqual(0, process.returncode)
+
+    def test_background_process_holding_output(self):
+        start = time.time()
+        lines, process = self.run_command('echo started; sleep 5 &')
+        self.assertEqual([u'started'], lines)
+        self.assertLess(time.time() - start, 4)
+
+    def test_reaps_with_resource_usage(self):
+        lines, process = self.run_command('echo done; kill -9 $$')
+        self.assertEqual([u'done'], lines)
+        self.assertEqual(-9, process.returncode)
+        usage = runner.resource_usage(process.rusage)
+        self.assertEqual(sorted(Event.RESOURCE_FIELDS), sorted(usage))
+
+    def test_timeout_kills_process_group(self):
+        process = subprocess.Popen('(trap "" TERM; sleep 30) & sleep 30', shell=True,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   preexec_fn=os.setsid)
+        lines = runner.iter_output_lines(process, deadline=time.time() + 0.2)
+        self.assertRaises(runner.JobTimedOut, list, lines)
+
+        runner.terminate_process_group(process, grace=1)
+        self.assertEqual(-15, process.returncode)
+        self.assert_group_gone(process)
+
+    def test_timeout_after_output_is_closed(self):
+        start = time.time()
+        process = subprocess.Popen('echo started; exec sleep 30 > /dev/null 2>&1', shell=True,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   preexec_fn=os.setsid)
+        lines = []
+        with self.assertRaises(runner.JobTimedOut):
+            for line in runner.iter_output_lines(process, deadline=time.time() + 0.5):
+                lines.append(line)
+        self.assertEqual([u'started'], lines)
+        self.assertLess(time.time() - start, 5)
+
+        runner.terminate_process_group(process, grace=1)
+        self.assert_group_gone(process)
+
+    def assert_group_gone(self, process):
+        # orphans linger as zombies until init reaps them
+        states = subprocess.check_output(['ps', '-eo', 'pgid=,stat=']).splitlines()
+        alive = [state for pgid, state in (line.split() for line in states)
+                 if int(pgid) == process.pid and not state.startswith('Z')]
+        self.assertEqual([], alive)
+
+
+class TestRunLock(unittest.TestCase):
+
+    def test_second_lock_is_refused_until_released(self):
+        filename = tempfile.mktemp(suffix='.lock')
+        self.addCleanup(os.remove, filename)
+
+        first = runner.acquire_run_lock(filename)
+        self.assertIsNotNone(first)
+        self.assertIsNone(runner.acquire_run_lock(filename))
+
+        first.close()
+        second = runner.acquire_run_lock(filename)
+        self.assertIsNotNone(second)
+        second.close()
+
+    def test_wait_for_lock_is_bounded(self):
+        filename = tempfile.mktemp(suffix='.lock')
+        self.addCleanup(os.remove, filename)
+        first = runner.acquire_run_lock(filename)
+        self.addCleanup(first.close)
+
+        start = time.time()
+        self.assertIsNone(runner.acquire_run_lock(filename, wait=0.3))
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertLess(time.time() - start, 2)
+
+    def test_queue_one_run_is_skipped_after_waiting(self):
+        log_path = Config.LOG_PATH
+        Config.LOG_PATH = tempfile.mkdtemp()
+        self.addCleanup(setattr, Config, 'LOG_PATH', log_path)
+        held = runner.acquire_run_lock('{0}/a-job.lock'.format(Config.LOG_PATH))
+        self.addCleanup(held.close)
+
+        cronq_runner = runner.CronqRunner()
+        with mock.patch.object(cronq_runner, 'publish_result') as publish_result:
+            with mock.patch.object(cronq_runner, '_run_job') as run_job:
+                self.assertTrue(cronq_runner.run_job({
+                    'cmd': 'true', 'job_id': 1, 'run_id': 'run', 'name': 'a job',
+                    'overlap': 'queue_one', 'timeout': 0.2,
+                }))
+        self.assertFalse(run_job.called)
+        publish_result.assert_called_once_with({'job_id': 1, 'run_id': 'run', 'type': 'skipped'})
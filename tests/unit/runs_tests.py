@@ -0,0 +1,47 @@
+import datetime
+import unittest
+
+from cronq.backends.runs import apply_result
+from cronq.backends.runs import new_run
+
+
+class TestApplyResult(unittest.TestCase):
+
+    def setUp(self):
+        self.start = datetime.datetime(2016, 1, 1)
+
+    def result(self, seconds, type, return_code=None, **resources):
+        return {
+            'job_id': 1,
+            '_datetime': self.start + datetime.timedelta(seconds=seconds),
+            'run_id': 'run',
+            'type': type,
+            'host': 'runner',
+            'return_code': return_code,
+            'resources': resources,
+        }
+
+    def apply(self, *results):
+        run = new_run('run', 1)
+        for result in results:
+            apply_result(run, result)
+        return run
+
+    def test_finished_run(self):
+        run = self.apply(self.result(0, 'starting'),
+                         self.result(3, 'finished', 0, cpu_user=1.5))
+        self.assertEqual(('succeeded', 0, 3.0, 1.5), (
+            run['status'], run['return_code'], run['duration'], run['cpu_user']))
+        self.assertEqual(self.start, run['created_at'])
+
+    def test_order_and_duplicates_do_not_matter(self):
+        results = [self.result(0, 'starting'), self.result(3, 'finished', 1)]
+        expected = self.apply(*results)
+        self.assertEqual('failed', expected['status'])
+        self.assertEqual(expected, self.apply(*reversed(results)))
+        self.assertEqual(expected, self.apply(results[1], results[0], results[1]))
+
+    def test_running_run(self):
+        run = self.apply(self.result(0, 'starting'))
+        self.assertEqual(('starting', None, None), (
+            run['status'], run['completed_at'], run['duration']))
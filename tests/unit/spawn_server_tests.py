@@ -0,0 +1,74 @@
+import Queue
+import subprocess
+import time
+import unittest
+
+from cronq import runner
+from cronq.spawn_server import SpawnServer
+
+
+class FirstReplyIsLate(object):
+
+    """Replies where the first one only arrives after its request timed out"""
+
+    def __init__(self, replies):
+        self.replies = replies
+        self.timed_out = False
+
+    def get(self, timeout=None):
+        if not self.timed_out:
+            self.timed_out = True
+            self.replies.put(self.replies.get(timeout=timeout))
+            raise Queue.Empty()
+        return self.replies.get(timeout=timeout)
+
+
+class TestSpawnServer(unittest.TestCase):
+
+    def setUp(self):
+        self.spawn_server = SpawnServer()
+        self.addCleanup(self.spawn_server.stop)
+
+    def test_output_and_exit_status(self):
+        process = self.spawn_server.spawn('echo out; echo err >&2; exit 3')
+        lines = list(runner.iter_output_lines(process))
+
+        self.assertEqual([u'out', u'err'], lines)
+        self.assertEqual(3, process.returncode)
+        self.assertIn('cpu_user', runner.resource_usage(process.rusage))
+
+    def test_timeout_kills_process_group(self):
+        process = self.spawn_server.spawn('(trap "" TERM; sleep 30) & sleep 30')
+        lines = runner.iter_output_lines(process, deadline=time.time() + 0.2)
+        self.assertRaises(runner.JobTimedOut, list, lines)
+
+        runner.terminate_process_group(process, grace=1)
+        self.assertEqual(-15, process.returncode)
+
+    def test_helper_is_restarted(self):
+        self.spawn_server.start()
+        self.spawn_server._helper.kill()
+        self.spawn_server._helper.wait()
+
+        process = self.spawn_server.spawn('echo again')
+        self.assertEqual([u'again'], list(runner.iter_output_lines(process)))
+
+    def test_command_of_timed_out_request_is_killed(self):
+        self.spawn_server.start()
+        self.spawn_server._replies = FirstReplyIsLate(self.spawn_server._replies)
+        self.assertRaises(OSError, self.spawn_server.spawn, 'exec sleep 31.5')
+
+        # the late reply is read by the next request
+        process = self.spawn_server.spawn('echo again')
+        self.assertEqual([u'again'], list(runner.iter_output_lines(process)))
+        for _ in xrange(50):
+            if not self.sleeping():
+                break
+            time.sleep(0.05)
+        self.assertEqual([], self.sleeping())
+        self.assertEqual({}, self.spawn_server._processes)
+
+    def sleeping(self):
+        processes = subprocess.check_output(['ps', '-eo', 'stat=,args=']).splitlines()
+        return [line for line in processes
+                if line.split(None, 1)[1:] == ['sleep 31.5'] and not line.startswith('Z')]
@@ -0,0 +1,324 @@
+import datetime
+import unittest
+
+import mock
+
+from cronq.backends.mysql import STATUS_UPDATE_ATTEMPTS
+from cronq.backends.mysql import Storage
+from cronq.models.job import Job
+
+from sqlalchemy import event
+from sqlalchemy.dialects import mysql
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+
+class TestMergeStatusUpdates(unittest.TestCase):
+
+    def setUp(self):
+        # no database is needed to plan the updates
+        self.storage = Storage.__new__(Storage)
+        self.start = datetime.datetime(2016, 1, 1)
+
+    def result(self, job_id, seconds, type, return_code=None):
+        return {
+            'job_id': job_id,
+            '_datetime': self.start + datetime.timedelta(seconds=seconds),
+            'run_id': 'run',
+            'type': type,
+            'return_code': return_code,
+        }
+
+    def test_newest_result_per_job_with_its_start(self):
+        updates = dict(self.storage._merge_status_updates([
+            self.result(1, 0, 'starting'),
+            self.result(2, 0, 'starting'),
+            self.result(1, 3, 'finished', 1),
+            self.result(1, 4, 'skipped'),
+        ]))
+
+        finished, = updates['finish']
+        self.assertEqual((1, 'failed', self.start), (
+            finished['job'], finished['status'], finished['started_at']))
+        started, = updates['start']
+        self.assertEqual((2, 'starting'), (started['job'], started['status']))
+
+    def test_finish_wins_a_tie_with_a_start(self):
+        updates = dict(self.storage._merge_status_updates([
+            self.result(1, 0, 'finished', 0),
+            self.result(1, 0, 'starting'),
+        ]))
+        self.assertEqual(['finish'], updates.keys())
+        self.assertEqual('succeeded', updates['finish'][0]['status'])
+
+
+class SqliteStorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch('cronq.backends.mysql.Config.DATABASE_URL', 'sqlite://'):
+            self.storage = Storage(publisher=mock.Mock(), isolation_level=None)
+        self.addCleanup(self.storage.close)
+        # enforce foreign keys like InnoDB does
+        event.listen(self.storage._engine, 'connect',
+                     lambda connection, record: connection.execute('PRAGMA foreign_keys=ON'))
+        self.storage.bootstrap()
+
+
+class TestRemoveJob(SqliteStorageTestCase):
+
+    def test_remove_job_that_ran(self):
+        self.storage.add_job('job', 60, 'true', datetime.datetime.utcnow(), category_id=None)
+        job_id = self.storage.jobs().next()['id']
+        self.storage.add_event(job_id, datetime.datetime.utcnow(), 'a' * 32, 'finished', 'host', 0)
+        self.assertEqual(1, len(self.storage.runs_for_job(job_id, 20)))
+
+        self.storage.remove_job(job_id)
+        self.assertEqual([], list(self.storage.jobs()))
+        self.assertEqual([], self.storage.runs_for_job(job_id, 20))
+
+
+class TestStatusStatements(SqliteStorageTestCase):
+
+    def setUp(self):
+        super(TestStatusStatements, self).setUp()
+        self.storage.add_job('job', 3600, 'true', datetime.datetime.utcnow(),
+                             category_id=None, overlap=Job.OVERLAP_SKIP)
+        self.job_id = self.storage.jobs().next()['id']
+        self.start = datetime.datetime.utcnow()
+
+    def at(self, seconds):
+        return self.start + datetime.timedelta(seconds=seconds)
+
+    def job(self):
+        self.storage.session.expire_all()
+        return self.storage.session.query(Job).get(self.job_id)
+
+    def finish(self, seconds, return_code=0):
+        self.storage.add_results([{
+            'job_id': self.job_id,
+            '_datetime': self.at(seconds),
+            'run_id': 'a' * 32,
+            'type': 'finished',
+            'host': 'runner',
+            'return_code': return_code,
+        }])
+
+    def test_out_of_order_start_is_ignored(self):
+        self.finish(3)
+        self.assertTrue(self.storage.update_job_status('a' * 32, self.job_id, self.at(0), 'starting'))
+
+        job = self.job()
+        self.assertEqual(('succeeded', self.at(3)), (job.current_status, job.last_run_stop))
+        self.assertIsNone(job.last_run_start)
+
+    def test_finish_clears_the_lease(self):
+        self.storage.update_job_status('a' * 32, self.job_id, self.at(0), 'starting')
+        self.assertEqual('starting', self.job().current_status)
+        self.assertIsNotNone(self.job().run_lease_expires_at)
+
+        self.finish(3, return_code=1)
+        job = self.job()
+        self.assertEqual(('failed', 'failed', self.at(0)), (
+            job.current_status, job.last_run_status, job.last_run_start))
+        self.assertIsNone(job.run_lease_expires_at)
+
+    def test_start_renews_the_lease_of_a_long_job(self):
+        job = self.job()
+        job.timeout = 3600
+        self.storage.session.commit()
+
+        with mock.patch('cronq.backends.mysql.Config.INJECTOR_OVERLAP_LEASE', 60):
+            before = datetime.datetime.utcnow()
+            self.storage.update_job_status('a' * 32, self.job_id, self.at(0), 'starting')
+            self.assertGreaterEqual(self.job().run_lease_expires_at,
+                                    before + datetime.timedelta(hours=2))
+
+            self.finish(1)
+            self.storage.add_results([{
+                'job_id': self.job_id,
+                '_datetime': self.at(2),
+                'run_id': 'b' * 32,
+                'type': 'starting',
+            }])
+            self.assertGreaterEqual(self.job().run_lease_expires_at,
+                                    before + datetime.timedelta(hours=2))
+
+    def test_live_queued_run_is_kept(self):
+        lease = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        job = self.job()
+        job.current_status = Storage.QUEUED
+        job.run_lease_expires_at = lease
+        self.storage.session.commit()
+
+        self.finish(3)
+        job = self.job()
+        self.assertEqual((Storage.QUEUED, lease, 'succeeded'), (
+            job.current_status, job.run_lease_expires_at, job.last_run_status))
+
+    def test_no_backoff_after_the_last_attempt(self):
+        error = OperationalError('UPDATE', {}, Exception('deadlock'))
+        with mock.patch.object(self.storage, '_update_job_status', side_effect=error):
+            with mock.patch('cronq.backends.mysql.time.sleep') as sleep:
+                self.assertFalse(self.storage.update_job_status(
+                    'a' * 32, self.job_id, self.at(0), 'starting'))
+        self.assertEqual(STATUS_UPDATE_ATTEMPTS - 1, sleep.call_count)
+
+
+class TestOverlap(SqliteStorageTestCase):
+
+    def add_job(self, overlap):
+        self.storage.add_job('job', 3600, 'true', datetime.datetime.utcnow(),
+                             category_id=None, overlap=overlap)
+        return self.storage.jobs().next()['id']
+
+    def inject_now(self, job_id):
+        self.storage.run_job_now(job_id)
+        self.storage.inject()
+        return self.storage.publisher.publish.call_count
+
+    def job(self, job_id):
+        self.storage.session.expire_all()
+        return self.storage.session.query(Job).get(job_id)
+
+    def report(self, job_id, run_id, type, return_code=None):
+        self.storage.add_results([{
+            'job_id': job_id,
+            '_datetime': datetime.datetime.utcnow(),
+            'run_id': run_id,
+            'type': type,
+            'host': 'runner',
+            'return_code': return_code,
+        }])
+
+    def test_skip_while_a_run_is_in_progress(self):
+        job_id = self.add_job(Job.OVERLAP_SKIP)
+        self.assertEqual(1, self.inject_now(job_id))
+        self.report(job_id, 'a' * 32, 'starting')
+        self.assertEqual(1, self.inject_now(job_id))
+
+        self.report(job_id, 'a' * 32, 'finished', 0)
+        self.assertEqual(2, self.inject_now(job_id))
+
+    def test_queue_one_holds_a_run_until_the_current_one_finishes(self):
+        job_id = self.add_job(Job.OVERLAP_QUEUE_ONE)
+        self.assertEqual(1, self.inject_now(job_id))
+        self.report(job_id, 'a' * 32, 'starting')
+        self.assertEqual(1, self.inject_now(job_id))
+        self.assertEqual(1, self.inject_now(job_id))
+        self.assertEqual(['skipped', 'starting'],
+                         sorted(run['status'] for run in self.storage.runs_for_job(job_id, 20)))
+
+        self.report(job_id, 'a' * 32, 'finished', 0)
+        job = self.job(job_id)
+        self.assertEqual((1, 0), (job.run_now, job.run_queued))
+
+        self.storage.inject()
+        self.assertEqual(2, self.storage.publisher.publish.call_count)
+        self.assertEqual(Storage.QUEUED, self.job(job_id).current_status)
+
+    def test_expired_lease_lets_the_next_run_through(self):
+        job_id = self.add_job(Job.OVERLAP_SKIP)
+        self.assertEqual(1, self.inject_now(job_id))
+        job = self.job(job_id)
+        job.run_lease_expires_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        self.storage.session.commit()
+
+        self.assertEqual(2, self.inject_now(job_id))
+        self.assertEqual([], self.storage.runs_for_job(job_id, 20))
+
+    def test_skip_is_recorded_as_a_run(self):
+        job_id = self.add_job(Job.OVERLAP_SKIP)
+        self.assertEqual(1, self.inject_now(job_id))
+        self.assertEqual(1, self.inject_now(job_id))
+
+        run, = self.storage.runs_for_job(job_id, 20)
+        self.assertEqual('skipped', run['status'])
+        self.assertEqual(run, self.storage.get_run(run['id']))
+
+
+class TestInjectJobNow(SqliteStorageTestCase):
+
+    def setUp(self):
+        super(TestInjectJobNow, self).setUp()
+        self.next_run = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        self.storage.add_job('job', 3600, 'true', self.next_run, category_id=None)
+        self.job_id = self.storage.jobs().next()['id']
+
+    def job(self):
+        return self.storage.jobs(_id=self.job_id).next()
+
+    def run_now_flag(self):
+        self.storage.session.expire_all()
+        return self.storage.session.query(Job).get(self.job_id).run_now
+
+    def test_publishes_flagged_job_without_advancing_it(self):
+        self.storage.run_job_now(self.job_id)
+        self.assertTrue(self.storage.inject_job_now(self.job_id))
+
+        self.assertEqual(1, self.storage.publisher.publish.call_count)
+        self.assertFalse(self.run_now_flag())
+        self.assertEqual(self.next_run, self.job()['next_run'])
+
+    def test_ignores_job_not_flagged(self):
+        self.assertFalse(self.storage.inject_job_now(self.job_id))
+        self.assertFalse(self.storage.publisher.publish.called)
+        self.assertEqual(self.next_run, self.job()['next_run'])
+
+    def test_failed_publish_leaves_it_flagged(self):
+        self.storage.publisher.publish.return_value = False
+        self.storage.run_job_now(self.job_id)
+        self.assertFalse(self.storage.inject_job_now(self.job_id))
+        self.assertTrue(self.run_now_flag())
+        self.assertEqual(self.next_run, self.job()['next_run'])
+
+
+class TestBatchClaim(SqliteStorageTestCase):
+
+    def setUp(self):
+        super(TestBatchClaim, self).setUp()
+        self.storage.publisher.publish_many.side_effect = lambda jobs: [True] * len(jobs)
+        self.due = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+        for name in ('a', 'b', 'c'):
+            self.storage.add_job(name, 3600, 'true', self.due, category_id=None)
+
+    def test_claims_due_jobs_in_one_call(self):
+        self.assertEqual(3, self.storage.get_unpublished_tasks(10))
+
+        published, = self.storage.publisher.publish_many.call_args_list
+        self.assertEqual(['a', 'b', 'c'], sorted(doc['name'] for _, doc, _ in published[0][0]))
+        self.storage.session.expire_all()
+        for job in self.storage.jobs():
+            self.assertGreater(job['next_run'], datetime.datetime.utcnow())
+
+        self.assertEqual(0, self.storage.get_unpublished_tasks(10))
+        self.assertEqual(1, self.storage.publisher.publish_many.call_count)
+
+
+class TestClaimQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = Storage.__new__(Storage)
+        self.storage._shards = None
+        # an unbound session is enough to build the queries
+        self.session = sessionmaker()()
+
+    def claim_sql(self, dialect):
+        queries = self.storage._due_jobs_queries(self.session)
+        query = self.storage._claim_query(queries[1].limit(10), dialect.name)
+        return str(query.statement.compile(dialect=dialect)).strip()
+
+    def test_claims_lock_rows(self):
+        with mock.patch('cronq.backends.mysql.Config.INJECTOR_SKIP_LOCKED', False):
+            sql = self.claim_sql(mysql.dialect())
+        self.assertTrue(sql.endswith('FOR UPDATE'), sql)
+
+    def test_skip_locked_on_mysql(self):
+        with mock.patch('cronq.backends.mysql.Config.INJECTOR_SKIP_LOCKED', True):
+            sql = self.claim_sql(mysql.dialect())
+        self.assertTrue(sql.endswith('FOR UPDATE SKIP LOCKED'), sql)
+
+    def test_skip_locked_only_on_mysql(self):
+        with mock.patch('cronq.backends.mysql.Config.INJECTOR_SKIP_LOCKED', True):
+            sql = self.claim_sql(sqlite.dialect())
+        self.assertNotIn('SKIP LOCKED', sql)